@@ -1,9 +1,17 @@
+from flowy.boilerplate import start_activity_worker
+from flowy.boilerplate import start_workflow_worker
 from flowy.boilerplate import workflow_starter
 import argparse
+import importlib
+import multiprocessing
 import sys
 
 
-def main():
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['worker']:
+        return worker_main(argv[1:])
     parser = argparse.ArgumentParser()
     parser.add_argument("domain")
     parser.add_argument("name")
@@ -13,12 +21,41 @@ def main():
     parser.add_argument("--workflow-duration", type=int, default=None)
     parser.add_argument('args', nargs=argparse.REMAINDER)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     wf = workflow_starter(args.domain, args.name, args.version, args.task_list,
                           args.decision_duration, args.workflow_duration)
     return not wf.start(*args.args)  # 0 is success
 
 
+def worker_main(argv):
+    parser = argparse.ArgumentParser(prog='flowy worker')
+    parser.add_argument("kind", choices=['activity', 'workflow'])
+    parser.add_argument("domain")
+    parser.add_argument("task_list")
+    parser.add_argument("--package", required=True,
+                        help="the package to scan for tasks")
+    parser.add_argument("--processes", type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument("--max-tasks", type=int, default=None,
+                        help="recycle a worker after this many tasks")
+    parser.add_argument("--max-rss", type=int, default=None,
+                        help="recycle a worker above this many MB of RSS")
+    parser.add_argument("--identity", default=None)
+    parser.add_argument("--no-register", dest='register',
+                        action='store_false')
+
+    args = parser.parse_args(argv)
+
+    start = start_activity_worker
+    if args.kind == 'workflow':
+        start = start_workflow_worker
+    start(args.domain, args.task_list, reg_remote=args.register,
+          package=importlib.import_module(args.package),
+          identity=args.identity, processes=args.processes,
+          max_tasks=args.max_tasks, max_rss=args.max_rss)
+    return 0
+
+
 if __name__ == '__main__':
     sys.exit(main())
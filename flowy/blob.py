@@ -0,0 +1,194 @@
+""" Offloading of large payloads to a content-addressed blob store.
+
+SWF limits inputs and results to 32k characters and every payload is copied
+in the history, parsed again on each decision. When a blob store is set,
+serialized payloads larger than the threshold are stored under their SHA-256
+digest and replaced by a short reference that's restored on deserialization.
+Workers and deciders must use the same store.
+
+    set_blob_store(LocalBlobStore('/mnt/shared/flowy'), threshold=8192)
+
+"""
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+from collections import OrderedDict
+
+
+BLOB_PREFIX = '@blob:'
+BROADCAST_KEY = '@broadcast'
+
+_store = None
+_threshold = None
+_cache = None
+_broadcasts = None
+
+
+def set_blob_store(store, threshold=8192, cache_size=64):
+    """ Offload the payloads over threshold characters to store, None stops
+    the offloading. The last cache_size payloads and broadcast values read
+    are kept in memory.
+    """
+    global _store, _threshold, _cache, _broadcasts
+    _store = store
+    _threshold = threshold
+    _cache = LRUCache(cache_size)
+    _broadcasts = LRUCache(cache_size)
+
+
+def offload(data):
+    if _store is None or len(data) <= _threshold:
+        return data
+    key = _store.put(data.encode('utf-8'))
+    _cache[key] = data
+    return BLOB_PREFIX + key
+
+
+def restore(data):
+    if data is None or not data.startswith(BLOB_PREFIX):
+        return data
+    if _store is None:
+        raise ValueError('No blob store set to read %s.' % data)
+    key = data[len(BLOB_PREFIX):]
+    try:
+        return _cache[key]
+    except KeyError:
+        pass
+    payload = _store.get(key).decode('utf-8')
+    _cache[key] = payload
+    return payload
+
+
+def offload_buffer(data):
+    """ The key of the stored bytes, None if they should stay inline. """
+    if _store is None or len(data) <= _threshold:
+        return None
+    return _store.put(data)
+
+
+def restore_buffer(key):
+    """ The stored bytes, memory-mapped when the store supports it. """
+    if _store is None:
+        raise ValueError('No blob store set to read buffer %s.' % key)
+    get_buffer = getattr(_store, 'get_buffer', _store.get)
+    return get_buffer(key)
+
+
+def store_broadcast(value):
+    """ Store the value once for many calls, the returned key is passed as a
+    {BROADCAST_KEY: key} handle. None if there is no store to use.
+    """
+    if _store is None:
+        return None
+    return _store.put(json.dumps(value).encode('utf-8'))
+
+
+def resolve_broadcast(obj):
+    # a json object_hook, the values are shared by all the tasks in this
+    # process so they must be treated as read-only
+    if len(obj) != 1 or BROADCAST_KEY not in obj:
+        return obj
+    if _store is None:
+        raise ValueError('No blob store set to read broadcast %s.'
+                         % obj[BROADCAST_KEY])
+    key = obj[BROADCAST_KEY]
+    try:
+        return _broadcasts[key]
+    except KeyError:
+        pass
+    value = json.loads(_store.get(key).decode('utf-8'))
+    _broadcasts[key] = value
+    return value
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class LRUCache(object):
+    def __init__(self, size):
+        self._size = size
+        self._data = OrderedDict()
+
+    def __getitem__(self, key):
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self._size:
+            self._data.popitem(last=False)
+
+
+class LocalBlobStore(object):
+    """ Blobs as files in a directory, possibly on a shared filesystem. """
+    def __init__(self, path):
+        self._path = path
+
+    def put(self, data):
+        key = _digest(data)
+        path = self._blob_path(key)
+        if os.path.exists(path):
+            return key
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        # write aside and rename so readers never see a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return key
+
+    def get(self, key):
+        m = self.get_buffer(key)
+        try:
+            return m[:]
+        finally:
+            if not isinstance(m, bytes):
+                m.close()
+
+    def get_buffer(self, key):
+        # the mapping stays open as long as it's referenced, i.e. by the
+        # arrays created over it
+        with open(self._blob_path(key), 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _blob_path(self, key):
+        return os.path.join(self._path, key[:2], key)
+
+
+class S3BlobStore(object):
+    """ Blobs as objects in a S3 bucket, or any S3 compatible API. """
+    def __init__(self, bucket, prefix='', client=None):
+        if client is None:
+            import boto3
+            client = boto3.client('s3')
+        self._bucket = bucket
+        self._prefix = prefix
+        self._client = client
+
+    def put(self, data):
+        key = _digest(data)
+        self._client.put_object(Bucket=self._bucket, Key=self._prefix + key,
+                                Body=data)
+        return key
+
+    def get(self, key):
+        r = self._client.get_object(Bucket=self._bucket,
+                                    Key=self._prefix + key)
+        return r['Body'].read()
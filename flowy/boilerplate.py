@@ -7,14 +7,26 @@ import uuid
 from contextlib import contextmanager
 
 import boto3
+from boto.swf.layer1 import Layer1
 
+from flowy.codec import encode
+from flowy.gateway import CompletionGateway
+from flowy.limits import Limiter
+from flowy.outbox import CompletionSender
+from flowy.outbox import DecisionSender
+from flowy.outbox import Outbox
 from flowy.poller import SWFActivityPoller
 from flowy.poller import SWFWorkflowPoller
 from flowy.proxy import serialize_args
 from flowy.scanner import SWFScanner
+from flowy.serializer import get_serializer
 from flowy.spec import SWFWorkflowSpec
 from flowy.spec import _sentinel
 from flowy.task import AsyncSWFActivity
+from flowy.task import serialize_result
+from flowy.util import MagicBind
+from flowy.worker import PreforkSupervisor
+from flowy.worker import ProcessPoolWorker
 from flowy.worker import SingleThreadedWorker
 
 logger = logging.getLogger(__name__)
@@ -22,20 +34,19 @@ logger = logging.getLogger(__name__)
 
 def start_activity_worker(domain, task_list, client=None, reg_remote=True,
                           loop=-1, package=None, ignore=None, setup_log=True,
-                          identity=None):
+                          identity=None, processes=None, max_tasks=None,
+                          max_rss=None, pool_size=None, shm_threshold=65536,
+                          limits=None, max_task_rss=None, outbox=None):
+    if processes is not None and pool_size is not None:
+        raise ValueError('Use either a prefork or a process pool worker.')
     if setup_log:
         _setup_default_logger()
-    if identity is None:
-        identity = _default_identity()
 
     swf_client = client if client else boto3.client('swf')
 
     scanner = SWFScanner()
     scanner.scan_activities(package=package, ignore=ignore, level=1)
 
-    poller = SWFActivityPoller(domain, task_list, swf_client, identity, scanner)
-    worker = SingleThreadedWorker(poller)
-
     if reg_remote:
         not_registered = scanner.register_remote(swf_client)
         if not_registered:
@@ -44,24 +55,55 @@ def start_activity_worker(domain, task_list, client=None, reg_remote=True,
             )
             sys.exit(1)
 
-    try:
-        worker.run_forever(loop)
-    except KeyboardInterrupt:
-        pass
+    senders = []  # (pid, CompletionSender)
+
+    def poller_factory(forked=False, respond=True):
+        c = swf_client
+        if forked and client is None:
+            # after a fork each worker needs its own client
+            c = boto3.client('swf')
+        responder = None
+        if respond:
+            # in the process running the tasks, its thread doesn't survive
+            # a fork
+            responder = CompletionSender(
+                c, Outbox(outbox) if outbox is not None else None)
+            responder.start()
+            senders.append((os.getpid(), responder))
+        return SWFActivityPoller(domain, task_list, c,
+                                 identity or _default_identity(), scanner,
+                                 responder)
+
+    def teardown():
+        scanner.teardown()
+        for pid, sender in senders:
+            if pid == os.getpid():
+                sender.close()
+
+    def worker_factory():
+        limiter = Limiter(limits, spec_keys=scanner.spec_keys())
+        if pool_size is None:
+            poller = poller_factory(forked=processes is not None)
+            # warm up the pooled activities in the process running them
+            scanner.setup()
+            return SingleThreadedWorker(poller, teardown, limiter)
+        poller = poller_factory(forked=processes is not None, respond=False)
+        return ProcessPoolWorker(poller, lambda: poller_factory(forked=True),
+                                 pool_size, shm_threshold, scanner.setup,
+                                 teardown, limiter, max_task_rss)
+
+    _run_workers(worker_factory, loop, processes, max_tasks, max_rss)
 
 
 def start_workflow_worker(domain, task_list, layer1=None, reg_remote=True,
                           loop=-1, package=None, ignore=None, setup_log=True,
-                          identity=None):
+                          identity=None, processes=None, max_tasks=None,
+                          max_rss=None, pipeline=False):
     if setup_log:
         _setup_default_logger()
-    if identity is None:
-        identity = _default_identity()
-    swf_client = _get_client(layer1, domain, identity)
+    swf_client = _get_client(layer1, domain, identity or _default_identity())
     scanner = SWFScanner()
     scanner.scan_workflows(package=package, ignore=ignore, level=1)
-    poller = SWFWorkflowPoller(swf_client, task_list, scanner)
-    worker = SingleThreadedWorker(poller)
     if reg_remote:
         not_registered = scanner.register_remote(swf_client)
         if not_registered:
@@ -69,25 +111,74 @@ def start_workflow_worker(domain, task_list, layer1=None, reg_remote=True,
                 'Not all workflows could be registered: %s', not_registered
             )
             sys.exit(1)
+
+    def worker_factory():
+        c = swf_client
+        if processes is not None:
+            # after a fork each worker needs its own client
+            c = _get_client(layer1, domain, identity or _default_identity())
+        if not pipeline:
+            return SingleThreadedWorker(SWFWorkflowPoller(c, task_list,
+                                                          scanner))
+        # poll for the next decision task while the decisions are sent
+        sender = DecisionSender(lambda: _get_client(
+            layer1, domain, identity or _default_identity()))
+        sender.start()
+        poller = SWFWorkflowPoller(c, task_list, scanner, responder=sender)
+        return SingleThreadedWorker(poller, sender.close)
+
+    _run_workers(worker_factory, loop, processes, max_tasks, max_rss)
+
+
+def _run_workers(worker_factory, loop, processes, max_tasks, max_rss):
+    # the code is imported and scanned once, then shared by the processes
     try:
-        worker.run_forever(loop)
+        if processes is None:
+            worker = worker_factory()
+            try:
+                worker.run_forever(loop)
+            finally:
+                close = getattr(worker, 'close', None)
+                if close is not None:
+                    close()
+        else:
+            PreforkSupervisor(worker_factory, processes, max_tasks,
+                              max_rss).run_forever()
     except KeyboardInterrupt:
         pass
 
 
-def async_scheduler(domain, token, layer1=None):
-    return AsyncSWFActivity(_get_client(layer1, domain), token)
+def async_scheduler(domain, token, layer1=None, compression=None,
+                    serializer=None):
+    return AsyncSWFActivity(_get_client(layer1, domain), token, compression,
+                            serializer)
+
+
+def completion_gateway(domain, layer1=None, **kwargs):
+    """ A CompletionGateway for many AsyncSWFActivity tasks, to be started.
+    """
+    return CompletionGateway(lambda: _get_client(layer1, domain), **kwargs)
 
 
 def workflow_starter(domain, name, version, task_list=None,
                      decision_duration=None, workflow_duration=None,
-                     id=None, tags=None, layer1=None, setup_log=True):
+                     id=None, tags=None, layer1=None, setup_log=True,
+                     compression=None, serializer=None):
     if setup_log:
         _setup_default_logger()
     spec = SWFWorkflowSpec(name, version, task_list, decision_duration,
                            workflow_duration)
     client = _get_client(layer1, domain)
-    return SWFWorkflowStarter(spec, client, id, tags)
+    return SWFWorkflowStarter(spec, client, id, tags, compression,
+                              serializer)
+
+
+def _get_client(layer1, domain, identity=None):
+    # the deciders and the async activities speak boto's Layer1, bound to
+    # the domain and the identity of the worker
+    if layer1 is None:
+        layer1 = Layer1()
+    return MagicBind(layer1, domain=domain, identity=identity)
 
 
 def _default_identity():
@@ -96,11 +187,14 @@ def _default_identity():
 
 
 class SWFWorkflowStarter(object):
-    def __init__(self, spec, client, id=None, tags=None):
+    def __init__(self, spec, client, id=None, tags=None, compression=None,
+                 serializer=None):
         self._spec = spec
         self._client = client
         self._id = id
         self._tags = tags
+        self._compression = compression
+        self._serializer = serializer
 
     @contextmanager
     def options(self, task_list=_sentinel, decision_duration=_sentinel,
@@ -122,10 +216,27 @@ class SWFWorkflowStarter(object):
         id = self._id
         if id is None:
             id = uuid.uuid4()
-        input = self._serialize_arguments(*args, **kwargs)
+        if self._serializer is not None:
+            input = get_serializer(self._serializer).dumps([args, kwargs])
+        else:
+            input = self._serialize_arguments(*args, **kwargs)
+        input = encode(input, self._compression)
         return self._spec.start(self._client, id, input, self._tags)
 
+    def signal(self, name, value=None, id=None, run_id=None):
+        if id is None:
+            id = self._id
+        if id is None:
+            raise ValueError("The workflow ID is required to signal it.")
+        if self._serializer is not None:
+            input = get_serializer(self._serializer).dumps(value)
+        else:
+            input = self._serialize_signal(value)
+        input = encode(input, self._compression)
+        return self._spec.signal(self._client, id, name, input, run_id)
+
     _serialize_arguments = serialize_args
+    _serialize_signal = serialize_result
 
 
 def _setup_default_logger():
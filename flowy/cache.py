@@ -0,0 +1,167 @@
+""" A decider side cache for the results of deterministic activities.
+
+Activities declared with swf_activity(..., cacheable=True, ttl=...) have
+their results cached by the deciders, keyed by name, version and a digest of
+the input. A result is cached once, by the decision that sees its activity
+complete, never from a replayed history or a cache marker. On a hit the result is recorded in a history marker instead of
+scheduling the activity. The activity modules must be imported by the
+deciders for them to know which activities are cacheable, scanning the same
+package does that.
+
+    set_result_cache(TieredCache(MemoryCache(1024), SQLiteCache('/tmp/c')))
+
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+CACHE_MARKER_PREFIX = 'flowy.cache.'
+
+_cacheable = {}
+_result_cache = None
+
+
+def set_cacheable(name, version, ttl=None):
+    _cacheable[(str(name), str(version))] = ttl
+
+
+def set_result_cache(cache):
+    global _result_cache
+    _result_cache = cache
+
+
+def is_cacheable(spec):
+    """ If the results of the activity are cached by this process. """
+    return _result_cache is not None and _cache_key(spec) in _cacheable
+
+
+def cached_result(spec, input):
+    """ The cached result, None on a miss or if the activity isn't cacheable.
+    """
+    if _result_cache is None:
+        return None
+    key = _cache_key(spec)
+    if key not in _cacheable:
+        return None
+    return _result_cache.get(_input_key(key, input))
+
+
+def cache_result(spec, input, result):
+    if _result_cache is None:
+        return
+    key = _cache_key(spec)
+    if key not in _cacheable:
+        return
+    input_key = _input_key(key, input)
+    if _result_cache.get(input_key) is None:
+        _result_cache.set(input_key, result, _cacheable[key])
+
+
+def _cache_key(spec):
+    return str(spec._name), str(spec._version)
+
+
+def _input_key(key, input):
+    digest = hashlib.sha256(input.encode('utf-8')).hexdigest()
+    return '%s:%s:%s' % (key[0], key[1], digest)
+
+
+def _expires(ttl):
+    if ttl is None:
+        return None
+    return time.time() + ttl
+
+
+class MemoryCache(object):
+    """ An in-process LRU cache. """
+    def __init__(self, size=1024):
+        self._size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires < time.time():
+                return None
+            self._data[key] = value, expires
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value, _expires(ttl)
+            while len(self._data) > self._size:
+                self._data.popitem(last=False)
+
+
+class SQLiteCache(object):
+    """ A cache in a local SQLite database, shared by the local deciders. """
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        with self._connection() as c:
+            c.execute('CREATE TABLE IF NOT EXISTS results ('
+                      'key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+
+    def get(self, key):
+        with self._connection() as c:
+            row = c.execute('SELECT value, expires FROM results '
+                            'WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        if expires is not None and expires < time.time():
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        with self._connection() as c:
+            c.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                      (key, value, _expires(ttl)))
+
+    def purge(self):
+        """ Delete the expired results. """
+        with self._connection() as c:
+            c.execute('DELETE FROM results WHERE expires < ?', (time.time(),))
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=30)
+            self._local.connection = connection
+        return connection
+
+
+class TieredCache(object):
+    """ Looks up the caches in order, the hits are copied to the faster ones.
+
+    The remaining time to live isn't known across tiers, so the copies are
+    kept for promote_ttl seconds at most.
+    """
+    def __init__(self, *caches, **kwargs):
+        self._caches = caches
+        self._promote_ttl = kwargs.pop('promote_ttl', 60)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments: %s'
+                            % ', '.join(sorted(kwargs)))
+
+    def get(self, key):
+        for i, cache in enumerate(self._caches):
+            value = cache.get(key)
+            if value is not None:
+                for faster in self._caches[:i]:
+                    faster.set(key, value, self._promote_ttl)
+                return value
+        return None
+
+    def set(self, key, value, ttl=None):
+        for cache in self._caches:
+            cache.set(key, value, ttl)
@@ -0,0 +1,115 @@
+""" Encoding of the serialized payloads before they are sent to SWF.
+
+A payload is optionally compressed and then, if still large, offloaded to
+the blob store. Compressed payloads start with a short header naming the
+algorithm, so they are decoded whatever the settings of the reader are.
+
+    compression = Compression('zlib', threshold=1024)
+    summarize = SWFActivityProxy('Summarize', 1, compression=compression)
+
+"""
+import base64
+import zlib
+
+from flowy.blob import offload, restore
+
+try:
+    import lz4.frame as lz4
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+try:
+    import zstandard as zstd
+except ImportError:  # pragma: no cover
+    zstd = None
+
+
+def _zlib_compress(data, level):
+    return zlib.compress(data, 6 if level is None else level)
+
+
+def _lz4_compress(data, level):
+    return lz4.compress(data, compression_level=level or 0)
+
+
+def _zstd_compress(data, level):
+    return zstd.ZstdCompressor(level=level or 3).compress(data)
+
+
+def _zstd_decompress(data):
+    return zstd.ZstdDecompressor().decompress(data)
+
+
+_CODECS = {'zlib': (_zlib_compress, zlib.decompress)}
+if lz4 is not None:
+    _CODECS['lz4'] = (_lz4_compress, lz4.decompress)
+if zstd is not None:
+    _CODECS['zstd'] = (_zstd_compress, _zstd_decompress)
+
+
+def compress_bytes(codec, data, level=None):
+    compress, _ = _codec(codec)
+    return compress(data, level)
+
+
+def decompress_bytes(codec, data):
+    _, decompress = _codec(codec)
+    return decompress(data)
+
+
+def _codec(codec):
+    try:
+        return _CODECS[codec]
+    except KeyError:
+        raise ValueError('Compression codec %r is not available.' % codec)
+
+
+class Compression(object):
+    """ Compress the payloads longer than threshold characters.
+
+    The compressed data is base64 encoded, so it's only used when it's
+    actually shorter than the original payload.
+    """
+    def __init__(self, codec='zlib', threshold=1024, level=None):
+        if codec not in _CODECS:
+            raise ValueError('Compression codec %r is not available.'
+                             % codec)
+        self._codec = codec
+        self._threshold = threshold
+        self._level = level
+
+    def compress(self, data):
+        if len(data) <= self._threshold:
+            return data
+        compress, _ = _CODECS[self._codec]
+        compressed = base64.b64encode(compress(data.encode('utf-8'),
+                                               self._level))
+        compressed = '@%s:%s' % (self._codec, compressed.decode('ascii'))
+        if len(compressed) >= len(data):
+            return data
+        return compressed
+
+    def __repr__(self):
+        klass = self.__class__.__name__
+        return '%s(codec=%r, threshold=%r, level=%r)' % (
+            klass, self._codec, self._threshold, self._level)
+
+
+def encode(data, compression=None):
+    if compression is not None:
+        data = compression.compress(data)
+    return offload(data)
+
+
+def decode(data):
+    data = restore(data)
+    if data is None or not data.startswith('@'):
+        return data
+    codec, sep, payload = data[1:].partition(':')
+    if not sep or codec not in ('zlib', 'lz4', 'zstd'):
+        return data
+    if codec not in _CODECS:
+        raise ValueError('The %r codec is required to decode the payload.'
+                         % codec)
+    _, decompress = _CODECS[codec]
+    return decompress(base64.b64decode(payload)).decode('utf-8')
@@ -16,3 +16,9 @@ class TaskTimedout(TaskError):
     """ Raised from an activity or subworkflow task if any of its timeout
     timers were exceeded.
     """
+
+
+class TaskCancelled(Exception):
+    """ Raised from the heartbeat of an activity once its cancellation was
+    requested, the activity then stops and is reported as cancelled.
+    """
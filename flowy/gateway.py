@@ -0,0 +1,204 @@
+""" A gateway finishing many AsyncSWFActivity tasks from one process.
+
+The external systems hand the results of the async activities to the
+gateway, it sends them concurrently on a pool of lanes, each with its own
+client, within an optional shared rate:
+
+    gateway = CompletionGateway(lambda: boto3.client('swf'), lanes=32,
+                                rate=2000, outbox='/var/lib/flowy/gateway')
+    gateway.start()
+    gateway.finish(token, result)
+
+A token is finished or failed only once, the duplicates are dropped. The
+other processes can hand over their results through a spool directory the
+gateway drains:
+
+    spool('/var/spool/flowy', token, result=result)
+
+With an outbox, the responses are journaled before the spool files are
+removed and the unsent ones are sent again when the gateway restarts.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from flowy.codec import encode
+from flowy.limits import TokenBucket
+from flowy.outbox import CompletionSender, Outbox
+from flowy.serializer import get_serializer
+from flowy.task import serialize_result
+
+
+logger = logging.getLogger(__name__)
+
+
+def spool(directory, token, result=None, reason=None, heartbeat=False):
+    """ Hand a response over to the gateway draining directory.
+
+    The result is serialized by the gateway. The file is renamed in place
+    once written, so the gateway never reads a partial one.
+    """
+    if heartbeat:
+        record = {'token': token, 'heartbeat': True}
+    elif reason is not None:
+        record = {'token': token, 'reason': str(reason)}
+    else:
+        record = {'token': token, 'result': result}
+    name = '%.6f-%s' % (time.time(), uuid.uuid4().hex)
+    path = os.path.join(directory, name + '.tmp')
+    with open(path, 'w') as f:
+        json.dump(record, f)
+    os.rename(path, os.path.join(directory, name + '.json'))
+
+
+class CompletionGateway(object):
+    """ Sends the responses of the async activities on lanes threads.
+
+    The responses of a token are sent in order on the same lane. rate and
+    burst limit the calls per second of all the lanes together. The tokens
+    finished or failed are remembered, up to dedupe_size of them, so the
+    duplicates are dropped.
+    """
+
+    # how often the spool directory is scanned, in seconds
+    spool_interval = 0.1
+
+    def __init__(self, client_factory, lanes=16, rate=None, burst=None,
+                 outbox=None, spool=None, compression=None, serializer=None,
+                 retries=8, backoff=1, max_backoff=60, dedupe_size=100000):
+        bucket = None
+        if rate is not None:
+            bucket = _SharedBucket(rate, burst)
+        self._lanes = []
+        for _ in range(lanes):
+            client = client_factory()
+            if bucket is not None:
+                client = _RateLimitedClient(client, bucket)
+            lane_outbox = Outbox(outbox) if outbox is not None else None
+            self._lanes.append(CompletionSender(client, lane_outbox, retries,
+                                                backoff, max_backoff))
+        self._spool = spool
+        self._compression = compression
+        self._serializer = serializer
+        self._dedupe_size = dedupe_size
+        self._done = OrderedDict()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._spool_thread = None
+
+    def start(self):
+        for lane in self._lanes:
+            lane.start()
+        if self._spool is not None:
+            self._spool_thread = threading.Thread(target=self._drain_spool)
+            self._spool_thread.daemon = True
+            self._spool_thread.start()
+
+    def close(self):
+        """ Drain the spool and wait for the queued responses. """
+        self._stopping.set()
+        if self._spool_thread is not None:
+            self._spool_thread.join()
+            self._spool_thread = None
+        for lane in self._lanes:
+            lane.close()
+
+    def finish(self, token, result):
+        try:
+            if self._serializer is not None:
+                result = get_serializer(self._serializer).dumps(result)
+            else:
+                result = self._serialize_result(result)
+            result = encode(result, self._compression)
+        except TypeError:
+            logger.exception('Error while serializing the result:')
+            return False
+        return self._respond('respond_activity_task_completed', token,
+                             result=str(result))
+
+    def fail(self, token, reason):
+        return self._respond('respond_activity_task_failed', token,
+                             reason=str(reason)[:256], details=None)
+
+    def heartbeat(self, token):
+        with self._lock:
+            if token in self._done:
+                return False
+        self._lane(token).queue_heartbeat(task_token=str(token))
+        return True
+
+    def _respond(self, method, token, **kwargs):
+        token = str(token)
+        with self._lock:
+            if token in self._done:
+                logger.info('Dropping a duplicate response.')
+                return False
+            self._done[token] = True
+            while len(self._done) > self._dedupe_size:
+                self._done.popitem(last=False)
+        kwargs['task_token'] = token
+        self._lane(token)._send(method, kwargs, token)
+        return True
+
+    def _lane(self, token):
+        return self._lanes[hash(token) % len(self._lanes)]
+
+    def _drain_spool(self):
+        while 1:
+            stopping = self._stopping.is_set()
+            names = sorted(n for n in os.listdir(self._spool)
+                           if n.endswith('.json'))
+            for name in names:
+                path = os.path.join(self._spool, name)
+                try:
+                    with open(path) as f:
+                        record = json.load(f)
+                except (IOError, OSError, ValueError):
+                    logger.exception('Error while reading %s:', path)
+                    continue
+                if record.get('heartbeat'):
+                    self.heartbeat(record['token'])
+                elif 'reason' in record:
+                    self.fail(record['token'], record['reason'])
+                else:
+                    self.finish(record['token'], record.get('result'))
+                os.remove(path)
+            if stopping:
+                break
+            if not names:
+                self._stopping.wait(self.spool_interval)
+
+    _serialize_result = serialize_result
+
+
+class _SharedBucket(object):
+    def __init__(self, rate, burst=None):
+        self._bucket = TokenBucket(rate, burst)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while 1:
+            with self._lock:
+                delay = self._bucket.delay()
+                if not delay:
+                    self._bucket.take()
+                    return
+            time.sleep(delay)
+
+
+class _RateLimitedClient(object):
+    def __init__(self, client, bucket):
+        self._client = client
+        self._bucket = bucket
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        def call(**kwargs):
+            self._bucket.acquire()
+            return method(**kwargs)
+        return call
@@ -0,0 +1,220 @@
+""" Per activity type limits on the tasks run by a worker.
+
+An activity can limit how many of its tasks run at once and how many are
+started per second, with bursts of up to burst tasks:
+
+    @swf_activity(1, concurrency=4, rate=10, burst=20)
+    class Export(SWFActivity): ...
+
+The limits are enforced by each worker: every prefork worker has its own and
+the processes of a process pool worker share them. The workers can override
+them with the limits argument of start_activity_worker:
+
+    start_activity_worker('domain', 'list', limits={
+        ('Export', 1): Limit(concurrency=2)})
+
+An activity can also declare the CPU units and the megabytes of memory its
+tasks need, a process pool worker only starts the tasks that fit in what's
+left of the host capacity and only polls for more tasks while the smallest
+of the activities it runs still fits, one declaring no needs always does:
+
+    @swf_activity(1, cpu=2, memory=4096)
+    class Train(SWFActivity): ...
+
+SWF hands out the tasks of a task list in order, whatever their type, so a
+task over its limits is held by the worker until it can start and no more
+tasks are claimed while the worker holds one for each of its processes.
+A task needing more than the whole capacity runs alone.
+"""
+import os
+import time
+
+
+_limits = {}
+
+
+def set_limits(name, version, concurrency=None, rate=None, burst=None,
+               cpu=None, memory=None):
+    _limits[_key((name, version))] = Limit(concurrency, rate, burst, cpu,
+                                           memory)
+
+
+def _key(spec_key):
+    name, version = spec_key
+    return str(name), str(version)
+
+
+def host_capacity():
+    """ The CPUs and the megabytes of physical memory of this host. """
+    try:
+        memory = (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+                  // (1024 * 1024))
+    except (AttributeError, ValueError, OSError):  # pragma: no cover
+        memory = None
+    return Capacity(_cpu_count(), memory)
+
+
+def _cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # pragma: no cover
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+
+def _has_needs(limit):
+    return limit is not None and (limit.cpu is not None
+                                  or limit.memory is not None)
+
+
+class Capacity(object):
+    def __init__(self, cpu=None, memory=None):
+        self.cpu = cpu
+        self.memory = memory
+
+    def __repr__(self):
+        klass = self.__class__.__name__
+        return '%s(cpu=%r, memory=%r)' % (klass, self.cpu, self.memory)
+
+
+class Limit(object):
+    def __init__(self, concurrency=None, rate=None, burst=None, cpu=None,
+                 memory=None):
+        if concurrency is not None and concurrency < 1:
+            raise ValueError('The concurrency must be at least 1.')
+        if rate is not None and rate <= 0:
+            raise ValueError('The rate must be positive.')
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.cpu = cpu
+        self.memory = memory
+
+    def __repr__(self):
+        klass = self.__class__.__name__
+        return ('%s(concurrency=%r, rate=%r, burst=%r, cpu=%r, memory=%r)'
+                % (klass, self.concurrency, self.rate, self.burst, self.cpu,
+                   self.memory))
+
+
+class TokenBucket(object):
+    """ Allows rate tasks per second on average and burst at once. """
+    def __init__(self, rate, burst=None, clock=time.time):
+        self._rate = float(rate)
+        self._capacity = max(1, burst or 1)
+        self._tokens = self._capacity
+        self._clock = clock
+        self._last = clock()
+
+    def delay(self):
+        """ The seconds to wait for the next token. """
+        self._refill()
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self._rate
+
+    def take(self):
+        self._refill()
+        self._tokens -= 1
+
+    def _refill(self):
+        now = self._clock()
+        elapsed = max(0, now - self._last)
+        self._tokens = min(self._capacity,
+                           self._tokens + elapsed * self._rate)
+        self._last = now
+
+
+class Limiter(object):
+    """ Tracks the running tasks and the rates of the limited activities.
+
+    The resources needed by the running tasks are packed in capacity, the
+    host capacity by default. spec_keys are the activities run by the
+    worker, the ones it polls for while the smallest of them still fits.
+    """
+    def __init__(self, limits=None, clock=time.time, capacity=None,
+                 spec_keys=None):
+        self._limits = dict(_limits)
+        for spec_key, limit in (limits or {}).items():
+            self._limits[_key(spec_key)] = limit
+        self._spec_keys = None
+        if spec_keys is not None:
+            self._spec_keys = [_key(spec_key) for spec_key in spec_keys]
+        self._clock = clock
+        if capacity is None:
+            capacity = host_capacity()
+        self._capacity = capacity
+        self._running = {}
+        self._buckets = {}
+        self._used = [0, 0]  # CPUs and memory
+        self._tasks = 0
+
+    def delay(self, spec_key):
+        """ The seconds until a task can start, None if it has to wait for a
+        running task to finish.
+        """
+        key = _key(spec_key)
+        limit = self._limits.get(key)
+        if limit is None:
+            return 0
+        if (limit.concurrency is not None
+                and self._running.get(key, 0) >= limit.concurrency):
+            return None
+        if not self._fits(limit):
+            return None
+        if limit.rate is None:
+            return 0
+        return self._bucket(key, limit).delay()
+
+    def can_poll(self):
+        """ If the needs of any activity run by the worker still fit, an
+        activity that declares none always fits.
+        """
+        if self._spec_keys is None:
+            # not known, only the activities declaring their needs count
+            limits = [l for l in self._limits.values() if _has_needs(l)]
+        else:
+            limits = [self._limits.get(key) for key in self._spec_keys]
+        if not all(_has_needs(l) for l in limits):
+            return True
+        return not limits or any(self._fits(l) for l in limits)
+
+    def start(self, spec_key):
+        self._tasks += 1
+        key = _key(spec_key)
+        limit = self._limits.get(key)
+        if limit is None:
+            return
+        self._running[key] = self._running.get(key, 0) + 1
+        self._used[0] += limit.cpu or 0
+        self._used[1] += limit.memory or 0
+        if limit.rate is not None:
+            self._bucket(key, limit).take()
+
+    def finish(self, spec_key):
+        self._tasks = max(0, self._tasks - 1)
+        key = _key(spec_key)
+        limit = self._limits.get(key)
+        if self._running.get(key):
+            self._running[key] -= 1
+            self._used[0] -= limit.cpu or 0
+            self._used[1] -= limit.memory or 0
+
+    def _fits(self, limit):
+        # a task larger than the capacity runs alone
+        if not self._tasks:
+            return True
+        cpu, memory = self._capacity.cpu, self._capacity.memory
+        if (limit.cpu and cpu is not None
+                and self._used[0] + limit.cpu > cpu):
+            return False
+        if (limit.memory and memory is not None
+                and self._used[1] + limit.memory > memory):
+            return False
+        return True
+
+    def _bucket(self, key, limit):
+        if key not in self._buckets:
+            self._buckets[key] = TokenBucket(limit.rate, limit.burst,
+                                             self._clock)
+        return self._buckets[key]
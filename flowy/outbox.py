@@ -0,0 +1,329 @@
+""" Sends the responses of the activities and deciders in the background.
+
+A CompletionSender stands in for the SWF client of the activities: their
+completions, failures and cancellations are queued and sent by a background
+thread, so the worker polls for the next task right away. The responses that
+fail to send are retried with an exponential backoff. The heartbeats are
+sent right away, their response tells if the task is to be cancelled.
+
+With an Outbox, every completion and failure is first appended to a local
+journal and acknowledged there once it's sent. The responses still in the
+journals of the workers that stopped or crashed are sent again when a worker
+using the same outbox directory starts:
+
+    start_activity_worker('domain', 'list', outbox='/var/lib/flowy/outbox')
+
+Every process writes its own journal, locked while the process is alive.
+"""
+import heapq
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+# the task can't be completed anymore, it timed out or was closed
+_PERMANENT_ERRORS = ('UnknownResourceFault', 'OperationNotPermittedFault',
+                     'ValidationException')
+
+
+class Outbox(object):
+    """ Append-only journals of the responses in directory. """
+
+    # the journal is truncated when nothing is pending and it's larger
+    compact_size = 1024 * 1024
+
+    def __init__(self, directory, fsync=False):
+        self._directory = directory
+        self._fsync = fsync
+        self._lock = threading.Lock()
+        self._pending = set()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        name = '%s-%s-%s.outbox' % (socket.gethostname(), os.getpid(),
+                                    uuid.uuid4().hex[:8])
+        self._path = os.path.join(directory, name)
+        self._file = open(self._path, 'a')
+        _lock_file(self._file)
+
+    def recover(self):
+        """ Take over the responses left in the journals of dead workers. """
+        records = []
+        for name in sorted(os.listdir(self._directory)):
+            path = os.path.join(self._directory, name)
+            if not name.endswith('.outbox') or path == self._path:
+                continue
+            try:
+                f = open(path, 'r+')
+            except (IOError, OSError):
+                continue
+            try:
+                if not _lock_file(f, block=False):
+                    continue  # its worker is still running
+                for record in _pending_records(f):
+                    self._write(record)
+                    records.append(record)
+                os.remove(path)
+            finally:
+                f.close()
+        return records
+
+    def append(self, method, kwargs):
+        record = {'id': uuid.uuid4().hex, 'method': method, 'kwargs': kwargs}
+        self._write(record)
+        return record
+
+    def ack(self, id):
+        self._write({'ack': id})
+
+    def close(self):
+        self._file.close()
+
+    def _write(self, record):
+        with self._lock:
+            if 'ack' in record:
+                self._pending.discard(record['ack'])
+            else:
+                self._pending.add(record['id'])
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+            if self._fsync:
+                os.fsync(self._file.fileno())
+            if not self._pending and self._file.tell() > self.compact_size:
+                self._file.truncate(0)
+
+
+def _pending_records(f):
+    records, acked = [], set()
+    for line in f:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue  # the last line of a crashed worker
+        if 'ack' in record:
+            acked.add(record['ack'])
+        else:
+            records.append(record)
+    return [r for r in records if r['id'] not in acked]
+
+
+def _lock_file(f, block=True):
+    if fcntl is None:  # pragma: no cover
+        return block
+    flags = fcntl.LOCK_EX if block else fcntl.LOCK_EX | fcntl.LOCK_NB
+    try:
+        fcntl.flock(f.fileno(), flags)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _error_code(e):
+    # boto raises SWFResponseErrors, boto3 ClientErrors
+    code = getattr(e, 'error_code', None)
+    response = getattr(e, 'response', None)
+    if code is None and isinstance(response, dict):
+        code = response.get('Error', {}).get('Code')
+    if code is None:
+        body = getattr(e, 'body', None)
+        if isinstance(body, dict):
+            code = body.get('__type', '').rpartition('#')[2]
+    return code
+
+
+class CompletionSender(object):
+    """ Queues the responses of the activities and sends them in a thread.
+
+    A response is retried up to retries times, waiting backoff seconds
+    after the first failure and doubling up to max_backoff. The ones that
+    couldn't be sent stay in the outbox for the next start, and so do the
+    ones still waiting to be retried when the sender is closed. The queued
+    heartbeats that fail are not retried.
+    """
+    def __init__(self, swf_client, outbox=None, retries=8, backoff=1,
+                 max_backoff=60):
+        self._swf_client = swf_client
+        self._outbox = outbox
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._queue = queue.Queue()
+        self._heartbeats = set()  # the tokens with a heartbeat queued
+        self._thread = None
+
+    def start(self):
+        if self._outbox is not None:
+            for record in self._outbox.recover():
+                self._queue.put(record)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """ Wait for the queued responses to be sent or given up on. """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._outbox is not None:
+            self._outbox.close()
+
+    def respond_activity_task_completed(self, **kwargs):
+        self._send('respond_activity_task_completed', kwargs)
+
+    def respond_activity_task_failed(self, **kwargs):
+        self._send('respond_activity_task_failed', kwargs)
+
+    def respond_activity_task_canceled(self, **kwargs):
+        self._send('respond_activity_task_canceled', kwargs)
+
+    def record_activity_task_heartbeat(self, **kwargs):
+        # the activity waits for the response, it may request the cancellation
+        return self._swf_client.record_activity_task_heartbeat(**kwargs)
+
+    def queue_heartbeat(self, **kwargs):
+        # the heartbeats are not journaled and a queued one is enough
+        token = kwargs.get('task_token')
+        if token in self._heartbeats:
+            return
+        self._heartbeats.add(token)
+        self._queue.put({'method': 'record_activity_task_heartbeat',
+                         'kwargs': kwargs})
+
+    def _send(self, method, kwargs, key=None):
+        if self._outbox is not None:
+            record = self._outbox.append(method, kwargs)
+        else:
+            record = {'method': method, 'kwargs': kwargs}
+        if key is not None:
+            # sent in order with the other records with the same key
+            record['key'] = key
+        self._queue.put(record)
+
+    def _run(self):
+        retries = []  # (due, sequence, attempt, record)
+        sequence = itertools.count()
+        # the records queued behind a retried one with the same key
+        waiting = {}
+
+        def retry(attempt, record, delay=0):
+            heapq.heappush(retries, (time.time() + delay, next(sequence),
+                                     attempt, record))
+
+        def release(key):
+            if key not in waiting:
+                return
+            if waiting[key]:
+                retry(0, waiting[key].pop(0))
+            else:
+                del waiting[key]
+
+        while 1:
+            timeout = None
+            if retries:
+                timeout = max(0, retries[0][0] - time.time())
+            try:
+                record = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                _, _, attempt, record = heapq.heappop(retries)
+            else:
+                if record is None:
+                    break
+                attempt = 0
+                if record.get('key') in waiting:
+                    waiting[record['key']].append(record)
+                    continue
+            key = record.get('key')
+            if self._deliver(record):
+                release(key)
+                continue
+            attempt += 1
+            if attempt > self._retries:
+                logger.error('Giving up sending %s.', record['method'])
+                release(key)
+                continue
+            if key is not None:
+                waiting.setdefault(key, [])
+            retry(attempt, record, min(self._max_backoff,
+                                       self._backoff * 2 ** (attempt - 1)))
+        # a last try, the ones that fail are left in the outbox
+        for _, _, _, record in sorted(retries):
+            self._deliver(record)
+            for waiting_record in waiting.pop(record.get('key'), []):
+                self._deliver(waiting_record)
+
+    def _deliver(self, record):
+        """ False if it should be retried. """
+        method, kwargs = record['method'], record['kwargs']
+        if method == 'record_activity_task_heartbeat':
+            self._heartbeats.discard(kwargs.get('task_token'))
+        try:
+            getattr(self._swf_client, method)(**kwargs)
+        except Exception as e:
+            retry = method != 'record_activity_task_heartbeat'
+            if retry and _error_code(e) not in _PERMANENT_ERRORS:
+                logger.warning('Error while sending %s, retrying: %s',
+                               method, e)
+                return False
+            logger.exception('Error while sending %s:', method)
+        if 'id' in record:
+            self._outbox.ack(record['id'])
+        return True
+
+
+class DecisionSender(object):
+    """ Sends the decisions of the deciders in the background.
+
+    The decisions are spread on lanes threads by workflow ID, so the ones
+    of a workflow are sent in order and a slow or retried response only
+    holds back the workflows on its lane, and in its lane only its own
+    workflow. Every lane sends with its own client from client_factory.
+    The decisions are not journaled, a lost one is scheduled again by SWF
+    once its decision task times out.
+    """
+    def __init__(self, client_factory, lanes=4, retries=5, backoff=0.5,
+                 max_backoff=10):
+        self._lanes = [CompletionSender(client_factory(), None, retries,
+                                        backoff, max_backoff)
+                       for _ in range(lanes)]
+
+    def start(self):
+        for lane in self._lanes:
+            lane.start()
+
+    def close(self):
+        for lane in self._lanes:
+            lane.close()
+
+    def bind(self, workflow_id):
+        """ A client sending the decisions of a workflow. """
+        return _WorkflowDecisions(self, workflow_id)
+
+    def _send(self, workflow_id, kwargs):
+        lane = self._lanes[hash(workflow_id) % len(self._lanes)]
+        lane._send('respond_decision_task_completed', kwargs, workflow_id)
+
+
+class _WorkflowDecisions(object):
+    def __init__(self, sender, workflow_id):
+        self._sender = sender
+        self._workflow_id = workflow_id
+
+    def respond_decision_task_completed(self, **kwargs):
+        self._sender._send(self._workflow_id, kwargs)
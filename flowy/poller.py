@@ -1,26 +1,65 @@
+import json
 import logging
 
 from boto.swf.exceptions import SWFResponseError
 
-from flowy.spec import SWFSpecKey, SWFWorkflowSpec
+from flowy.cache import CACHE_MARKER_PREFIX
+from flowy.spec import SWFSpecKey, SWFWorkflowSpec, _fused_decode
+from flowy.task import CANCEL_MARKER_PREFIX, TIMEOUT_REASON_PREFIX
+from flowy.task import SWFFusedActivity, _activity_fail, _activity_timeout
 
 logger = logging.getLogger(__name__)
 
 
 class SWFActivityPoller(object):
-    def __init__(self, domain, task_list, swf_client, identity, task_factory):
+    def __init__(self, domain, task_list, swf_client, identity, task_factory,
+                 responder=None):
         self._domain = domain
         self._identity = identity
         self._task_list = task_list
         self._swf_client = swf_client
         self._task_factory = task_factory
+        # the activities respond through it, a CompletionSender for example
+        self._responder = responder if responder is not None else swf_client
 
     def poll_next_task(self):
-        swf_response = self._poll_response()
-        spec_key, input, token = self._parse_response(swf_response)
+        return self.build_task(*self.poll_next_response())
+
+    def poll_next_response(self):
+        """ The spec key, input and token of the next activity task. """
+        return self._parse_response(self._poll_response())
+
+    def start_to_close(self, spec_key, input=None):
+        """ The start to close timeout of the activity, if known locally.
+
+        A fused task runs for as long as all its steps, the sum travels with
+        its input. The default of the registered activity applies otherwise.
+        """
+        chain, _, timeout = _fused_decode(input)
+        if chain is not None:
+            return timeout
+        start_to_close = getattr(self._task_factory, 'start_to_close', None)
+        if start_to_close is None:
+            return None
+        return start_to_close(spec_key)
+
+    def fail_task(self, token, reason):
+        return _activity_fail(self._responder, token, reason)
+
+    def time_out_task(self, token, reason):
+        """ Fail a task given up on locally, it's retried like a timeout. """
+        return _activity_timeout(self._responder, token, reason)
+
+    def build_task(self, spec_key, input, token):
+        chain, input, _ = _fused_decode(input)
+        if chain is not None:
+            steps = [self._task_factory(key, swf_client=self._responder,
+                                        input=input, token=token)
+                     for key in chain]
+            return SWFFusedActivity(self._responder, input, token, steps)
         return self._task_factory(
             spec_key,
-            swf_client=self._swf_client,
+            swf_client=self._responder,
             input=input,
             token=token
         )
@@ -50,15 +89,19 @@ class SWFActivityPoller(object):
 
 
 class SWFWorkflowPoller(object):
-    def __init__(self, swf_client, task_list, task_factory, spec_factory=SWFWorkflowSpec):
+    def __init__(self, swf_client, task_list, task_factory, spec_factory=SWFWorkflowSpec,
+                 responder=None):
         self._swf_client = swf_client
         self._task_list = task_list
         self._task_factory = task_factory
         self._spec_factory = spec_factory
+        # the decisions are sent through it, a DecisionSender for example
+        self._responder = responder
 
     def poll_next_task(self):
         first_page = self._poll_response_first_page()
         token = _parse_token(first_page)
+        workflow_id = _parse_workflow_id(first_page)
         all_events = self._events(first_page)
         # the first page sometimes contains an empty events list, because
         # of that we can't get the WorkflowExecutionStarted before the
@@ -69,12 +112,19 @@ class SWFWorkflowPoller(object):
         tags = _parse_tags(first_event)
         try:
             p = self._parse_events
-            running, timedout, results, errors, order = p(all_events)
+            (running, timedout, results, errors, order, cancelled,
+             children, signals, markers, fresh) = p(all_events)
         except _PaginationError:
             return self.poll_next_task()
-        return self._task_factory(spec, self._swf_client, input, token,
+        swf_client = self._swf_client
+        if self._responder is not None:
+            swf_client = self._responder.bind(workflow_id)
+        return self._task_factory(spec, swf_client, input, token,
                                   running, timedout, results, errors, order,
-                                  spec, tags)
+                                  spec, tags, cancelled=cancelled,
+                                  children=children, signals=signals,
+                                  markers=markers, workflow_id=workflow_id,
+                                  fresh=fresh)
 
     def _events(self, first_page):
         page = first_page
@@ -101,33 +151,85 @@ class SWFWorkflowPoller(object):
 
     def _parse_events(self, events):
         running, timedout, results, errors, order = set(), set(), {}, {}, []
+        cancelled, children, signals, markers = set(), {}, {}, {}
         event2call = {}
+        fused = {}  # the step call IDs of the fused activities
+        timers = {}  # the call IDs of the shared timers
+        # the place in order of the next cached result of each decision
+        decided = {}
+        # the activity results no decision saw yet
+        fresh = set()
         for e in events:
             e_type = e.get('eventType')
             if e_type == 'ActivityTaskScheduled':
-                id = e['activityTaskScheduledEventAttributes']['activityId']
+                ATSEA = 'activityTaskScheduledEventAttributes'
+                id = e[ATSEA]['activityId']
                 event2call[e['eventId']] = id
-                running.add(id)
+                steps = _control_call_ids(e[ATSEA].get('control'))
+                if steps:
+                    fused[id] = steps
+                running.update(fused.get(id, [id]))
             elif e_type == 'ActivityTaskCompleted':
                 ATCEA = 'activityTaskCompletedEventAttributes'
                 id = event2call[e[ATCEA]['scheduledEventId']]
                 result = e[ATCEA]['result']
+                if id in fused:
+                    steps = fused[id]
+                    running.difference_update(steps)
+                    for step_id, r in zip(steps, json.loads(result)):
+                        results[step_id] = r
+                        order.append(step_id)
+                    continue
                 running.remove(id)
                 results[id] = result
                 order.append(id)
+                fresh.add(id)
             elif e_type == 'ActivityTaskFailed':
                 ATFEA = 'activityTaskFailedEventAttributes'
                 id = event2call[e[ATFEA]['scheduledEventId']]
                 reason = e[ATFEA]['reason']
+                if reason and reason.startswith(TIMEOUT_REASON_PREFIX):
+                    # given up on by the worker in place of SWF
+                    for id in fused.get(id, [id]):
+                        running.remove(id)
+                        timedout.add(id)
+                        order.append(id)
+                    continue
+                if id in fused:
+                    # the details hold the results of the completed steps
+                    steps = fused[id]
+                    running.difference_update(steps)
+                    done = json.loads(e[ATFEA].get('details') or '[]')
+                    for step_id, r in zip(steps, done):
+                        results[step_id] = r
+                        order.append(step_id)
+                    id = steps[min(len(done), len(steps) - 1)]
+                    errors[id] = reason
+                    order.append(id)
+                    continue
                 running.remove(id)
                 errors[id] = reason
                 order.append(id)
             elif e_type == 'ActivityTaskTimedOut':
                 ATTOEA = 'activityTaskTimedOutEventAttributes'
                 id = event2call[e[ATTOEA]['scheduledEventId']]
-                running.remove(id)
-                timedout.add(id)
-                order.append(id)
+                for id in fused.get(id, [id]):
+                    running.remove(id)
+                    timedout.add(id)
+                    order.append(id)
+            elif e_type == 'ActivityTaskCanceled':
+                ATCDEA = 'activityTaskCanceledEventAttributes'
+                id = event2call[e[ATCDEA]['scheduledEventId']]
+                for id in fused.get(id, [id]):
+                    running.remove(id)
+                    cancelled.add(id)
+            elif e_type == 'ActivityTaskCancelRequested':
+                ATCREA = 'activityTaskCancelRequestedEventAttributes'
+                cancelled.add(e[ATCREA]['activityId'])
+            elif e_type == 'RequestCancelActivityTaskFailed':
+                # most likely finished already, don't ask again
+                RCATFEA = 'requestCancelActivityTaskFailedEventAttributes'
+                cancelled.add(e[RCATFEA]['activityId'])
             elif e_type == 'ScheduleActivityTaskFailed':
                 SATFEA = 'scheduleActivityTaskFailedEventAttributes'
                 id = e[SATFEA]['activityId']
@@ -139,6 +241,7 @@ class SWFWorkflowPoller(object):
                 SCWEIEA = 'startChildWorkflowExecutionInitiatedEventAttributes'
                 id = _subworkflow_id(e[SCWEIEA]['workflowId'])
                 running.add(id)
+                children[id] = e[SCWEIEA]['workflowId']
             elif e_type == 'ChildWorkflowExecutionCompleted':
                 CWECEA = 'childWorkflowExecutionCompletedEventAttributes'
                 id = _subworkflow_id(
@@ -165,6 +268,21 @@ class SWFWorkflowPoller(object):
                 running.remove(id)
                 timedout.add(id)
                 order.append(id)
+            elif e_type == 'ChildWorkflowExecutionCanceled':
+                CWECDEA = 'childWorkflowExecutionCanceledEventAttributes'
+                id = _subworkflow_id(
+                    e[CWECDEA]['workflowExecution']['workflowId']
+                )
+                running.remove(id)
+                cancelled.add(id)
+            elif e_type == 'RequestCancelExternalWorkflowExecutionInitiated':
+                RCEWEIEA = ('requestCancelExternalWorkflowExecution'
+                            'InitiatedEventAttributes')
+                cancelled.add(_subworkflow_id(e[RCEWEIEA]['workflowId']))
+            elif e_type == 'RequestCancelExternalWorkflowExecutionFailed':
+                RCEWEFEA = ('requestCancelExternalWorkflowExecution'
+                            'FailedEventAttributes')
+                cancelled.add(_subworkflow_id(e[RCEWEFEA]['workflowId']))
             elif e_type == 'StartChildWorkflowExecutionFailed':
                 SCWEFEA = 'startChildWorkflowExecutionFailedEventAttributes'
                 id = _subworkflow_id(e[SCWEFEA]['workflowId'])
@@ -172,13 +290,63 @@ class SWFWorkflowPoller(object):
                 errors[id] = reason
                 order.append(id)
             elif e_type == 'TimerStarted':
-                id = e['timerStartedEventAttributes']['timerId']
-                running.add(id)
+                TSEA = 'timerStartedEventAttributes'
+                id = e[TSEA]['timerId']
+                calls = _control_call_ids(e[TSEA].get('control'))
+                if calls:
+                    timers[id] = calls
+                running.update(timers.get(id, [id]))
             elif e_type == 'TimerFired':
                 id = e['timerFiredEventAttributes']['timerId']
-                running.remove(id)
-                results[id] = None
-        return running, timedout, results, errors, order
+                for id in timers.get(id, [id]):
+                    running.remove(id)
+                    results[id] = None
+            elif e_type == 'TimerCanceled':
+                id = e['timerCanceledEventAttributes']['timerId']
+                for id in timers.get(id, [id]):
+                    running.remove(id)
+                    cancelled.add(id)
+            elif e_type == 'CancelTimerFailed':
+                cancelled.add(e['cancelTimerFailedEventAttributes']['timerId'])
+            elif e_type == 'WorkflowExecutionSignaled':
+                WESEA = 'workflowExecutionSignaledEventAttributes'
+                name = e[WESEA]['signalName']
+                received = signals.setdefault(name, [])
+                # signals are ordered with the results as (name, index)
+                order.append((name, len(received)))
+                received.append(e[WESEA].get('input'))
+            elif e_type == 'DecisionTaskStarted':
+                decided[e['eventId']] = len(order)
+            elif e_type == 'DecisionTaskCompleted':
+                DTCEA = 'decisionTaskCompletedEventAttributes'
+                started = e[DTCEA]['startedEventId']
+                decided[e['eventId']] = decided.pop(started, None)
+                fresh.clear()
+            elif e_type == 'MarkerRecorded':
+                MREA = 'markerRecordedEventAttributes'
+                name = e[MREA]['markerName']
+                if name.startswith(CACHE_MARKER_PREFIX):
+                    # a cached activity result recorded instead of the task,
+                    # ordered where its decision saw it: before the events
+                    # that arrived while the decision was made
+                    id = name[len(CACHE_MARKER_PREFIX):]
+                    results[id] = e[MREA].get('details')
+                    decision = e[MREA].get('decisionTaskCompletedEventId')
+                    position = decided.get(decision)
+                    if position is None:
+                        order.append(id)
+                    else:
+                        order.insert(position, id)
+                        decided[decision] = position + 1
+                    continue
+                if name.startswith(CANCEL_MARKER_PREFIX):
+                    # a delayed call given up on while its timer was running
+                    cancelled.add(name[len(CANCEL_MARKER_PREFIX):])
+                    continue
+                # the latest checkpoint replaces the previous ones
+                markers[name] = e[MREA].get('details')
+        return (running, timedout, results, errors, order, cancelled,
+                children, signals, markers, fresh)
 
     def _poll_response_first_page(self):
         swf_response = {}
@@ -209,6 +377,10 @@ def _parse_token(page):
     return page['taskToken']
 
 
+def _parse_workflow_id(page):
+    return page['workflowExecution']['workflowId']
+
+
 def _parse_input(event):
     assert event['eventType'] == 'WorkflowExecutionStarted'
     event_attrs = event['workflowExecutionStartedEventAttributes']
@@ -233,6 +405,19 @@ def _parse_tags(event):
     return event_attrs.get('tagList', None)
 
 
+def _control_call_ids(control):
+    # fused activities and shared timers list the call IDs they resolve
+    if not control:
+        return None
+    try:
+        call_ids = json.loads(control)
+    except ValueError:
+        return None
+    if not isinstance(call_ids, list):
+        return None
+    return [str(call_id) for call_id in call_ids]
+
+
 def _subworkflow_id(workflow_id):
     return workflow_id.rsplit('-', 1)[-1]
 
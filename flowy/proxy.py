@@ -1,29 +1,63 @@
-import json
+import math
+import random
 from contextlib import contextmanager
 
+from flowy.codec import decode, encode
+from flowy.serializer import get_serializer, loads
 from flowy.exception import TaskError
-from flowy.result import Error, Placeholder, Result, Timeout
+from flowy.result import Error, LazyResult, Placeholder, Result, Timeout
 from flowy.spec import _sentinel, SWFActivitySpec, SWFWorkflowSpec
+from flowy.spec import SWFFusedActivitySpec
 from flowy.task import serialize_args
 from flowy.util import MagicBind
 
 
-deserialize_result = staticmethod(json.loads)
+@staticmethod
+def deserialize_result(result):
+    return loads(decode(result))
+
+
+class ExponentialBackoff(object):
+    """ A retry schedule for timed-out tasks.
+
+    The n-th retry is preceded by a timer of base * factor ** (n - 1)
+    seconds, capped at max and increased by up to a jitter fraction of it.
+    The jitter is only drawn when the timer is scheduled, so replaying the
+    history stays deterministic.
+    """
+    def __init__(self, base=1, factor=2, max=None, jitter=0):
+        self._base = base
+        self._factor = factor
+        self._max = max
+        self._jitter = jitter
+
+    def delay(self, retry):
+        delay = self._base * self._factor ** (retry - 1)
+        if self._max is not None:
+            delay = min(delay, self._max)
+        if self._jitter:
+            delay += delay * self._jitter * random.random()
+        return max(int(math.ceil(delay)), 1)
 
 
 class TaskProxy(object):
 
     Error = Error
+    LazyResult = LazyResult
     Placeholder = Placeholder
     Result = Result
     Timeout = Timeout
 
     timeout_message = "A task has timed-out"
 
-    def __init__(self, retry=3, delay=0, error_handling=False):
+    def __init__(self, retry=3, delay=0, error_handling=False, backoff=None,
+                 compression=None, serializer=None):
         self._retry = retry
         self._delay = delay
         self._error_handling = error_handling
+        self._backoff = backoff
+        self._compression = compression
+        self._serializer = serializer
 
     def __get__(self, obj, objtype):
         if obj is None:
@@ -32,34 +66,59 @@ class TaskProxy(object):
 
     @contextmanager
     def options(self, retry=_sentinel, delay=_sentinel,
-                error_handling=_sentinel):
+                error_handling=_sentinel, backoff=_sentinel,
+                compression=_sentinel, serializer=_sentinel):
         old_retry = self._retry
         old_delay = self._delay
         old_error_handling = self._error_handling
+        old_backoff = self._backoff
+        old_compression = self._compression
+        old_serializer = self._serializer
         if retry is not _sentinel:
             self._retry = retry
         if delay is not _sentinel:
             self._delay = delay
         if error_handling is not _sentinel:
             self._error_handling = error_handling
+        if backoff is not _sentinel:
+            self._backoff = backoff
+        if compression is not _sentinel:
+            self._compression = compression
+        if serializer is not _sentinel:
+            self._serializer = serializer
         yield
         self._retry = old_retry
         self._delay = old_delay
         self._error_handling = old_error_handling
+        self._backoff = old_backoff
+        self._compression = old_compression
+        self._serializer = old_serializer
 
     def __call__(self, task, *args, **kwargs):
         result = self._args_based_result(task, args, kwargs)
         if result is not None:
-            task._reserve_call_ids(task._call_id, self._delay, self._retry)
+            self._reserve_call_ids(task)
             return result
-        args, kwargs = self._extract_results(args, kwargs)
-        # there is no error handling for argument/result transport
-        # we want those to bubble up in the workflow and stop it
-        input = self._serialize_arguments(*args, **kwargs)
+
+        def input():
+            # only called if the task is scheduled or its result cached, the
+            # calls already finished aren't serialized again on every replay
+            a, k = self._extract_results(args, kwargs)
+            # there is no error handling for argument/result transport
+            # we want those to bubble up in the workflow and stop it
+            if self._serializer is not None:
+                data = get_serializer(self._serializer).dumps([a, k])
+            else:
+                data = self._serialize_arguments(*a, **k)
+            return encode(data, self._compression)
+
         state, value, order = self._schedule(task, input)
         if state == task._FOUND:
-            return self.Result(self._deserialize_result(value), order)
+            # folded results don't need to be deserialized on every replay
+            return self.LazyResult(value, order, self._deserialize_result)
         elif state == task._RUNNING:
+            return self.Placeholder(task._in_flight)
+        elif state == task._CANCELLED:
             return self.Placeholder()
         elif state == task._ERROR:
             if self._error_handling:
@@ -87,6 +146,14 @@ class TaskProxy(object):
         if self._deps_in_args(args):
             return self.Placeholder()
 
+    def _reserve_call_ids(self, task):
+        task._reserve_call_ids(task._call_id, self._delay, self._retry,
+                               backoff=self._backoff)
+
+    def _result_call_ids(self, task):
+        return task._result_call_ids(task._call_id, self._delay, self._retry,
+                                     backoff=self._backoff)
+
     def _deps_in_args(self, args):
         return any(isinstance(r, Placeholder) for r in args)
 
@@ -111,50 +178,193 @@ class TaskProxy(object):
 
 
 class SWFActivityProxy(TaskProxy):
+    """ Proxy for scheduling an activity.
+
+    With hedge_after set, if the activity didn't complete after that many
+    seconds a duplicate attempt is scheduled and the first one to complete
+    wins; the other one is cancelled unless hedge_cancel is False.
+    """
     def __init__(self, name, version, task_list=None, heartbeat=None,
                  schedule_to_close=None, schedule_to_start=None,
-                 start_to_close=None, retry=3, delay=0, error_handling=False):
+                 start_to_close=None, retry=3, delay=0, error_handling=False,
+                 hedge_after=None, hedge_cancel=True, backoff=None,
+                 compression=None, serializer=None):
         self._spec = SWFActivitySpec(name, version, task_list, heartbeat,
                                      schedule_to_close, schedule_to_start,
                                      start_to_close)
+        self._hedge_after = hedge_after
+        self._hedge_cancel = hedge_cancel
         self.timeout_message = "Activity %s has timed-out" % self._spec
-        super(SWFActivityProxy, self).__init__(retry, delay, error_handling)
+        super(SWFActivityProxy, self).__init__(retry, delay, error_handling,
+                                               backoff, compression,
+                                               serializer)
 
     @contextmanager
     def options(self, task_list=_sentinel, heartbeat=_sentinel,
                 schedule_to_close=_sentinel, schedule_to_start=_sentinel,
                 start_to_close=_sentinel, retry=_sentinel, delay=_sentinel,
-                error_handling=_sentinel):
+                error_handling=_sentinel, hedge_after=_sentinel,
+                hedge_cancel=_sentinel, backoff=_sentinel,
+                compression=_sentinel, serializer=_sentinel):
+        old_hedge_after = self._hedge_after
+        old_hedge_cancel = self._hedge_cancel
+        if hedge_after is not _sentinel:
+            self._hedge_after = hedge_after
+        if hedge_cancel is not _sentinel:
+            self._hedge_cancel = hedge_cancel
         with self._spec.options(task_list, heartbeat, schedule_to_close,
                                 schedule_to_start, start_to_close):
             with super(SWFActivityProxy, self).options(retry, delay,
-                                                       error_handling):
+                                                       error_handling,
+                                                       backoff, compression,
+                                                       serializer):
                 yield
+        self._hedge_after = old_hedge_after
+        self._hedge_cancel = old_hedge_cancel
 
     def _schedule(self, task, input):
         return task.schedule_activity(self._spec, input, self._retry,
-                                      self._delay)
+                                      self._delay, self._hedge_after,
+                                      self._hedge_cancel, self._backoff)
+
+    def _reserve_call_ids(self, task):
+        task._reserve_call_ids(task._call_id, self._delay, self._retry,
+                               hedge=bool(self._hedge_after),
+                               backoff=self._backoff)
+
+    def _result_call_ids(self, task):
+        return task._result_call_ids(task._call_id, self._delay, self._retry,
+                                     hedge=bool(self._hedge_after),
+                                     backoff=self._backoff)
+
+
+class SWFFusedActivityProxy(TaskProxy):
+    """ Calls a chain of activities, each step getting the result of the
+    previous one, as a single activity task run by one worker.
+
+    This saves a schedule/poll/complete cycle and a decision for every extra
+    step. The activities must share the task list. The timers of the fused
+    task are computed from the timers of the steps.
+
+        class Pipeline(Workflow):
+            parse = SWFActivityProxy('Parse', 1, task_list='l')
+            store = SWFActivityProxy('Store', 1, task_list='l')
+            parse_and_store = SWFFusedActivityProxy([parse, store])
+
+            def run(self, doc):
+                return self.parse_and_store(doc)  # same as store(parse(doc))
+
+    """
+    def __init__(self, proxies, retry=3, delay=0, error_handling=False,
+                 backoff=None, compression=None, serializer=None):
+        self._spec = SWFFusedActivitySpec(p._spec for p in proxies)
+        self.timeout_message = "Activity %s has timed-out" % self._spec
+        super(SWFFusedActivityProxy, self).__init__(retry, delay,
+                                                    error_handling, backoff,
+                                                    compression, serializer)
+
+    def _schedule(self, task, input):
+        return task.schedule_fused(self._spec, input, self._retry,
+                                   self._delay, self._backoff)
+
+    def _reserve_call_ids(self, task):
+        task._reserve_call_ids(task._call_id, self._delay, self._retry,
+                               len(self._spec), backoff=self._backoff)
+
+    def _result_call_ids(self, task):
+        return task._result_call_ids(task._call_id, self._delay, self._retry,
+                                     len(self._spec), backoff=self._backoff)
 
 
 class SWFWorkflowProxy(TaskProxy):
     def __init__(self, name, version, task_list=None, decision_duration=None,
                  workflow_duration=None, retry=3, delay=0,
-                 error_handling=False):
+                 error_handling=False, backoff=None, compression=None,
+                 serializer=None):
         self._spec = SWFWorkflowSpec(name, version, task_list,
                                      decision_duration, workflow_duration)
         self.timeout_message = "Workflow %s has timed-out" % self._spec
-        super(SWFWorkflowProxy, self).__init__(retry, delay, error_handling)
+        super(SWFWorkflowProxy, self).__init__(retry, delay, error_handling,
+                                               backoff, compression,
+                                               serializer)
 
     @contextmanager
     def options(self, task_list=_sentinel, decision_duration=_sentinel,
                 workflow_duration=_sentinel, retry=_sentinel, delay=_sentinel,
-                error_handling=_sentinel):
+                error_handling=_sentinel, backoff=_sentinel,
+                compression=_sentinel, serializer=_sentinel):
         with self._spec.options(task_list, decision_duration,
                                 workflow_duration):
             with super(SWFWorkflowProxy, self).options(retry, delay,
-                                                       error_handling):
+                                                       error_handling,
+                                                       backoff, compression,
+                                                       serializer):
                 yield
 
     def _schedule(self, task, input):
         return task.schedule_workflow(self._spec, input, self._retry,
-                                      self._delay)
+                                      self._delay, self._backoff)
+
+
+class SWFPartitionProxy(SWFWorkflowProxy):
+    """ Maps an index range over a tree of child workflows.
+
+    The [start, stop) range is split in up to width slices, each one run by
+    a child workflow that splits it again until the slices have at most
+    leaf_size indexes. The results of the children are combined with
+    reduce, a function taking the list of results in range order (the list
+    is returned as is if it's missing). The children get deterministic IDs
+    derived from the ID of their parent.
+
+    The workflow must be a SWFPartitionedWorkflow using this same proxy as
+    its partition attribute. Only the range bounds are sent to the children,
+    the leaves should map the indexes to the actual items themselves.
+
+        @swf_workflow(version=1)
+        class SumSquares(SWFPartitionedWorkflow):
+            partition = SWFPartitionProxy('SumSquares', 1, width=10,
+                                          leaf_size=100, reduce=sum)
+            square = SWFActivityProxy('Square', 1)
+
+            def run_leaf(self, start, stop):
+                squares = [self.square(i) for i in range(start, stop)]
+                return self.accumulate('sum', operator.add, 0, *squares)
+
+    """
+    def __init__(self, name, version, width=10, leaf_size=100, reduce=None,
+                 task_list=None, decision_duration=None,
+                 workflow_duration=None, retry=3, delay=0,
+                 error_handling=False, backoff=None, compression=None,
+                 serializer=None):
+        if width < 2:
+            raise ValueError('The partition width must be at least 2.')
+        self._width = width
+        self._leaf_size = leaf_size
+        self._reduce = reduce
+        super(SWFPartitionProxy, self).__init__(
+            name, version, task_list, decision_duration, workflow_duration,
+            retry, delay, error_handling, backoff, compression, serializer)
+
+    def __call__(self, task, start, stop):
+        call = super(SWFPartitionProxy, self).__call__
+        results = [call(task, s, e) for s, e in self._slices(start, stop)]
+        errs = [r for r in results if isinstance(r, (Error, Timeout))]
+        if errs:
+            return min(errs)
+        if any(isinstance(r, Placeholder) for r in results):
+            return self.Placeholder()
+        value = [r.result() for r in results]
+        if self._reduce is not None:
+            value = self._reduce(value)
+        return self.Result(value, max(r._order for r in results))
+
+    def _slices(self, start, stop):
+        if stop - start <= self._leaf_size:
+            return [(start, stop)]
+        size = int(math.ceil(float(stop - start) / self._width))
+        return [(s, min(s + size, stop)) for s in range(start, stop, size)]
+
+    def _schedule(self, task, input):
+        return task.schedule_workflow(self._spec, input, self._retry,
+                                      self._delay, self._backoff,
+                                      deterministic_id=True)
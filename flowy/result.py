@@ -15,6 +15,12 @@ class _Sortable(object):
 
 
 class Placeholder(_Sortable):
+    def __init__(self, calls=()):
+        # the in-flight pieces of the call this placeholder waits for, the
+        # ones to cancel, as (call_id, kind): an attempt, a timer or both
+        # attempts and the timer of a hedged call
+        self._calls = tuple(calls)
+
     def result(self):
         raise SuspendTask()
 
@@ -44,3 +50,17 @@ class Result(_Sortable):
 
     def result(self):
         return self._result
+
+
+class LazyResult(Result):
+    """ A result deserialized only when its value is first needed. """
+    def __init__(self, result, order, deserialize):
+        self._serialized = result
+        self._deserialize = deserialize
+        self._order = order
+
+    def result(self):
+        if self._deserialize is not None:
+            self._result = self._deserialize(self._serialized)
+            self._deserialize = self._serialized = None
+        return self._result
@@ -1,7 +1,11 @@
+import os
 import sys
 import logging
+import threading
 
 import venusian
+from .cache import set_cacheable
+from .limits import set_limits
 from .spec import SWFActivitySpec, SWFWorkflowSpec
 
 
@@ -10,16 +14,27 @@ logger = logging.getLogger(__name__)
 
 def swf_activity(version, task_list=None, heartbeat=None,
                  schedule_to_close=None, schedule_to_start=None,
-                 start_to_close=None, name=None):
+                 start_to_close=None, name=None, cacheable=False, ttl=None,
+                 pooled=False, concurrency=None, rate=None, burst=None,
+                 cpu=None, memory=None):
 
     def wrapper(activity_factory):
+        if cacheable:
+            # known as soon as it's imported, deciders don't scan activities
+            set_cacheable(name or activity_factory.__name__, version, ttl)
+        if any(x is not None for x in (concurrency, rate, cpu, memory)):
+            set_limits(name or activity_factory.__name__, version,
+                       concurrency, rate, burst, cpu, memory)
         def callback(scanner, f_name, ob):
             if name is not None:
                 f_name = name
             activity_spec = SWFActivitySpec(
                 f_name, version, task_list, heartbeat, schedule_to_close,
                 schedule_to_start, start_to_close)
-            scanner.registry.add(activity_spec, activity_factory)
+            factory = activity_factory
+            if pooled:
+                factory = InstancePool(activity_factory)
+            scanner.registry.add(activity_spec, factory)
         venusian.attach(activity_factory, callback, category='activity')
         return activity_factory
     return wrapper
@@ -44,9 +59,23 @@ def swf_workflow(version, task_list=None, workflow_duration=None,
 class TaskRegistry(object):
     def __init__(self):
         self._registry = {}
+        self._specs = {}
 
     def add(self, spec, factory):
         self._registry[spec] = factory
+        self._specs[spec] = spec
+
+    def start_to_close(self, spec_key):
+        """ The start to close timeout of a registered spec, if it has one.
+        """
+        spec = self._specs.get(spec_key)
+        timeout = getattr(spec, '_start_to_close', None)
+        if timeout is None:
+            return None
+        return int(timeout)
+
+    def spec_keys(self):
+        return [spec._key for spec in self._specs]
 
     def __call__(self, spec, *args, **kwargs):
         try:
@@ -56,6 +85,69 @@ class TaskRegistry(object):
             return lambda: None
         return fact(*args, **kwargs)
 
+    def setup(self):
+        """ Warm up the pooled activities in this process and thread. """
+        for factory in self._pools():
+            factory.setup()
+
+    def teardown(self):
+        for factory in self._pools():
+            factory.teardown()
+
+    def _pools(self):
+        return [f for f in self._registry.values()
+                if isinstance(f, InstancePool)]
+
+
+class InstancePool(object):
+    """ Reuses one instance of an activity class per process and thread.
+
+    An instance is created without calling __init__ and its setup() method,
+    if any, is called once, when the worker starts or on the first task. For
+    every task __init__ is called again on the pooled instance with the task
+    arguments, so the expensive state belongs in setup(). The teardown()
+    methods are called when the worker stops.
+    """
+    def __init__(self, factory):
+        self._factory = factory
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._instances = []  # (pid, instance)
+        self._generation = 0  # the instances torn down are not reused
+
+    def __call__(self, *args, **kwargs):
+        instance = self.setup()
+        instance.__init__(*args, **kwargs)
+        return instance
+
+    def setup(self):
+        # the instances of the parent are not reused after a fork
+        key = os.getpid(), self._generation
+        if getattr(self._local, 'key', None) == key:
+            return self._local.instance
+        instance = self._factory.__new__(self._factory)
+        if hasattr(instance, 'setup'):
+            instance.setup()
+        self._local.key, self._local.instance = key, instance
+        with self._lock:
+            self._instances.append((key[0], instance))
+        return instance
+
+    def teardown(self):
+        pid = os.getpid()
+        with self._lock:
+            instances = [i for p, i in self._instances if p == pid]
+            self._instances = [(p, i) for p, i in self._instances
+                               if p != pid]
+            self._generation += 1
+        for instance in instances:
+            if hasattr(instance, 'teardown'):
+                try:
+                    instance.teardown()
+                except Exception:
+                    logger.exception('Error while tearing down %r:',
+                                     instance)
+
 
 class SWFTaskRegistry(TaskRegistry):
     def register_remote(self, swf_client):
@@ -88,6 +180,18 @@ class Scanner(object):
     def __call__(self, *args, **kwargs):
         return self._registry(*args, **kwargs)
 
+    def setup(self):
+        self._registry.setup()
+
+    def teardown(self):
+        self._registry.teardown()
+
+    def start_to_close(self, spec_key):
+        return self._registry.start_to_close(spec_key)
+
+    def spec_keys(self):
+        return self._registry.spec_keys()
+
 
 class SWFScanner(Scanner):
     def __init__(self, registry=None):
@@ -0,0 +1,304 @@
+""" Semaphores and rate limits shared by all the workers of a fleet.
+
+The activities list them in their semaphores setting. They are acquired
+before run is called and released once it returns:
+
+    set_semaphore_store(RedisSemaphoreStore(url='redis://limits:6379/0'))
+
+    class Charge(SWFActivity):
+        semaphores = [Semaphore('partner', 10, lease=60),
+                      RateLimit('partner', rate=50, burst=10)]
+
+A semaphore is held with a lease that expires unless renewed, so the slots
+of the crashed workers are freed. The leases are renewed by the heartbeats
+of the activity, which must heartbeat more often than the lease expires.
+While a task waits for its semaphores it heartbeats as well. A task that
+can't acquire them in time, or while the store is unreachable, is failed as
+timed out and retried by the decider.
+
+SQLiteSemaphoreStore works for the workers of a single host.
+"""
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+_semaphore_store = None
+
+
+def set_semaphore_store(store):
+    global _semaphore_store
+    _semaphore_store = store
+
+
+def _store(store):
+    if store is not None:
+        return store
+    if _semaphore_store is None:
+        raise RuntimeError('No semaphore store is set.')
+    return _semaphore_store
+
+
+def new_holder():
+    return uuid.uuid4().hex
+
+
+class Semaphore(object):
+    """ At most limit holders at once, each holding a lease of lease seconds.
+    """
+    def __init__(self, name, limit, lease=60, poll=1, store=None):
+        self.name = name
+        self._limit = limit
+        self._lease = lease
+        self._poll = poll
+        self._store = store
+
+    def acquire(self, holder):
+        """ 0 if acquired, otherwise the seconds to wait before retrying. """
+        store = _store(self._store)
+        if store.acquire(self.name, holder, self._limit, self._lease):
+            return 0
+        return self._poll
+
+    def renew(self, holder):
+        return _store(self._store).renew(self.name, holder, self._lease)
+
+    def release(self, holder):
+        _store(self._store).release(self.name, holder)
+
+    def __repr__(self):
+        klass = self.__class__.__name__
+        return '%s(%r, %r, lease=%r)' % (klass, self.name, self._limit,
+                                         self._lease)
+
+
+class RateLimit(object):
+    """ A token bucket of rate tokens per second, holding up to burst. """
+    def __init__(self, name, rate, burst=None, store=None):
+        self.name = name
+        self._rate = float(rate)
+        self._burst = max(1, burst or 1)
+        self._store = store
+
+    def acquire(self, holder):
+        return _store(self._store).take(self.name, self._rate, self._burst)
+
+    def renew(self, holder):
+        return True
+
+    def release(self, holder):
+        pass
+
+    def __repr__(self):
+        klass = self.__class__.__name__
+        return '%s(%r, rate=%r, burst=%r)' % (klass, self.name, self._rate,
+                                              self._burst)
+
+
+def acquire_all(guards, holder, heartbeat=None, timeout=None, interval=1):
+    """ Wait for all the semaphores and rate limits, in a global order.
+
+    Returns the ones acquired, None if they couldn't be acquired in timeout
+    seconds. While waiting, the leases already acquired are renewed and
+    heartbeat is called at least every interval seconds.
+    """
+    # the semaphores first, so no token is wasted waiting for them
+    guards = sorted(guards, key=lambda g: (isinstance(g, RateLimit), g.name))
+    deadline = None if timeout is None else time.time() + timeout
+    acquired = []
+    try:
+        for guard in guards:
+            while 1:
+                delay = guard.acquire(holder)
+                if not delay:
+                    acquired.append(guard)
+                    break
+                if deadline is not None and time.time() + delay > deadline:
+                    release_all(acquired, holder)
+                    return None
+                renew_all(acquired, holder)
+                if heartbeat is not None:
+                    heartbeat()
+                time.sleep(min(delay, interval))
+    except Exception:
+        # don't keep the slots until the leases expire
+        try:
+            release_all(acquired, holder)
+        except Exception:
+            pass
+        raise
+    return acquired
+
+
+def renew_all(guards, holder):
+    return all([guard.renew(holder) for guard in guards])
+
+
+def release_all(guards, holder):
+    for guard in guards:
+        guard.release(holder)
+
+
+class SQLiteSemaphoreStore(object):
+    """ The semaphores in a local SQLite database, for a single host. """
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        with self._transaction() as c:
+            c.execute('CREATE TABLE IF NOT EXISTS leases ('
+                      'name TEXT, holder TEXT, expires REAL, '
+                      'PRIMARY KEY (name, holder))')
+            c.execute('CREATE TABLE IF NOT EXISTS buckets ('
+                      'name TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+
+    def acquire(self, name, holder, limit, lease):
+        now = time.time()
+        with self._transaction() as c:
+            c.execute('DELETE FROM leases WHERE name = ? AND expires < ?',
+                      (name, now))
+            held, = c.execute('SELECT COUNT(*) FROM leases WHERE name = ? '
+                              'AND holder != ?', (name, holder)).fetchone()
+            if held >= limit:
+                return False
+            c.execute('INSERT OR REPLACE INTO leases VALUES (?, ?, ?)',
+                      (name, holder, now + lease))
+        return True
+
+    def renew(self, name, holder, lease):
+        now = time.time()
+        with self._transaction() as c:
+            cursor = c.execute('UPDATE leases SET expires = ? WHERE name = ? '
+                               'AND holder = ? AND expires >= ?',
+                               (now + lease, name, holder, now))
+            return cursor.rowcount == 1
+
+    def release(self, name, holder):
+        with self._transaction() as c:
+            c.execute('DELETE FROM leases WHERE name = ? AND holder = ?',
+                      (name, holder))
+
+    def take(self, name, rate, burst):
+        now = time.time()
+        with self._transaction() as c:
+            row = c.execute('SELECT tokens, updated FROM buckets '
+                            'WHERE name = ?', (name,)).fetchone()
+            tokens, updated = row if row is not None else (burst, now)
+            tokens = min(burst, tokens + max(0, now - updated) * rate)
+            delay = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                delay = (1 - tokens) / rate
+            c.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)',
+                      (name, tokens, now))
+        return delay
+
+    def _transaction(self):
+        # sqlite connections can't be shared between threads or processes
+        pid, connection = getattr(self._local, 'connection', (None, None))
+        if pid != os.getpid():
+            connection = sqlite3.connect(self._path, timeout=30,
+                                         isolation_level=None)
+            self._local.connection = os.getpid(), connection
+        return _Transaction(connection)
+
+
+class _Transaction(object):
+    # lock the database for writing from the start, so the reads and the
+    # writes of a call are atomic across processes
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __enter__(self):
+        self._connection.execute('BEGIN IMMEDIATE')
+        return self._connection
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self._connection.execute('COMMIT')
+        else:
+            self._connection.execute('ROLLBACK')
+
+
+_ACQUIRE = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if not redis.call('ZSCORE', KEYS[1], ARGV[1])
+        and redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[1])
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[3])))
+return 1
+"""
+
+_RENEW = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local expires = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not expires or tonumber(expires) < now then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[1])
+if redis.call('TTL', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[2])))
+end
+return 1
+"""
+
+# returns the delay in microseconds, Lua numbers are truncated to integers
+_TAKE = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local delay = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    delay = math.ceil((1 - tokens) / rate * 1000000)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens),
+           'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return delay
+"""
+
+
+class RedisSemaphoreStore(object):
+    """ The semaphores in Redis, or any server speaking its protocol.
+
+    The leases expire by the clock of the server, so the clocks of the
+    workers don't matter. Requires Redis 5 or newer for the scripts.
+    """
+    def __init__(self, client=None, url='redis://localhost:6379/0',
+                 prefix='flowy.semaphore.'):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self._client = client
+        self._prefix = prefix
+        self._acquire = client.register_script(_ACQUIRE)
+        self._renew = client.register_script(_RENEW)
+        self._take = client.register_script(_TAKE)
+
+    def acquire(self, name, holder, limit, lease):
+        key = self._prefix + name
+        return bool(self._acquire(keys=[key], args=[holder, limit, lease]))
+
+    def renew(self, name, holder, lease):
+        key = self._prefix + name
+        return bool(self._renew(keys=[key], args=[holder, lease]))
+
+    def release(self, name, holder):
+        self._client.zrem(self._prefix + name, holder)
+
+    def take(self, name, rate, burst):
+        key = self._prefix + 'rate.' + name
+        return self._take(keys=[key], args=[rate, burst]) / 1000000.0
@@ -0,0 +1,192 @@
+""" Serializers for the task arguments and results.
+
+JSON stays the default and its payloads are sent as they are, the other
+serializers wrap theirs in a '@<tag>:' envelope so any reader knows how to
+load them. A serializer can be chosen, by name or as an object, per proxy
+and per task class with their serializer setting:
+
+    score = SWFActivityProxy('Score', 1, serializer='msgpack')
+
+NumPy arrays are best sent with a NumpySerializer, registered as 'numpy'.
+
+Pickle runs arbitrary code when loading so it's not registered by default,
+only trusted setups should call register_serializer(PickleSerializer()).
+"""
+import base64
+import json
+import pickle
+
+from flowy.blob import BROADCAST_KEY, offload_buffer, resolve_broadcast
+from flowy.blob import restore_buffer
+from flowy.codec import compress_bytes, decompress_bytes
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+_NDARRAY_KEY = '@ndarray'
+
+_serializers = {}
+
+
+def register_serializer(serializer):
+    _serializers[serializer.tag] = serializer
+
+
+def get_serializer(serializer):
+    if not isinstance(serializer, str):
+        return serializer
+    try:
+        return _serializers[serializer]
+    except KeyError:
+        raise ValueError('Serializer %r is not registered.' % serializer)
+
+
+def loads(data):
+    if data is None or not data.startswith('@'):
+        return _json_loads(data)
+    tag, sep, payload = data[1:].partition(':')
+    if not sep:
+        raise ValueError('Invalid payload envelope.')
+    return get_serializer(tag).loads(payload)
+
+
+def _json_loads(data):
+    return json.loads(data, object_hook=resolve_broadcast)
+
+
+def _envelope(tag, data):
+    return '@%s:%s' % (tag, base64.b64encode(data).decode('ascii'))
+
+
+class JSONSerializer(object):
+    tag = 'json'
+
+    def dumps(self, value):
+        return json.dumps(value)
+
+    def loads(self, data):
+        return _json_loads(data)
+
+
+class OrJSONSerializer(object):
+    """ Faster JSON, in an envelope so only its payloads are read by orjson.
+
+    orjson is stricter than json: it rejects NaN, Infinity and the integers
+    over 64 bits, so the untagged payloads are always read by json.
+    """
+    tag = 'orjson'
+
+    def dumps(self, value):
+        try:
+            data = orjson.dumps(value).decode('utf-8')
+        except orjson.JSONEncodeError as e:
+            raise TypeError(str(e))
+        return '@%s:%s' % (self.tag, data)
+
+    def loads(self, data):
+        # orjson has no object hook, the handles are only resolved when present
+        if BROADCAST_KEY in data:
+            return _json_loads(data)
+        return orjson.loads(data)
+
+
+class MsgpackSerializer(object):
+    tag = 'msgpack'
+
+    def dumps(self, value):
+        return _envelope(self.tag, msgpack.packb(value, use_bin_type=True))
+
+    def loads(self, data):
+        return msgpack.unpackb(base64.b64decode(data), raw=False,
+                               object_hook=resolve_broadcast)
+
+
+class PickleSerializer(object):
+    tag = 'pickle'
+
+    def dumps(self, value):
+        return _envelope(self.tag, pickle.dumps(value, protocol=2))
+
+    def loads(self, data):
+        return pickle.loads(base64.b64decode(data))
+
+
+class NumpySerializer(object):
+    """ JSON with the arrays sent as their raw buffer instead of lists.
+
+    An array is encoded as its dtype, shape and base85 (base64 on Python 2)
+    buffer, compressed with codec if set. The buffers larger than the blob
+    store threshold are offloaded as they are and memory-mapped back from a
+    LocalBlobStore. The decoded arrays are read-only views over the buffers,
+    copy them to modify them.
+    """
+    tag = 'numpy'
+
+    def __init__(self, codec=None, level=None):
+        self._codec = codec
+        self._level = level
+
+    def dumps(self, value):
+        return '@%s:%s' % (self.tag, json.dumps(value, default=self._default))
+
+    def loads(self, data):
+        return json.loads(data, object_hook=self._object_hook)
+
+    def _default(self, value):
+        if isinstance(value, numpy.generic):
+            return value.item()
+        if not isinstance(value, numpy.ndarray):
+            raise TypeError('%r is not JSON serializable' % (value,))
+        if value.dtype.hasobject:
+            raise TypeError('Arrays of objects are not serializable.')
+        array = numpy.ascontiguousarray(value)
+        buf = array.tobytes()
+        encoded = {'dtype': array.dtype.str, 'shape': list(array.shape)}
+        if self._codec is not None:
+            buf = compress_bytes(self._codec, buf, self._level)
+            encoded['codec'] = self._codec
+        key = offload_buffer(buf)
+        if key is not None:
+            encoded['blob'] = key
+        elif hasattr(base64, 'b85encode'):
+            encoded['b85'] = base64.b85encode(buf).decode('ascii')
+        else:  # pragma: no cover
+            encoded['b64'] = base64.b64encode(buf).decode('ascii')
+        return {_NDARRAY_KEY: encoded}
+
+    def _object_hook(self, obj):
+        if len(obj) != 1 or _NDARRAY_KEY not in obj:
+            return resolve_broadcast(obj)
+        encoded = obj[_NDARRAY_KEY]
+        if 'blob' in encoded:
+            buf = restore_buffer(encoded['blob'])
+        elif 'b85' in encoded:
+            buf = base64.b85decode(encoded['b85'])
+        else:
+            buf = base64.b64decode(encoded['b64'])
+        if 'codec' in encoded:
+            buf = decompress_bytes(encoded['codec'], buf)
+        array = numpy.frombuffer(buf, dtype=numpy.dtype(encoded['dtype']))
+        return array.reshape(encoded['shape'])
+
+
+register_serializer(JSONSerializer())
+if orjson is not None:
+    register_serializer(OrJSONSerializer())
+if msgpack is not None:
+    register_serializer(MsgpackSerializer())
+if numpy is not None:
+    register_serializer(NumpySerializer())
@@ -1,3 +1,4 @@
+import json
 import logging
 from collections import namedtuple
 from contextlib import contextmanager
@@ -146,6 +147,62 @@ class SWFActivitySpec(object):
                     self._schedule_to_start, self._start_to_close)
 
 
+class SWFFusedActivitySpec(object):
+    """ A chain of activities scheduled as a single activity task.
+
+    The task is scheduled under the type of the first activity and carries the
+    whole chain in its input, so the worker can run the steps in sequence. The
+    call IDs of the steps travel in the control field to let the decider
+    expose each step result on its own.
+    """
+    def __init__(self, specs):
+        specs = list(specs)
+        if len(specs) < 2:
+            raise ValueError('A fused chain needs at least two activities')
+        self._specs = specs
+
+    def __len__(self):
+        return len(self._specs)
+
+    def schedule(self, swf_decisions, call_id, input):
+        first = self._specs[0]
+        task_list = _str_or_none(first._task_list)
+        if any(_str_or_none(s._task_list) != task_list for s in self._specs):
+            raise ValueError('Fused activities must share the task list')
+        heartbeat, schedule_to_close, schedule_to_start, start_to_close = (
+            self._timers_encode())
+        steps = [int(call_id) + i for i in range(len(self._specs))]
+        swf_decisions.schedule_activity_task(
+            str(call_id), str(first._name), str(first._version),
+            heartbeat_timeout=heartbeat,
+            schedule_to_close_timeout=schedule_to_close,
+            schedule_to_start_timeout=schedule_to_start,
+            start_to_close_timeout=start_to_close,
+            task_list=task_list,
+            control=json.dumps(steps),
+            input=_fused_encode([s._key for s in self._specs], input,
+                                start_to_close))
+
+    def _timers_encode(self):
+        # the whole chain runs in one task, its timers must cover every step
+        first, rest = self._specs[0], self._specs[1:]
+        start_to_close = _sum_or_none(s._start_to_close for s in self._specs)
+        schedule_to_close = _sum_or_none(
+            [first._schedule_to_close] + [s._start_to_close for s in rest])
+        heartbeat = None
+        if all(s._heartbeat is not None for s in self._specs):
+            heartbeat = max(s._heartbeat for s in self._specs)
+        return (
+            _timer_encode(heartbeat, 'heartbeat'),
+            _timer_encode(schedule_to_close, 'schedule_to_close'),
+            _timer_encode(first._schedule_to_start, 'schedule_to_start'),
+            _timer_encode(start_to_close, 'start_to_close'))
+
+    def __repr__(self):
+        klass = self.__class__.__name__
+        return "%s(specs=%r)" % (klass, self._specs)
+
+
 @total_ordering
 class SWFWorkflowSpec(object):
     def __init__(self, name, version, task_list=None, decision_duration=None,
@@ -171,6 +228,16 @@ class SWFWorkflowSpec(object):
             return None
         return r['runId']
 
+    def signal(self, swf_client, workflow_id, name, input, run_id=None):
+        try:
+            swf_client.signal_workflow_execution(
+                str(name), str(workflow_id), input=str(input),
+                run_id=_str_or_none(run_id))
+        except SWFResponseError:
+            logger.exception('Error while signaling the workflow:')
+            return False
+        return True
+
     def restart(self, swf_decisions, input, tags=None):
         decision_duration, workflow_duration = self._timers_encode()
         # BOTO has a bug in this call when setting the decision_duration
@@ -292,6 +359,39 @@ def _timer_encode(val, name):
     return str(val)
 
 
+def _sum_or_none(vals):
+    vals = list(vals)
+    if any(val is None for val in vals):
+        return None
+    return sum(int(val) for val in vals)
+
+
+def _fused_encode(chain, input, start_to_close=None):
+    # SWF doesn't hand the timeouts over with the task, the sum of the steps
+    # is known only when scheduling
+    envelope = {'fused': [list(key) for key in chain], 'input': input}
+    if start_to_close is not None:
+        envelope['start_to_close'] = int(start_to_close)
+    return json.dumps(envelope)
+
+
+def _fused_decode(input):
+    """ Split a fused task input into its chain of spec keys, the input of
+    the first step and the start to close timeout of the chain. Regular
+    inputs are always JSON lists or tagged payloads so they are returned
+    untouched, with no chain.
+    """
+    if not input or not input.startswith('{'):
+        return None, input, None
+    try:
+        envelope = json.loads(input)
+        chain = [SWFSpecKey(name, version)
+                 for name, version in envelope['fused']]
+        return chain, envelope['input'], envelope.get('start_to_close')
+    except (ValueError, KeyError, TypeError):
+        return None, input, None
+
+
 def _tags_encode(tags):
     if tags is not None:
         # make it deterministic for tests
@@ -5,16 +5,32 @@ from contextlib import contextmanager
 
 from boto.swf.exceptions import SWFResponseError
 from boto.swf.layer1_decisions import Layer1Decisions
-from flowy.exception import SuspendTask, TaskError
-from flowy.result import Error, Result, Timeout
+from flowy.blob import BROADCAST_KEY, store_broadcast
+from flowy.cache import CACHE_MARKER_PREFIX, cache_result, cached_result
+from flowy.cache import is_cacheable
+from flowy.codec import decode, encode
+from flowy.exception import SuspendTask, TaskCancelled, TaskError
+from flowy.result import Error, Placeholder, Result, Timeout
+from flowy.semaphore import acquire_all, new_holder, release_all, renew_all
+from flowy.serializer import get_serializer, loads
 from flowy.spec import _sentinel
 
 
 logger = logging.getLogger(__name__)
 
+# a marker for each delayed call given up on while its timer runs
+CANCEL_MARKER_PREFIX = 'flowy.cancel.'
+# the reason of the tasks given up on by a worker before SWF times them out,
+# the deciders take them for timed out so they are retried
+TIMEOUT_REASON_PREFIX = 'flowy.timeout: '
+
 
 serialize_result = staticmethod(json.dumps)
-deserialize_args = staticmethod(json.loads)
+
+
+@staticmethod
+def deserialize_args(input):
+    return loads(decode(input))
 
 
 @staticmethod
@@ -41,6 +57,8 @@ class Task(object):
             result = self.run(*args, **kwargs)
         except SuspendTask:
             return self._suspend()
+        except TaskCancelled:
+            return self._acknowledge_cancel()
         except Exception as e:
             logger.exception("Error while running the task:")
             return self.fail(e)
@@ -53,12 +71,26 @@ class Task(object):
     def _suspend(self):
         raise NotImplementedError
 
+    def _acknowledge_cancel(self):
+        raise NotImplementedError
+
     def fail(self, reason):
         raise NotImplementedError
 
     def _finish(self, result):
         raise NotImplementedError
 
+    def _encode(self, value, serialize):
+        # the serialize hook is used unless a serializer is chosen
+        if self.serializer is not None:
+            data = get_serializer(self.serializer).dumps(value)
+        else:
+            data = serialize(value)
+        return encode(data, self.compression)
+
+    # a Compression and a serializer for the payloads sent by this task
+    compression = None
+    serializer = None
     _serialize_result = serialize_result
     _deserialize_arguments = deserialize_args
 
@@ -68,38 +100,79 @@ class SWFActivity(Task):
         self._swf_client = swf_client
         super(SWFActivity, self).__init__(input, token)
 
+    def __call__(self):
+        if not self.semaphores:
+            return super(SWFActivity, self).__call__()
+        self._leases = _acquire_semaphores(self, self.semaphores,
+                                           self.semaphore_timeout)
+        if self._leases is None:
+            return False
+        try:
+            return super(SWFActivity, self).__call__()
+        finally:
+            _release_semaphores(*self._leases)
+            self._leases = None
+
+    # the Semaphores and RateLimits acquired before running, see semaphore
+    semaphores = ()
+    semaphore_timeout = None
+    _leases = None
+
     def _suspend(self):
         return True
 
+    def _acknowledge_cancel(self):
+        return _activity_cancel(self._swf_client, self.token)
+
     def fail(self, reason):
         return _activity_fail(self._swf_client, self.token, reason)
 
     def _finish(self, result):
         try:
-            result = self._serialize_result(result)
+            result = self._encode(result, self._serialize_result)
         except TypeError:
             logger.exception('Error while serializing the result:')
             return False
         return _activity_finish(self._swf_client, self.token, result)
 
     def heartbeat(self):
+        """ Raises TaskCancelled if the task is to be cancelled, False if the
+        heartbeat couldn't be sent.
+        """
+        if self._leases is not None:
+            holder, leases = self._leases
+            try:
+                if not renew_all(leases, holder):
+                    logger.warning('Lost the lease of a semaphore.')
+            except Exception:
+                logger.exception('Error while renewing the semaphores:')
         return _activity_heartbeat(self._swf_client, self.token)
 
 
 class AsyncSWFActivity(object):
-    def __init__(self, swf_client, token):
+    def __init__(self, swf_client, token, compression=None, serializer=None):
         self._swf_client = swf_client
         self._token = token
+        self._compression = compression
+        self._serializer = serializer
 
     def heartbeat(self):
-        return _activity_heartbeat(self._swf_client, self._token)
+        try:
+            return _activity_heartbeat(self._swf_client, self._token)
+        except TaskCancelled:
+            # the external system stops and fails or finishes the task
+            return False
 
     def fail(self, reason):
         return _activity_fail(self._swf_client, self._token, reason)
 
     def finish(self, result):
         try:
-            result = self._serialize_result(result)
+            if self._serializer is not None:
+                result = get_serializer(self._serializer).dumps(result)
+            else:
+                result = self._serialize_result(result)
+            result = encode(result, self._compression)
         except TypeError:
             logger.exception('Error while serializing the result:')
             return False
@@ -108,25 +181,140 @@ class AsyncSWFActivity(object):
     _serialize_result = serialize_result
 
 
+class SWFFusedActivity(Task):
+    """ Runs a chain of activities in sequence as a single activity task.
+
+    The value returned by each step is passed in memory to the next one. The
+    serialized result of every step is reported back, on failure as the
+    details of the failed task, so the decider can expose them one by one.
+    """
+    def __init__(self, swf_client, input, token, steps):
+        self._swf_client = swf_client
+        self._steps = steps
+        super(SWFFusedActivity, self).__init__(input, token)
+
+    def __call__(self):
+        if not all(isinstance(step, Task) for step in self._steps):
+            return self.fail('Not all the fused activities were found.')
+        try:
+            args, kwargs = self._deserialize_arguments(self._input)
+        except ValueError:
+            logger.exception("Error while deserializing the arguments:")
+            return False
+        # the semaphores of all the steps are held for the whole chain
+        semaphores = [g for step in self._steps
+                      for g in getattr(step, 'semaphores', ())]
+        leases = None
+        if semaphores:
+            timeouts = [getattr(step, 'semaphore_timeout', None)
+                        for step in self._steps]
+            timeouts = [t for t in timeouts if t is not None]
+            leases = _acquire_semaphores(self, semaphores,
+                                         min(timeouts) if timeouts else None)
+            if leases is None:
+                return False
+            for step in self._steps:
+                step._leases = leases
+        try:
+            return self._run_steps(args, kwargs)
+        finally:
+            if leases is not None:
+                _release_semaphores(*leases)
+                for step in self._steps:
+                    step._leases = None
+
+    def _run_steps(self, args, kwargs):
+        results = []
+        for step in self._steps:
+            try:
+                value = step.run(*args, **kwargs)
+                results.append(step._encode(value, step._serialize_result))
+            except SuspendTask:
+                return self.fail('Fused activities cannot be suspended.')
+            except TaskCancelled:
+                return self._acknowledge_cancel()
+            except Exception as e:
+                logger.exception("Error while running the fused task:")
+                return _activity_fail(self._swf_client, self.token, e,
+                                      details=json.dumps(results))
+            args, kwargs = [value], {}
+        return _activity_finish(self._swf_client, self.token,
+                                json.dumps(results))
+
+    def _acknowledge_cancel(self):
+        return _activity_cancel(self._swf_client, self.token)
+
+    def fail(self, reason):
+        return _activity_fail(self._swf_client, self.token, reason)
+
+    def heartbeat(self):
+        return _activity_heartbeat(self._swf_client, self.token)
+
+
+def _acquire_semaphores(task, semaphores, timeout):
+    # the task is failed as timed out if they can't be acquired, so the
+    # decider retries it
+    holder = new_holder()
+    try:
+        leases = acquire_all(semaphores, holder, task.heartbeat, timeout)
+    except TaskCancelled:
+        task._acknowledge_cancel()
+        return None
+    except Exception as e:
+        logger.exception('Error while acquiring the semaphores:')
+        _activity_timeout(task._swf_client, task.token,
+                          'Error while acquiring the semaphores: %s' % e)
+        return None
+    if leases is None:
+        _activity_timeout(task._swf_client, task.token,
+                          'Timed out waiting for the semaphores.')
+        return None
+    return holder, leases
+
+
+def _release_semaphores(holder, leases):
+    # the leases expire anyway
+    try:
+        release_all(leases, holder)
+    except Exception:
+        logger.exception('Error while releasing the semaphores:')
+
+
 def _activity_heartbeat(swf_client, token):
     try:
-        swf_client.record_activity_task_heartbeat(task_token=str(token))
+        response = swf_client.record_activity_task_heartbeat(
+            task_token=str(token))
     except SWFResponseError:
         logger.exception('Error while sending the heartbeat:')
         return False
+    if response and response.get('cancelRequested'):
+        raise TaskCancelled()
     return True
 
 
-def _activity_fail(swf_client, token, reason):
+def _activity_cancel(swf_client, token):
+    try:
+        swf_client.respond_activity_task_canceled(task_token=str(token))
+    except SWFResponseError:
+        logger.exception('Error while cancelling the activity:')
+        return False
+    return True
+
+
+def _activity_fail(swf_client, token, reason, details=None):
     try:
         swf_client.respond_activity_task_failed(
-            reason=str(reason)[:256], task_token=str(token))
+            reason=str(reason)[:256], details=details, task_token=str(token))
     except SWFResponseError:
         logger.exception('Error while failing the activity:')
         return False
     return True
 
 
+def _activity_timeout(swf_client, token, reason):
+    return _activity_fail(swf_client, token, TIMEOUT_REASON_PREFIX + reason)
+
+
 def _activity_finish(swf_client, token, result):
     try:
         swf_client.respond_activity_task_completed(
@@ -139,20 +327,36 @@ def _activity_finish(swf_client, token, result):
 
 class _SWFWorkflow(Task):
 
-    _TIMEDOUT, _RUNNING, _ERROR, _FOUND, _NOTFOUND = range(5)
+    _TIMEDOUT, _RUNNING, _ERROR, _FOUND, _NOTFOUND, _CANCELLED = range(6)
+    _TIMER, _ACTIVITY, _WORKFLOW = 'timer', 'activity', 'workflow'
+    _HEDGE_TIMER = 'hedge timer'
 
     def __init__(self, scheduler, input, token, running, timedout, results,
-                 errors, order, spec, tags):
+                 errors, order, spec, tags, cancelled=(), children=None,
+                 signals=None, markers=None, workflow_id=None, fresh=()):
         self._scheduler = scheduler
         self._running = set(map(int, running))
         self._timedout = set(map(int, timedout))
         self._results = dict((int(k), v) for k, v in results.items())
         self._errors = dict((int(k), v) for k, v in errors.items())
-        self._order = list(map(int, order))
+        # signals are ordered by (name, index), everything else by call ID
+        self._order = [o if isinstance(o, tuple) else int(o) for o in order]
+        self._cancelled = set(map(int, cancelled))
+        if children is None:
+            children = {}
+        self._children = dict((int(k), v) for k, v in children.items())
+        self._signals = signals if signals is not None else {}
+        self._waited_signals = {}
+        self._markers = markers if markers is not None else {}
+        # the results of the activities that completed since last decision
+        self._fresh = set(map(int, fresh))
+        self._workflow_id = workflow_id
+        self._broadcast_count = 0
         self._spec = spec
         self._tags = tags
         self._scheduled = False
         self._call_id = 0
+        self._in_flight = []
         super(_SWFWorkflow, self).__init__(input, token)
 
     @contextmanager
@@ -166,26 +370,118 @@ class _SWFWorkflow(Task):
             yield
         self._tags = old_tags
 
-    def first_result(self, *results):
-            return min(results).result()
+    def first_result(self, *results, **kwargs):
+        cancel = _pop_cancel(kwargs)
+        first = min(results)
+        if cancel and not isinstance(first, Placeholder):
+            self._cancel_placeholders(r for r in results if r is not first)
+        return first.result()
 
-    def first_results(self, n, *results):
+    def first_results(self, n, *results, **kwargs):
+        cancel = _pop_cancel(kwargs)
         n = int(n)
         if not len(results) > 1:
             raise ValueError("No results to wait for.")
         if n == 1:
-            return self.first_result(*results)
+            return self.first_result(*results, cancel=cancel)
         elif n < len(results):
-            return [r.result() for r in sorted(results)[:n]]
+            results = sorted(results)
+            if cancel and not isinstance(results[n - 1], Placeholder):
+                self._cancel_placeholders(results[n:])
+            return [r.result() for r in results[:n]]
         else:
-            return all_results(*results)
+            return self.all_results(*results)
 
     def all_results(self, *results):
         return [r.result() for r in results]
 
+    def accumulate(self, name, func, initial, *results):
+        """ Fold the finished results into an aggregate, as func(acc, value).
+
+        The results are folded in the order they finished and the aggregate
+        is checkpointed in a history marker, so on the next decisions only
+        the newly finished results are deserialized and folded. The name must
+        be unique in the workflow and the aggregate JSON serializable.
+
+        The aggregate is returned as a Result once all the results are
+        folded, a Placeholder before that, or the first Error or Timeout.
+        """
+        value, folded = initial, set()
+        checkpoint = self._markers.get(name)
+        if checkpoint is not None:
+            checkpoint = self._deserialize_checkpoint(checkpoint)
+            value = checkpoint['value']
+            folded = set(_expand_ranges(checkpoint['folded']))
+        errors = [r for r in results if isinstance(r, (Error, Timeout))]
+        if errors:
+            return min(errors)
+        done = sorted(r for r in results if isinstance(r, Result))
+        new = [r for r in done if r._order not in folded]
+        for r in new:
+            value = func(value, r.result())
+            folded.add(r._order)
+        if new:
+            self._checkpoint(name, value, folded)
+        if len(done) < len(results):
+            return Placeholder()
+        return Result(value, max(r._order for r in done) if done else None)
+
+    def _checkpoint(self, name, value, folded):
+        try:
+            details = self._encode({
+                'folded': _compress_ranges(folded),
+                'value': value,
+            }, self._serialize_checkpoint)
+        except TypeError:
+            logger.exception('Error while serializing the checkpoint:')
+            return
+        if len(details) > self._max_checkpoint_size:
+            logger.warning('The %r checkpoint is too large, skipping it.',
+                           name)
+            return
+        self._scheduler.record_marker(name, details)
+
+    def broadcast(self, value):
+        """ A handle to pass value to many calls without copying it.
+
+        The value is serialized and stored in the blob store only once, its
+        key is kept in a history marker for the next decisions. The tasks
+        get the value back, cached per process. Without a blob store the
+        value itself is returned.
+        """
+        name = 'flowy.broadcast.%d' % self._broadcast_count
+        self._broadcast_count += 1
+        key = self._markers.get(name)
+        if key is None:
+            key = store_broadcast(value)
+            if key is None:
+                return value
+            self._scheduler.record_marker(name, key)
+        return {BROADCAST_KEY: key}
+
+    def wait_for_signal(self, name):
+        """ The value of the next signal with this name, in arrival order.
+
+        Until it arrives a Placeholder is returned and, unlike polling with
+        delayed calls, the workflow makes no decisions while waiting: the
+        signal itself starts the next decision.
+        """
+        k = self._waited_signals.get(name, 0)
+        self._waited_signals[name] = k + 1
+        received = self._signals.get(name, [])
+        if k >= len(received):
+            return Placeholder()
+        value = received[k]
+        if value is not None:
+            value = self._deserialize_signal(value)
+        return Result(value, self._order.index((name, k)))
+
     def restart(self, *args, **kwargs):
         try:
-            input = self._serialize_restart_arguments(*args, **kwargs)
+            def serialize(args_kwargs):
+                args, kwargs = args_kwargs
+                return self._serialize_restart_arguments(*args, **kwargs)
+            input = self._encode([args, kwargs], serialize)
         except TypeError:
             logger.exception('Error while serializing restart arguments:')
             return False
@@ -208,23 +504,48 @@ class _SWFWorkflow(Task):
                 result.result()
             except TaskError as e:
                 return self._scheduler.fail(e)
-        if not self._scheduled and not self._running:
+        elif isinstance(result, Placeholder):
+            return self._scheduler.flush()
+        # don't wait for the calls that are being cancelled
+        if not self._scheduled and not self._running - self._cancelled:
             try:
-                r = self._serialize_result(r)
+                r = self._encode(r, self._serialize_result)
             except TypeError:
                 logger.exception("Error while serializing the result:")
                 return False
             return self._scheduler.complete(r)
         return self._scheduler.flush()
 
-    def schedule_activity(self, spec, input, retry, delay):
-        return self._schedule(spec, input, retry, delay, True)
-
-    def schedule_workflow(self, spec, input, retry, delay):
-        return self._schedule(spec, input, retry, delay, False)
-
-    def _schedule(self, spec, input, retry, delay, is_act=True):
+    _deserialize_signal = deserialize_args
+    _serialize_checkpoint = serialize_result
+    _deserialize_checkpoint = deserialize_args
+    # the marker details are limited to 32k characters
+    _max_checkpoint_size = 32768
+
+    def schedule_activity(self, spec, input, retry, delay, hedge_after=None,
+                          hedge_cancel=True, backoff=None):
+        return self._schedule(spec, input, retry, delay, True,
+                              hedge_after=hedge_after,
+                              hedge_cancel=hedge_cancel, backoff=backoff)
+
+    def schedule_workflow(self, spec, input, retry, delay, backoff=None,
+                          deterministic_id=False):
+        # by default the child workflow IDs are prefixed with a random UUID,
+        # deterministic IDs are prefixed with this workflow's ID instead
+        id_prefix = self._workflow_id if deterministic_id else None
+        return self._schedule(spec, input, retry, delay, False,
+                              backoff=backoff, id_prefix=id_prefix)
+
+    def schedule_fused(self, spec, input, retry, delay, backoff=None):
+        return self._schedule(spec, input, retry, delay, steps=len(spec),
+                              backoff=backoff)
+
+    def _schedule(self, spec, input, retry, delay, is_act=True, steps=1,
+                  hedge_after=None, hedge_cancel=True, backoff=None,
+                  id_prefix=None):
+        input = _lazy_input(input)
         initial_call_id = self._call_id
+        self._in_flight = []
         try:
             if delay:
                 state = self._search_timer()
@@ -232,21 +553,110 @@ class _SWFWorkflow(Task):
                     self._scheduled = True
                     self._scheduler.schedule_timer(delay, self._call_id)
                     state = self._RUNNING
+                if state == self._RUNNING:
+                    self._in_flight = [(self._call_id, self._TIMER)]
                 if not(state == self._FOUND):
                     return state, None, None
-            state, value, order = self._search_result(retry)
+            state, value, order = self._search_result(retry, steps, backoff)
+            if is_act and steps == 1:
+                state, value, order = self._cache(spec, input, state, value,
+                                                  order)
+            kind = self._ACTIVITY if is_act else self._WORKFLOW
             if state == self._NOTFOUND:
                 self._scheduled = True
-                sched = self._scheduler.schedule_activity
-                if not is_act:
-                    sched = self._scheduler.schedule_workflow
-                sched(spec, self._call_id, input)
-                return self._RUNNING, None, None
+                if is_act:
+                    self._scheduler.schedule_activity(spec, self._call_id,
+                                                      input())
+                else:
+                    self._scheduler.schedule_workflow(spec, self._call_id,
+                                                      input(), id_prefix)
+                state = self._RUNNING
+            if state == self._RUNNING and not self._in_flight:
+                self._in_flight = [(self._call_id, kind)]
+            if hedge_after:
+                hedge_call_id = (initial_call_id + int(delay > 0)
+                                 + (1 + retry) * steps
+                                 + retry * int(backoff is not None))
+                return self._hedge(spec, input, hedge_after, hedge_cancel,
+                                   hedge_call_id, (state, value, order))
             return state, value, order
         finally:
-            self._reserve_call_ids(initial_call_id, delay, retry)
+            self._reserve_call_ids(initial_call_id, delay, retry, steps,
+                                   bool(hedge_after), backoff)
+
+    def _cache(self, spec, input, state, value, order):
+        if not is_cacheable(spec):
+            return state, value, order
+        if state == self._FOUND:
+            # cached once, by the decision seeing the activity complete, the
+            # results replayed or recorded from the cache are left alone
+            if self._call_id in self._fresh:
+                cache_result(spec, input(), value)
+        elif state == self._NOTFOUND:
+            cached = cached_result(spec, input())
+            if cached is not None:
+                # the marker stands for the result on the next decisions,
+                # the poller orders it right after the events seen here
+                self._scheduler.record_marker(
+                    CACHE_MARKER_PREFIX + str(self._call_id), cached)
+                self._results[self._call_id] = cached
+                self._order.append(self._call_id)
+                return self._FOUND, cached, len(self._order) - 1
+        return state, value, order
+
+    def _hedge(self, spec, input, hedge_after, cancel, hedge_call_id,
+               first_attempt):
+        # a timer is started together with the first attempt, if it fires
+        # before any result is available a duplicate attempt is scheduled
+        state, value, order = first_attempt
+        first_call_id = self._call_id
+        timer_id, hedge_id = hedge_call_id, hedge_call_id + 1
+        self._call_id = hedge_id
+        h_state, h_value, h_order = self._search_result(0)
+        if self._FOUND in (state, h_state):
+            if h_state == self._FOUND and (state != self._FOUND
+                                           or h_order < order):
+                state, value, order = h_state, h_value, h_order
+                if cancel and first_call_id in self._running:
+                    self._cancel(first_call_id, self._ACTIVITY)
+            elif cancel and h_state == self._RUNNING:
+                self._cancel(hedge_id, self._ACTIVITY)
+            self._cancel_hedge_timer(timer_id)
+            return state, value, order
+        if state == self._RUNNING:
+            # the duplicate or the timer are cancelled with the first attempt
+            if timer_id in self._results:
+                if h_state == self._NOTFOUND:
+                    self._scheduled = True
+                    self._scheduler.schedule_activity(spec, hedge_id,
+                                                      input())
+                    h_state = self._RUNNING
+                if h_state == self._RUNNING:
+                    self._in_flight.append((hedge_id, self._ACTIVITY))
+            elif timer_id not in self._cancelled:
+                if timer_id not in self._running:
+                    self._scheduled = True
+                    self._scheduler.schedule_timer(hedge_after, timer_id,
+                                                   shared=False)
+                self._in_flight.append((timer_id, self._HEDGE_TIMER))
+            return self._RUNNING, None, None
+        # the first attempt failed, wait for the duplicate if there is one
+        if h_state == self._RUNNING:
+            self._in_flight = [(hedge_id, self._ACTIVITY)]
+            return self._RUNNING, None, None
+        self._cancel_hedge_timer(timer_id)
+        return state, value, order
+
+    def _cancel_hedge_timer(self, timer_id):
+        # the workflow can't complete while the timer is still running
+        if timer_id in self._running and timer_id not in self._cancelled:
+            self._scheduler.cancel_timer(timer_id)
+            self._cancelled.add(timer_id)
 
     def _search_timer(self):
+        # the timer of a cancelled call may still fire
+        if self._call_id in self._cancelled:
+            return self._CANCELLED
         if self._call_id in self._results:
             self._call_id += 1
             return self._FOUND
@@ -254,42 +664,129 @@ class _SWFWorkflow(Task):
             return self._RUNNING
         return self._NOTFOUND
 
-    def _search_result(self, retry):
+    def _search_result(self, retry, steps=1, backoff=None):
         # update self._call_id automatically
-        for self._call_id in range(self._call_id, self._call_id + retry + 1):
-            if self._call_id in self._timedout:
-                continue
-            if self._call_id in self._running:
+        first_call_id = self._call_id
+        # a fused chain uses one call ID for each step of an attempt and with
+        # a backoff policy each retry is preceded by a timer
+        stride = steps + int(backoff is not None)
+        for attempt in range(retry + 1):
+            self._call_id = first_call_id + attempt * stride
+            if attempt and backoff is not None:
+                self._call_id -= 1
+                state = self._search_timer()
+                if state == self._NOTFOUND:
+                    self._scheduled = True
+                    self._scheduler.schedule_timer(backoff.delay(attempt),
+                                                   self._call_id)
+                    state = self._RUNNING
+                if state == self._RUNNING:
+                    self._in_flight = [(self._call_id, self._TIMER)]
+                if not(state == self._FOUND):
+                    return state, None, None
+            state, value, order = self._search_attempt(steps)
+            if state != self._TIMEDOUT:
+                return state, value, order
+        return self._TIMEDOUT, None, self._order.index(self._call_id)
+
+    def _search_attempt(self, steps):
+        for call_id in range(self._call_id, self._call_id + steps):
+            # a cancelled call that times out or fails isn't retried
+            if call_id in self._cancelled and call_id not in self._results:
+                return self._CANCELLED, None, None
+            if call_id in self._timedout:
+                return self._TIMEDOUT, None, None
+            if call_id in self._running:
                 return self._RUNNING, None, None
-            if self._call_id in self._errors:
+            if call_id in self._errors:
                 return (self._ERROR,
-                        self._errors[self._call_id],
-                        self._order.index(self._call_id))
-            if self._call_id in self._results:
-                return (self._FOUND,
-                        self._results[self._call_id],
-                        self._order.index(self._call_id))
+                        self._errors[call_id],
+                        self._order.index(call_id))
+            if call_id in self._results:
+                continue
             return self._NOTFOUND, None, None
-        return self._TIMEDOUT, None, self._order.index(self._call_id)
-
-    def _reserve_call_ids(self, call_id, delay, retry):
+        return (self._FOUND,
+                self._results[call_id],
+                self._order.index(call_id))
+
+    def _cancel_placeholders(self, results):
+        for r in results:
+            if isinstance(r, Placeholder):
+                for call_id, kind in r._calls:
+                    self._cancel(call_id, kind)
+
+    def _cancel(self, call_id, kind):
+        if call_id in self._cancelled:
+            return
+        if kind == self._TIMER:
+            # a timer may be shared with other calls so it keeps running, the
+            # marker keeps the delayed call from being scheduled once it fires
+            self._scheduler.cancel_delay(call_id)
+        elif kind == self._HEDGE_TIMER:
+            # a timer of its own, the workflow can't complete while it runs
+            self._scheduler.cancel_timer(call_id)
+        elif kind == self._ACTIVITY:
+            self._scheduler.cancel_activity(call_id)
+        elif kind == self._WORKFLOW:
+            if call_id not in self._children:
+                # scheduled in this decision, it gets cancelled on the next one
+                return
+            self._scheduler.cancel_workflow(self._children[call_id])
+        self._cancelled.add(call_id)
+
+    def _reserve_call_ids(self, call_id, delay, retry, steps=1, hedge=False,
+                          backoff=None):
         self._call_id = (
-            1 + call_id         # one for the first call
-            + int(delay > 0)    # one for the timer if needed
-            + retry             # one for each possible retry
+            call_id
+            + int(delay > 0)            # one for the timer if needed
+            + (1 + retry) * steps       # for the first call and each retry
+            + retry * int(backoff is not None)  # a timer before each retry
+            + 2 * int(hedge)            # a timer and a duplicate attempt
         )
 
+    def _result_call_ids(self, call_id, delay, retry, steps=1, hedge=False,
+                         backoff=None):
+        # the call IDs a result can be found at, laid out as reserved above:
+        # the last step of each attempt and the duplicate attempt if hedged
+        first = call_id + int(delay > 0)
+        stride = steps + int(backoff is not None)
+        ids = [first + attempt * stride + steps - 1
+               for attempt in range(retry + 1)]
+        if hedge:
+            ids.append(first + (1 + retry) * steps
+                       + retry * int(backoff is not None) + 1)
+        return ids
+
     _serialize_restart_arguments = serialize_args
 
 
+_CANCEL_DECISIONS = frozenset(['CancelTimer', 'RequestCancelActivityTask',
+                               'RequestCancelExternalWorkflowExecution'])
+
+
+def _decision_target(decision):
+    # the activity, the timer or the workflow a decision starts or cancels
+    kind = decision['decisionType']
+    attrs = decision.get(kind[0].lower() + kind[1:] + 'DecisionAttributes')
+    if not attrs:
+        return None
+    return (attrs.get('activityId') or attrs.get('timerId')
+            or attrs.get('workflowId'))
+
+
 # It's important for the scheduler to ignore anything after the first flush
 # since the task doesn't promise calling it only once
 class SWFScheduler(object):
+
+    # keep the control field of shared timers well under its 32k limit
+    _max_shared_timer_calls = 1000
+
     def __init__(self, swf_client, token, rate_limit=64):
         self._swf_client = swf_client
         self._token = token
         self._rate_limit = rate_limit
         self._decisions = Layer1Decisions()
+        self._shared_timers = {}
         self._closed = False
 
     def flush(self):
@@ -306,40 +803,139 @@ class SWFScheduler(object):
         return True
 
     def restart(self, spec, input, tags):
-        decisions = self._decisions = Layer1Decisions()
+        decisions = self._close_decisions()
         spec.restart(decisions, input, tags)
         return self.flush()
 
     def fail(self, reason):
-        decisions = self._decisions = Layer1Decisions()
+        decisions = self._close_decisions()
         decisions.fail_workflow_execution(reason=str(reason)[:256])
         return self.flush()
 
     def complete(self, result):
-        decisions = self._decisions = Layer1Decisions()
+        decisions = self._close_decisions()
         decisions.complete_workflow_execution(result)
         return self.flush()
 
-    def schedule_timer(self, delay, call_id):
-        if len(self._decisions._data) < self._rate_limit:
+    def _close_decisions(self):
+        # the calls scheduled in this decision are dropped but the ones being
+        # cancelled must still be cancelled before the workflow closes, if
+        # they were started by an earlier decision
+        started = set(_decision_target(d) for d in self._decisions._data
+                      if d['decisionType'] not in _CANCEL_DECISIONS)
+        decisions = Layer1Decisions()
+        decisions._data = [d for d in self._decisions._data
+                           if d['decisionType'] in _CANCEL_DECISIONS
+                           and _decision_target(d) not in started]
+        self._decisions = decisions
+        return decisions
+
+    def schedule_timer(self, delay, call_id, shared=True):
+        delay = str(delay)
+        calls, attrs = self._shared_timers.get(delay, ([], None))
+        if shared and 0 < len(calls) < self._max_shared_timer_calls:
+            # a single timer fires for all the calls delayed the same in this
+            # decision, the calls it resolves are listed in its control field
+            calls.append(call_id)
+            attrs['control'] = json.dumps(calls)
+        elif len(self._decisions._data) < self._rate_limit:
             self._decisions.start_timer(
-                start_to_fire_timeout=str(delay),
+                start_to_fire_timeout=delay,
                 timer_id=str(call_id)
             )
+            if shared:
+                STDA = 'startTimerDecisionAttributes'
+                attrs = self._decisions._data[-1][STDA]
+                self._shared_timers[delay] = [call_id], attrs
 
     def schedule_activity(self, spec, call_id, input):
         if len(self._decisions._data) < self._rate_limit:
             spec.schedule(self._decisions, call_id, input)
 
-    def schedule_workflow(self, spec, call_id, input):
+    def schedule_workflow(self, spec, call_id, input, id_prefix=None):
         if len(self._decisions._data) < self._rate_limit:
-            call_id = '%s-%s' % (uuid.uuid4(), call_id)
+            if id_prefix is None:
+                id_prefix = uuid.uuid4()
+            call_id = '%s-%s' % (id_prefix, call_id)
             spec.schedule(self._decisions, call_id, input)
 
+    def record_marker(self, name, details):
+        if len(self._decisions._data) < self._rate_limit:
+            self._decisions.record_marker(str(name), details)
+
+    def cancel_timer(self, call_id):
+        self._decisions.cancel_timer(timer_id=str(call_id))
+
+    def cancel_delay(self, call_id):
+        self._decisions.record_marker(CANCEL_MARKER_PREFIX + str(call_id))
+
+    def cancel_activity(self, call_id):
+        self._decisions.request_cancel_activity_task(activity_id=str(call_id))
+
+    def cancel_workflow(self, workflow_id):
+        self._decisions.request_cancel_external_workflow_execution(
+            workflow_id=str(workflow_id))
+
 
 class SWFWorkflow(_SWFWorkflow):
     def __init__(self, swf_client, input, token, running, timedout, results,
-                 errors, order, spec, tags):
+                 errors, order, spec, tags, **kwargs):
         s = SWFScheduler(swf_client, token, rate_limit=64 - len(running))
         super(SWFWorkflow, self).__init__(s, input, token, running, timedout,
-                                          results, errors, order, spec, tags)
+                                          results, errors, order, spec, tags,
+                                          **kwargs)
+
+
+class SWFPartitionedWorkflow(SWFWorkflow):
+    """ A node of a tree of workflows mapping an index range.
+
+    Subclasses set partition to a SWFPartitionProxy for their own workflow
+    type and implement run_leaf(start, stop) for the slices small enough.
+    """
+    partition = None
+
+    def run(self, start, stop):
+        if stop - start <= self.partition._leaf_size:
+            return self.run_leaf(start, stop)
+        return self.partition(start, stop)
+
+    def run_leaf(self, start, stop):
+        raise NotImplementedError
+
+
+def _lazy_input(input):
+    # the input can be given as a function serializing it, called once and
+    # only when the input is needed
+    if not callable(input):
+        return lambda: input
+    serialized = []
+
+    def get():
+        if not serialized:
+            serialized.append(input())
+        return serialized[0]
+    return get
+
+
+def _compress_ranges(numbers):
+    ranges = []
+    for n in sorted(numbers):
+        if ranges and ranges[-1][1] == n - 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+    return ranges
+
+
+def _expand_ranges(ranges):
+    for start, end in ranges:
+        for n in range(start, end + 1):
+            yield n
+
+
+def _pop_cancel(kwargs):
+    cancel = kwargs.pop('cancel', False)
+    if kwargs:
+        raise TypeError('Unexpected keyword arguments: %s'
+                        % ', '.join(sorted(kwargs)))
+    return cancel
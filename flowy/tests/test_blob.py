@@ -0,0 +1,89 @@
+import shutil
+import tempfile
+from unittest import TestCase
+
+
+class TestLocalBlobStore(TestCase):
+
+    def setUp(self):
+        from flowy.blob import LocalBlobStore
+        self.path = tempfile.mkdtemp()
+        self.store = LocalBlobStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_content_addressed(self):
+        key = self.store.put(b'data')
+        self.assertEqual(self.store.put(b'data'), key)
+        self.assertNotEqual(self.store.put(b'other'), key)
+        self.assertEqual(self.store.get(key), b'data')
+
+    def test_empty(self):
+        self.assertEqual(self.store.get(self.store.put(b'')), b'')
+
+
+class DummyBlobStore(object):
+
+    def __init__(self):
+        self.blobs = {}
+        self.reads = 0
+
+    def put(self, data):
+        key = str(len(self.blobs))
+        self.blobs[key] = data
+        return key
+
+    def get(self, key):
+        self.reads += 1
+        return self.blobs[key]
+
+
+class TestOffload(TestCase):
+
+    def setUp(self):
+        from flowy.blob import set_blob_store
+        self.store = DummyBlobStore()
+        set_blob_store(self.store, threshold=10, cache_size=1)
+
+    def tearDown(self):
+        from flowy.blob import set_blob_store
+        set_blob_store(None)
+
+    def test_small_payloads_inline(self):
+        from flowy.codec import encode
+        from flowy.task import serialize_args
+        self.assertEqual(encode(serialize_args.__func__(1)), '[[1], {}]')
+        self.assertEqual(self.store.blobs, {})
+
+    def test_offload_and_restore(self):
+        from flowy.codec import encode
+        from flowy.task import serialize_result
+        from flowy.proxy import deserialize_result
+        data = encode(serialize_result.__func__('x' * 10))
+        self.assertEqual(data, '@blob:0')
+        self.assertEqual(deserialize_result.__func__(data), 'x' * 10)
+
+    def test_cache(self):
+        from flowy.blob import offload, restore
+        first, second = offload('a' * 11), offload('b' * 11)
+        self.assertEqual(restore(second), 'b' * 11)
+        self.assertEqual(self.store.reads, 0)
+        self.assertEqual(restore(first), 'a' * 11)
+        self.assertEqual(restore(first), 'a' * 11)
+        self.assertEqual(self.store.reads, 1)
+
+    def test_no_store(self):
+        from flowy.blob import restore, set_blob_store
+        set_blob_store(None)
+        self.assertRaises(ValueError, restore, '@blob:0')
+
+    def test_broadcast(self):
+        from flowy.blob import store_broadcast
+        from flowy.task import deserialize_args
+        key = store_broadcast({'table': [1, 2]})
+        input = '[[{"@broadcast": "%s"}], {}]' % key
+        args, kwargs = deserialize_args.__func__(input)
+        self.assertEqual(args, [{'table': [1, 2]}])
+        args, kwargs = deserialize_args.__func__(input)
+        self.assertEqual(self.store.reads, 1)
@@ -0,0 +1,71 @@
+import threading
+from unittest import TestCase
+
+
+class DummyLayer1(object):
+    lock = threading.Lock()
+
+    def __init__(self):
+        self.calls = []
+
+    def respond_activity_task_completed(self, task_token, result=None):
+        self._call('completed', task_token, result)
+
+    def respond_activity_task_failed(self, task_token, reason=None,
+                                     details=None):
+        self._call('failed', task_token, reason)
+
+    def record_activity_task_heartbeat(self, task_token, details=None):
+        self._call('heartbeat', task_token, None)
+
+    def start_workflow_execution(self, domain, workflow_id, workflow_name,
+                                 workflow_version, task_list=None,
+                                 child_policy=None,
+                                 execution_start_to_close_timeout=None,
+                                 input=None, tag_list=None,
+                                 task_start_to_close_timeout=None):
+        self._call('started', domain, workflow_id, workflow_name,
+                   workflow_version, input)
+        return {'runId': 'run'}
+
+    def signal_workflow_execution(self, domain, signal_name, workflow_id,
+                                  input=None, run_id=None):
+        self._call('signaled', domain, workflow_id, signal_name, input)
+
+    def _call(self, *args):
+        with self.lock:
+            self.calls.append(args)
+
+
+class TestBoilerplate(TestCase):
+
+    def setUp(self):
+        self.layer1 = DummyLayer1()
+
+    def test_completion_gateway(self):
+        from flowy.boilerplate import completion_gateway
+        gateway = completion_gateway('domain', layer1=self.layer1, lanes=2)
+        gateway.start()
+        self.assertTrue(gateway.finish('t1', 1))
+        self.assertTrue(gateway.fail('t2', 'err'))
+        gateway.close()
+        self.assertEqual(sorted(self.layer1.calls), [
+            ('completed', 't1', '1'), ('failed', 't2', 'err')])
+
+    def test_async_scheduler(self):
+        from flowy.boilerplate import async_scheduler
+        activity = async_scheduler('domain', 'token', layer1=self.layer1)
+        self.assertTrue(activity.heartbeat())
+        self.assertTrue(activity.finish(1))
+        self.assertEqual(self.layer1.calls, [
+            ('heartbeat', 'token', None), ('completed', 'token', '1')])
+
+    def test_workflow_starter(self):
+        from flowy.boilerplate import workflow_starter
+        starter = workflow_starter('domain', 'W', 1, layer1=self.layer1,
+                                   id='wid', setup_log=False)
+        self.assertEqual(starter.start(1), 'run')
+        self.assertTrue(starter.signal('s', 2))
+        self.assertEqual([c[:4] for c in self.layer1.calls], [
+            ('started', 'domain', 'wid', 'W'),
+            ('signaled', 'domain', 'wid', 's')])
@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+
+class TestMemoryCache(TestCase):
+
+    def test_lru(self):
+        from flowy.cache import MemoryCache
+        cache = MemoryCache(2)
+        cache.set('a', '1')
+        cache.set('b', '2')
+        cache.get('a')
+        cache.set('c', '3')
+        self.assertEqual(cache.get('a'), '1')
+        self.assertEqual(cache.get('b'), None)
+
+    def test_expired(self):
+        from flowy.cache import MemoryCache
+        cache = MemoryCache()
+        cache.set('a', '1', ttl=-1)
+        self.assertEqual(cache.get('a'), None)
+
+
+class TestSQLiteCache(TestCase):
+
+    def setUp(self):
+        from flowy.cache import SQLiteCache
+        self.path = tempfile.mkdtemp()
+        self.cache = SQLiteCache(os.path.join(self.path, 'cache.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get_set(self):
+        self.cache.set('a', '1')
+        self.cache.set('b', '2', ttl=-1)
+        self.assertEqual(self.cache.get('a'), '1')
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('c'), None)
+
+    def test_tiered(self):
+        from flowy.cache import MemoryCache, TieredCache
+        memory = MemoryCache()
+        self.cache.set('a', '1')
+        cache = TieredCache(memory, self.cache)
+        self.assertEqual(memory.get('a'), None)
+        self.assertEqual(cache.get('a'), '1')
+        self.assertEqual(memory.get('a'), '1')
+
+
+class TestCachedActivities(TestCase):
+
+    def setUp(self):
+        from flowy.cache import MemoryCache, set_cacheable, set_result_cache
+        self.cache = MemoryCache()
+        set_result_cache(self.cache)
+        set_cacheable('meta', 1)
+
+    def tearDown(self):
+        from flowy.cache import _cacheable, set_result_cache
+        set_result_cache(None)
+        del _cacheable[('meta', '1')]
+
+    def decide(self, results={}, order=[], fresh=()):
+        from flowy.proxy import SWFActivityProxy
+        from flowy.task import _SWFWorkflow
+        from flowy.tests.test_task import DummyScheduler
+
+        class MyWorkflow(_SWFWorkflow):
+            meta = SWFActivityProxy('meta', 1)
+            other = SWFActivityProxy('other', 1)
+
+            def run(self):
+                return self.meta('x').result() + self.other('y').result()
+
+        scheduler = DummyScheduler()
+        MyWorkflow(scheduler, '[[], {}]', 'token', [], [], results, {}, order,
+                   None, None, fresh=fresh)()
+        return scheduler.state
+
+    def test_miss_and_fill(self):
+        state = self.decide()
+        self.assertEqual(state[0][0], 'ACTIVITY')
+        self.decide(results={0: '1', 4: '2'}, order=[0, 4], fresh=[0, 4])
+        self.assertEqual(len(self.cache._data), 1)
+
+    def test_replayed_results_not_cached(self):
+        # a replayed result, maybe from an expired cache marker, stays out
+        self.decide(results={0: '1', 4: '2'}, order=[0, 4], fresh=[4])
+        self.assertEqual(len(self.cache._data), 0)
+
+    def test_hit(self):
+        self.decide(results={0: '1', 4: '2'}, order=[0, 4], fresh=[0])
+        state = self.decide(results={4: '2'}, order=[4])
+        self.assertEqual(state, [
+            ('MARKER', 'flowy.cache.0', '1'),
+            ('COMPLETE', '3'),
+        ])
@@ -0,0 +1,54 @@
+from unittest import TestCase
+
+
+class TestCompression(TestCase):
+
+    def test_below_threshold(self):
+        from flowy.codec import Compression
+        compression = Compression(threshold=100)
+        self.assertEqual(compression.compress('[1, 1]'), '[1, 1]')
+
+    def test_roundtrip(self):
+        from flowy.codec import Compression, decode
+        data = '[' + ', '.join(['"repetitive"'] * 100) + ']'
+        compressed = Compression(threshold=10).compress(data)
+        self.assertTrue(compressed.startswith('@zlib:'))
+        self.assertTrue(len(compressed) < len(data))
+        self.assertEqual(decode(compressed), data)
+
+    def test_incompressible(self):
+        from flowy.codec import Compression
+        self.assertEqual(Compression(threshold=1).compress('"ab"'), '"ab"')
+
+    def test_unknown_codec(self):
+        from flowy.codec import Compression
+        self.assertRaises(ValueError, Compression, 'gzip2')
+
+    def test_decode_plain(self):
+        from flowy.codec import decode
+        self.assertEqual(decode('{"@x": 1}'), '{"@x": 1}')
+        self.assertEqual(decode(None), None)
+
+
+class TestProxyCompression(TestCase):
+
+    def test_compressed_input(self):
+        from flowy.codec import Compression
+        from flowy.proxy import SWFActivityProxy
+        from flowy.task import _SWFWorkflow
+        from flowy.tests.test_task import DummyScheduler
+
+        class MyWorkflow(_SWFWorkflow):
+            a = SWFActivityProxy('a', 1,
+                                 compression=Compression(threshold=10))
+
+            def run(self):
+                return self.a('x' * 100)
+
+        scheduler = DummyScheduler()
+        MyWorkflow(scheduler, '[[], {}]', 'token', [], [], {}, {}, [], None,
+                   None)()
+        input = scheduler.state[0][3]
+        self.assertTrue(input.startswith('@zlib:'))
+        self.assertEqual(MyWorkflow._deserialize_arguments(input),
+                         [['x' * 100], {}])
@@ -0,0 +1,169 @@
+from unittest import TestCase
+
+
+class DummyDecisionClient(object):
+
+    def __init__(self):
+        self.decisions = None
+
+    def respond_decision_task_completed(self, task_token, decisions):
+        self.decisions = decisions
+
+
+class TestDAGWorkflow(TestCase):
+
+    def decide(self, running=[], results={}, errors={}, order=None):
+        from flowy.dag import Arg, Node, Ref, SWFDAGWorkflow
+        from flowy.proxy import SWFActivityProxy
+
+        class Pipeline(SWFDAGWorkflow):
+            fetch = SWFActivityProxy('fetch', 1)
+            parse = SWFActivityProxy('parse', 1, error_handling=True)
+            count = SWFActivityProxy('count', 1)
+            store = SWFActivityProxy('store', 1, error_handling=True)
+
+            nodes = [
+                Node('page', fetch, Arg(0)),
+                Node('doc', parse, Ref('page')),
+                Node('size', count, Ref('page'), unit=Arg('unit')),
+                Node('stored', store, Ref('doc'), Ref('size')),
+            ]
+            output = 'stored'
+
+        if order is None:
+            order = sorted(list(results) + list(errors))
+        client = DummyDecisionClient()
+        workflow = Pipeline(client, '[["url"], {"unit": "kb"}]', 'token',
+                            running, [], results, errors, order, None, None)
+        workflow()
+        return [self.summary(d) for d in client.decisions]
+
+    def summary(self, decision):
+        SATDA = 'scheduleActivityTaskDecisionAttributes'
+        if SATDA in decision:
+            attrs = decision[SATDA]
+            return attrs['activityType']['name'], attrs['input']
+        return decision['decisionType']
+
+    def test_first_node(self):
+        self.assertEqual(self.decide(), [('fetch', '[["url"], {}]')])
+
+    def test_schedule_all_ready_nodes(self):
+        self.assertEqual(self.decide(results={0: '"p"'}), [
+            ('parse', '[["p"], {}]'),
+            ('count', '[["p"], {"unit": "kb"}]'),
+        ])
+
+    def test_wait_for_dependencies(self):
+        self.assertEqual(self.decide(results={0: '"p"', 4: '"d"'},
+                                     running=[8]), [])
+
+    def test_complete(self):
+        decisions = self.decide(
+            results={0: '"p"', 4: '"d"', 8: '1', 12: '"s"'})
+        self.assertEqual(decisions, ['CompleteWorkflowExecution'])
+
+    def test_error_propagates(self):
+        decisions = self.decide(results={0: '"p"', 8: '1'}, errors={4: 'e'})
+        self.assertEqual(decisions, ['FailWorkflowExecution'])
+
+
+class CountingSerializer(object):
+    tag = 'counting'
+
+    def __init__(self):
+        self.dumped = []
+
+    def dumps(self, value):
+        import json
+        self.dumped.append(value)
+        return json.dumps(value)
+
+
+class TestDAGSerialization(TestCase):
+
+    def test_serialize_only_scheduled_nodes(self):
+        from flowy.dag import Arg, Node, Ref, SWFDAGWorkflow
+        from flowy.proxy import SWFActivityProxy
+        serializer = CountingSerializer()
+
+        step = SWFActivityProxy('step', 1, serializer=serializer)
+        nodes = [Node('n0', step, Arg(0))]
+        nodes += [Node('n%d' % i, step, Ref('n%d' % (i - 1)))
+                  for i in range(1, 50)]
+
+        class Chain(SWFDAGWorkflow):
+            pass
+
+        Chain.nodes, Chain.output = nodes, 'n49'
+
+        results = dict((i * 4, str(i)) for i in range(10))
+        client = DummyDecisionClient()
+        Chain(client, '[[0], {}]', 'token', [], [], results, {},
+              sorted(results), None, None)()
+        self.assertEqual(serializer.dumped, [[[9], {}]])
+        self.assertEqual(len(client.decisions), 1)
+
+
+class TestDAGFinishedNodes(TestCase):
+
+    def decide(self, running=[], timedout=[], results={}, fresh=()):
+        from flowy.dag import Arg, Node, Ref, SWFDAGWorkflow
+        from flowy.proxy import ExponentialBackoff, SWFActivityProxy
+
+        calls = []
+
+        class CountingProxy(SWFActivityProxy):
+            def __call__(self, task, *args, **kwargs):
+                calls.append(self._spec._name)
+                return super(CountingProxy, self).__call__(task, *args,
+                                                           **kwargs)
+
+        class Pipeline(SWFDAGWorkflow):
+            fetch = CountingProxy('fetch', 1, delay=5, retry=1,
+                                  backoff=ExponentialBackoff())
+            parse = CountingProxy('parse', 1, hedge_after=10)
+            store = CountingProxy('store', 1)
+
+            nodes = [
+                Node('page', fetch, Arg(0)),
+                Node('doc', parse, Ref('page')),
+                Node('stored', store, Ref('doc')),
+            ]
+            output = 'stored'
+
+        order = sorted(list(results) + list(timedout))
+        client = DummyDecisionClient()
+        workflow = Pipeline(client, '[["url"], {}]', 'token', running,
+                            timedout, results, {}, order, None, None,
+                            fresh=fresh)
+        workflow()
+        return calls, [d['decisionType'] for d in client.decisions]
+
+    def test_finished_proxies_not_called(self):
+        # fetch: timer 0, attempts 1 and 3 with a backoff timer at 2
+        calls, decisions = self.decide(
+            timedout=[1], results={0: 'null', 2: 'null', 3: '"p"'})
+        self.assertEqual(calls, ['parse', 'store'])
+        self.assertEqual(decisions, ['ScheduleActivityTask', 'StartTimer'])
+
+    def test_hedged_result_found(self):
+        # parse: attempts 4 to 7, the hedge timer at 8 and the duplicate at 9
+        calls, decisions = self.decide(
+            running=[4], results={0: 'null', 1: '"p"', 8: 'null', 9: '"d"'})
+        self.assertEqual(calls, ['store'])
+        self.assertEqual(decisions, ['ScheduleActivityTask'])
+
+    def test_fresh_result_goes_through_proxy(self):
+        calls, decisions = self.decide(
+            running=[4], results={0: 'null', 1: '"p"', 8: 'null', 9: '"d"'},
+            fresh=[9])
+        self.assertEqual(calls, ['parse', 'store'])
+        self.assertEqual(decisions, ['RequestCancelActivityTask',
+                                     'ScheduleActivityTask'])
+
+    def test_complete_without_calling_proxies(self):
+        calls, decisions = self.decide(
+            results={0: 'null', 1: '"p"', 4: '"d"', 10: '"s"'})
+        self.assertEqual(calls, [])
+        self.assertEqual(decisions, ['CompleteWorkflowExecution'])
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+
+class DummySWFClient(object):
+    lock = threading.Lock()
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def respond_activity_task_completed(self, result, task_token):
+        self._call('completed', task_token, result)
+
+    def respond_activity_task_failed(self, reason, details, task_token):
+        self._call('failed', task_token, reason)
+
+    def record_activity_task_heartbeat(self, task_token):
+        self._call('heartbeat', task_token, None)
+
+    def _call(self, *args):
+        with self.lock:
+            self.calls.append(args)
+
+
+class TestCompletionGateway(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def gateway(self, **kwargs):
+        from flowy.gateway import CompletionGateway
+        gateway = CompletionGateway(lambda: DummySWFClient(self.calls),
+                                    **kwargs)
+        gateway.start()
+        return gateway
+
+    def test_concurrent_completions(self):
+        gateway = self.gateway(lanes=8)
+        for i in range(1000):
+            self.assertTrue(gateway.finish('t%s' % i, {'i': i}))
+        gateway.close()
+        self.assertEqual(len(self.calls), 1000)
+        self.assertEqual(sorted(self.calls)[0], ('completed', 't0',
+                                                 '{"i": 0}'))
+
+    def test_dedupe(self):
+        gateway = self.gateway(lanes=2)
+        self.assertTrue(gateway.finish('t', 1))
+        self.assertFalse(gateway.finish('t', 2))
+        self.assertFalse(gateway.fail('t', 'error'))
+        self.assertFalse(gateway.heartbeat('t'))
+        gateway.close()
+        self.assertEqual(self.calls, [('completed', 't', '1')])
+
+    def test_order_per_token(self):
+        gateway = self.gateway(lanes=4)
+        gateway.heartbeat('t')
+        gateway.fail('t', 'error')
+        gateway.close()
+        self.assertEqual(self.calls, [('heartbeat', 't', None),
+                                      ('failed', 't', 'error')])
+
+    def test_rate(self):
+        gateway = self.gateway(lanes=4, rate=100, burst=1)
+        started = time.time()
+        for i in range(11):
+            gateway.finish('t%s' % i, i)
+        gateway.close()
+        self.assertEqual(len(self.calls), 11)
+        self.assertTrue(time.time() - started >= 0.09)
+
+    def test_spool(self):
+        from flowy.gateway import spool
+        spool_dir = os.path.join(self.dir, 'spool')
+        os.makedirs(spool_dir)
+        spool(spool_dir, 't1', result=[1, 2])
+        spool(spool_dir, 't2', reason='error')
+        spool(spool_dir, 't1', result=3)
+        gateway = self.gateway(spool=spool_dir,
+                               outbox=os.path.join(self.dir, 'outbox'))
+        gateway.close()
+        self.assertEqual(sorted(self.calls), [('completed', 't1', '[1, 2]'),
+                                              ('failed', 't2', 'error')])
+        self.assertEqual(os.listdir(spool_dir), [])
@@ -0,0 +1,129 @@
+from unittest import TestCase
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(TestCase):
+
+    def test_rate(self):
+        from flowy.limits import TokenBucket
+        clock = Clock()
+        bucket = TokenBucket(2, clock=clock)
+        self.assertEqual(bucket.delay(), 0)
+        bucket.take()
+        self.assertEqual(bucket.delay(), 0.5)
+        clock.now = 0.25
+        self.assertEqual(bucket.delay(), 0.25)
+        clock.now = 0.5
+        self.assertEqual(bucket.delay(), 0)
+
+    def test_burst(self):
+        from flowy.limits import TokenBucket
+        clock = Clock()
+        bucket = TokenBucket(1, burst=3, clock=clock)
+        for _ in range(3):
+            self.assertEqual(bucket.delay(), 0)
+            bucket.take()
+        self.assertEqual(bucket.delay(), 1)
+        clock.now = 100
+        for _ in range(3):
+            bucket.take()
+        self.assertEqual(bucket.delay(), 1)
+
+
+class TestLimiter(TestCase):
+
+    def test_concurrency(self):
+        from flowy.limits import Limit, Limiter
+        limiter = Limiter({('export', 1): Limit(concurrency=2)})
+        limiter.start(('export', '1'))
+        self.assertEqual(limiter.delay(('export', '1')), 0)
+        limiter.start(('export', '1'))
+        self.assertEqual(limiter.delay(('export', '1')), None)
+        self.assertEqual(limiter.delay(('other', '1')), 0)
+        limiter.finish(('export', '1'))
+        self.assertEqual(limiter.delay(('export', '1')), 0)
+
+    def test_rate(self):
+        from flowy.limits import Limit, Limiter
+        clock = Clock()
+        limiter = Limiter({('export', 1): Limit(rate=4)}, clock=clock)
+        limiter.start(('export', 1))
+        limiter.finish(('export', 1))
+        self.assertEqual(limiter.delay(('export', 1)), 0.25)
+
+    def test_declared_limits(self):
+        from flowy.limits import Limit, Limiter, _limits
+        from flowy.scanner import swf_activity
+
+        @swf_activity(3, concurrency=1, name='declared')
+        class Declared(object):
+            pass
+
+        try:
+            limiter = Limiter()
+            limiter.start(('declared', '3'))
+            self.assertEqual(limiter.delay(('declared', '3')), None)
+            # the worker settings win
+            limiter = Limiter({('declared', 3): Limit(concurrency=2)})
+            limiter.start(('declared', '3'))
+            self.assertEqual(limiter.delay(('declared', '3')), 0)
+        finally:
+            del _limits[('declared', '3')]
+
+    def test_capacity(self):
+        from flowy.limits import Capacity, Limit, Limiter
+        limiter = Limiter({('big', 1): Limit(memory=3000, cpu=1),
+                           ('small', 1): Limit(memory=500, cpu=1)},
+                          capacity=Capacity(cpu=4, memory=4000))
+        limiter.start(('big', 1))
+        self.assertEqual(limiter.delay(('big', 1)), None)
+        self.assertEqual(limiter.delay(('small', 1)), 0)
+        self.assertEqual(limiter.delay(('other', 1)), 0)
+        limiter.start(('small', 1))
+        limiter.start(('small', 1))
+        self.assertEqual(limiter.delay(('small', 1)), None)
+        self.assertFalse(limiter.can_poll())
+        limiter.finish(('big', 1))
+        self.assertTrue(limiter.can_poll())
+        self.assertEqual(limiter.delay(('big', 1)), 0)
+
+    def test_poll_for_undeclared_needs(self):
+        from flowy.limits import Capacity, Limit, Limiter
+        limits = {('big', 1): Limit(cpu=4), ('unused', 1): Limit(cpu=1)}
+        # the unused activity fits but the worker doesn't run it
+        limiter = Limiter(limits, capacity=Capacity(cpu=5),
+                          spec_keys=[('big', 1)])
+        limiter.start(('big', 1))
+        self.assertFalse(limiter.can_poll())
+        limiter = Limiter(limits, capacity=Capacity(cpu=5),
+                          spec_keys=[('big', 1), ('small', 1)])
+        limiter.start(('big', 1))
+        self.assertEqual(limiter.delay(('small', 1)), 0)
+        self.assertTrue(limiter.can_poll())
+
+    def test_larger_than_capacity(self):
+        from flowy.limits import Capacity, Limit, Limiter
+        limiter = Limiter({('huge', 1): Limit(cpu=8)},
+                          capacity=Capacity(cpu=4))
+        self.assertEqual(limiter.delay(('huge', 1)), 0)
+        limiter.start(('other', 1))
+        self.assertEqual(limiter.delay(('huge', 1)), None)
+
+    def test_host_capacity(self):
+        from flowy.limits import host_capacity
+        capacity = host_capacity()
+        self.assertTrue(capacity.cpu >= 1)
+        self.assertTrue(capacity.memory > 0)
+
+    def test_invalid(self):
+        from flowy.limits import Limit
+        self.assertRaises(ValueError, Limit, concurrency=0)
+        self.assertRaises(ValueError, Limit, rate=0)
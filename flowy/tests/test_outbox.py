@@ -0,0 +1,196 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+
+class DummySWFError(Exception):
+
+    def __init__(self, error_code=None):
+        self.error_code = error_code
+
+
+class FlakySWFClient(object):
+
+    def __init__(self, failures=0, error_code=None):
+        self.failures = failures
+        self.error_code = error_code
+        self.calls = []
+
+    def respond_activity_task_completed(self, result, task_token):
+        self._call('completed', result, task_token)
+
+    def respond_activity_task_failed(self, reason, details, task_token):
+        self._call('failed', reason, task_token)
+
+    def respond_activity_task_canceled(self, task_token):
+        self._call('canceled', None, task_token)
+
+    def record_activity_task_heartbeat(self, task_token):
+        self._call('heartbeat', None, task_token)
+        return {'cancelRequested': True}
+
+    def _call(self, *args):
+        if self.failures:
+            self.failures -= 1
+            raise DummySWFError(self.error_code)
+        self.calls.append(args)
+
+
+class TestOutbox(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_recover(self):
+        from flowy.outbox import Outbox
+        dead = Outbox(self.dir)
+        first = dead.append('respond_activity_task_completed', {'a': 1})
+        dead.append('respond_activity_task_completed', {'b': 2})
+        dead.ack(first['id'])
+        running = Outbox(self.dir)
+        other = Outbox(self.dir)
+        self.assertEqual(other.recover(), [])
+        dead.close()
+        records = running.recover()
+        self.assertEqual([r['kwargs'] for r in records], [{'b': 2}])
+        self.assertEqual(len(os.listdir(self.dir)), 2)
+        # the records taken over are journaled again
+        running.close()
+        records = other.recover()
+        self.assertEqual([r['kwargs'] for r in records], [{'b': 2}])
+        other.close()
+
+    def test_compact(self):
+        from flowy.outbox import Outbox
+        outbox = Outbox(self.dir)
+        outbox.compact_size = 10
+        record = outbox.append('respond_activity_task_completed', {})
+        outbox.ack(record['id'])
+        self.assertEqual(os.path.getsize(outbox._path), 0)
+        outbox.close()
+
+
+class TestCompletionSender(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_retry(self):
+        from flowy.outbox import CompletionSender, Outbox
+        client = FlakySWFClient(failures=2)
+        sender = CompletionSender(client, Outbox(self.dir), backoff=0.01)
+        sender.start()
+        sender.respond_activity_task_completed(result='1', task_token='t')
+        deadline = time.time() + 5
+        while not client.calls and time.time() < deadline:
+            time.sleep(0.01)
+        sender.close()
+        self.assertEqual(client.calls, [('completed', '1', 't')])
+        self.assertEqual(Outbox(self.dir).recover(), [])
+
+    def test_permanent_error(self):
+        from flowy.outbox import CompletionSender, Outbox
+        client = FlakySWFClient(failures=1, error_code='UnknownResourceFault')
+        sender = CompletionSender(client, Outbox(self.dir), backoff=0.01)
+        sender.start()
+        sender.respond_activity_task_failed(reason='r', details=None,
+                                            task_token='t')
+        sender.close()
+        self.assertEqual(client.calls, [])
+        self.assertEqual(Outbox(self.dir).recover(), [])
+
+    def test_replay_unsent(self):
+        from flowy.outbox import CompletionSender, Outbox
+        client = FlakySWFClient(failures=100)
+        sender = CompletionSender(client, Outbox(self.dir), retries=1,
+                                  backoff=0.01)
+        sender.start()
+        sender.respond_activity_task_completed(result='1', task_token='t')
+        sender.close()
+        client = FlakySWFClient()
+        sender = CompletionSender(client, Outbox(self.dir))
+        sender.start()
+        sender.close()
+        self.assertEqual(client.calls, [('completed', '1', 't')])
+
+    def test_heartbeat_response(self):
+        from flowy.outbox import CompletionSender
+        client = FlakySWFClient()
+        sender = CompletionSender(client)
+        sender.start()
+        response = sender.record_activity_task_heartbeat(task_token='t')
+        self.assertEqual(response, {'cancelRequested': True})
+        sender.respond_activity_task_canceled(task_token='t')
+        sender.close()
+        self.assertEqual(client.calls, [('heartbeat', None, 't'),
+                                        ('canceled', None, 't')])
+
+    def test_heartbeats_not_retried(self):
+        from flowy.outbox import CompletionSender
+        client = FlakySWFClient(failures=1)
+        sender = CompletionSender(client, backoff=0.01)
+        sender.start()
+        sender.queue_heartbeat(task_token='t')
+        sender.queue_heartbeat(task_token='t')
+        sender.close()
+        self.assertTrue(len(client.calls) <= 1)
+
+
+class FlakyDecisionClient(object):
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.calls = []
+
+    def respond_decision_task_completed(self, task_token, decisions):
+        if task_token in self.fail:
+            self.fail.remove(task_token)
+            raise DummySWFError()
+        self.calls.append(task_token)
+
+
+class TestDecisionSender(TestCase):
+
+    def test_order_per_workflow(self):
+        from flowy.outbox import DecisionSender
+        client = FlakyDecisionClient(fail=['a1'])
+        sender = DecisionSender(lambda: client, lanes=1, backoff=0.05)
+        sender.start()
+        sender.bind('a').respond_decision_task_completed(
+            task_token='a1', decisions=[])
+        # sent while a1 waits for its retry
+        deadline = time.time() + 5
+        while client.fail and time.time() < deadline:
+            time.sleep(0.001)
+        sender.bind('a').respond_decision_task_completed(
+            task_token='a2', decisions=[])
+        sender.bind('b').respond_decision_task_completed(
+            task_token='b1', decisions=[])
+        deadline = time.time() + 5
+        while len(client.calls) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        sender.close()
+        self.assertEqual(client.calls, ['b1', 'a1', 'a2'])
+
+    def test_close_sends_waiting(self):
+        from flowy.outbox import DecisionSender
+        client = FlakyDecisionClient(fail=['a1'])
+        sender = DecisionSender(lambda: client, lanes=2, backoff=60)
+        sender.start()
+        sender.bind('a').respond_decision_task_completed(
+            task_token='a1', decisions=[])
+        deadline = time.time() + 5
+        while client.fail and time.time() < deadline:
+            time.sleep(0.001)
+        sender.bind('a').respond_decision_task_completed(
+            task_token='a2', decisions=[])
+        sender.close()
+        self.assertEqual(client.calls, ['a1', 'a2'])
@@ -0,0 +1,234 @@
+from unittest import TestCase
+
+
+class TestParseEvents(TestCase):
+
+    def parse(self, *events):
+        from flowy.poller import SWFWorkflowPoller
+        poller = SWFWorkflowPoller(None, 'task_list', None)
+        events = [dict(e, eventId=i) for i, e in enumerate(events, 1)]
+        keys = ('running', 'timedout', 'results', 'errors', 'order',
+                'cancelled', 'children', 'signals', 'markers', 'fresh')
+        return dict(zip(keys, poller._parse_events(iter(events))))
+
+    def scheduled(self, id, control=None):
+        attrs = {'activityId': id}
+        if control is not None:
+            attrs['control'] = control
+        return {'eventType': 'ActivityTaskScheduled',
+                'activityTaskScheduledEventAttributes': attrs}
+
+    def completed(self, event_id, result):
+        return {'eventType': 'ActivityTaskCompleted',
+                'activityTaskCompletedEventAttributes': {
+                    'scheduledEventId': event_id, 'result': result}}
+
+    def failed(self, event_id, reason, details=None):
+        return {'eventType': 'ActivityTaskFailed',
+                'activityTaskFailedEventAttributes': {
+                    'scheduledEventId': event_id, 'reason': reason,
+                    'details': details}}
+
+    def test_fused_running(self):
+        state = self.parse(self.scheduled('3', control='[3, 4, 5]'))
+        self.assertEqual(state['running'], set(['3', '4', '5']))
+
+    def test_fused_results_per_step(self):
+        state = self.parse(
+            self.scheduled('3', control='[3, 4]'),
+            self.completed(1, '["a", "b"]'))
+        self.assertEqual(state['running'], set())
+        self.assertEqual(state['results'], {'3': 'a', '4': 'b'})
+        self.assertEqual(state['order'], ['3', '4'])
+
+    def test_fused_failed_step(self):
+        state = self.parse(
+            self.scheduled('3', control='[3, 4, 5]'),
+            self.failed(1, 'err', details='["a"]'))
+        self.assertEqual(state['running'], set())
+        self.assertEqual(state['results'], {'3': 'a'})
+        self.assertEqual(state['errors'], {'4': 'err'})
+        self.assertEqual(state['order'], ['3', '4'])
+
+    def test_given_up_timed_out(self):
+        from flowy.task import TIMEOUT_REASON_PREFIX
+        state = self.parse(
+            self.scheduled('3'),
+            self.scheduled('4', control='[4, 5]'),
+            self.failed(1, TIMEOUT_REASON_PREFIX + 'late'),
+            self.failed(2, TIMEOUT_REASON_PREFIX + 'late'))
+        self.assertEqual(state['running'], set())
+        self.assertEqual(state['timedout'], set(['3', '4', '5']))
+        self.assertEqual(state['errors'], {})
+        self.assertEqual(state['order'], ['3', '4', '5'])
+
+    def test_activity_cancel_requested(self):
+        state = self.parse(
+            self.scheduled('3'),
+            {'eventType': 'ActivityTaskCancelRequested',
+             'activityTaskCancelRequestedEventAttributes': {
+                 'activityId': '3'}})
+        self.assertEqual(state['running'], set(['3']))
+        self.assertEqual(state['cancelled'], set(['3']))
+
+    def test_activity_canceled(self):
+        state = self.parse(
+            self.scheduled('3'),
+            {'eventType': 'ActivityTaskCanceled',
+             'activityTaskCanceledEventAttributes': {
+                 'scheduledEventId': 1}})
+        self.assertEqual(state['running'], set())
+        self.assertEqual(state['cancelled'], set(['3']))
+
+    def test_child_workflow_ids(self):
+        state = self.parse(
+            {'eventType': 'StartChildWorkflowExecutionInitiated',
+             'startChildWorkflowExecutionInitiatedEventAttributes': {
+                 'workflowId': 'abc-3'}},
+            {'eventType': 'RequestCancelExternalWorkflowExecutionInitiated',
+             'requestCancelExternalWorkflowExecutionInitiatedEventAttributes':
+                 {'workflowId': 'abc-3'}})
+        self.assertEqual(state['children'], {'3': 'abc-3'})
+        self.assertEqual(state['cancelled'], set(['3']))
+
+    def test_shared_timer(self):
+        state = self.parse(
+            {'eventType': 'TimerStarted',
+             'timerStartedEventAttributes': {
+                 'timerId': '0', 'control': '[0, 4]'}},
+            {'eventType': 'TimerStarted',
+             'timerStartedEventAttributes': {'timerId': '2'}},
+            {'eventType': 'TimerFired',
+             'timerFiredEventAttributes': {'timerId': '0'}})
+        self.assertEqual(state['running'], set(['2']))
+        self.assertEqual(state['results'], {'0': None, '4': None})
+
+    def test_signals(self):
+        state = self.parse(
+            self.scheduled('3'),
+            {'eventType': 'WorkflowExecutionSignaled',
+             'workflowExecutionSignaledEventAttributes': {
+                 'signalName': 'go', 'input': '1'}},
+            self.completed(1, '"a"'),
+            {'eventType': 'WorkflowExecutionSignaled',
+             'workflowExecutionSignaledEventAttributes': {
+                 'signalName': 'go'}})
+        self.assertEqual(state['signals'], {'go': ['1', None]})
+        self.assertEqual(state['order'], [('go', 0), '3', ('go', 1)])
+
+    def test_latest_marker(self):
+        marker = 'markerRecordedEventAttributes'
+        state = self.parse(
+            {'eventType': 'MarkerRecorded',
+             marker: {'markerName': 'sum', 'details': '1'}},
+            {'eventType': 'MarkerRecorded',
+             marker: {'markerName': 'sum', 'details': '2'}})
+        self.assertEqual(state['markers'], {'sum': '2'})
+
+    def test_cached_result(self):
+        state = self.parse(
+            {'eventType': 'MarkerRecorded',
+             'markerRecordedEventAttributes': {
+                 'markerName': 'flowy.cache.4', 'details': '"a"'}})
+        self.assertEqual(state['results'], {'4': '"a"'})
+        self.assertEqual(state['order'], ['4'])
+        self.assertEqual(state['markers'], {})
+
+    def test_fresh_results(self):
+        state = self.parse(
+            self.scheduled('3'),
+            self.scheduled('4'),
+            self.completed(1, '"a"'),
+            {'eventType': 'DecisionTaskCompleted',
+             'decisionTaskCompletedEventAttributes': {'startedEventId': 0}},
+            self.completed(2, '"b"'),
+            {'eventType': 'MarkerRecorded',
+             'markerRecordedEventAttributes': {
+                 'markerName': 'flowy.cache.8', 'details': '"c"'}})
+        self.assertEqual(state['fresh'], set(['4']))
+
+    def test_cancelled_delay(self):
+        state = self.parse(
+            {'eventType': 'TimerStarted',
+             'timerStartedEventAttributes': {'timerId': '0'}},
+            {'eventType': 'MarkerRecorded',
+             'markerRecordedEventAttributes': {
+                 'markerName': 'flowy.cancel.0'}})
+        self.assertEqual(state['running'], set(['0']))
+        self.assertEqual(state['cancelled'], set(['0']))
+        self.assertEqual(state['markers'], {})
+
+    def test_cached_result_where_decided(self):
+        state = self.parse(
+            self.scheduled('3'),
+            {'eventType': 'DecisionTaskStarted'},
+            self.completed(1, '"b"'),
+            {'eventType': 'DecisionTaskCompleted',
+             'decisionTaskCompletedEventAttributes': {'startedEventId': 2}},
+            {'eventType': 'MarkerRecorded',
+             'markerRecordedEventAttributes': {
+                 'markerName': 'flowy.cache.4', 'details': '"a"',
+                 'decisionTaskCompletedEventId': 4}},
+            {'eventType': 'MarkerRecorded',
+             'markerRecordedEventAttributes': {
+                 'markerName': 'flowy.cache.8', 'details': '"c"',
+                 'decisionTaskCompletedEventId': 4}})
+        self.assertEqual(state['order'], ['4', '8', '3'])
+
+
+class DummyRegistry(object):
+
+    def start_to_close(self, spec_key):
+        return 30
+
+
+class TestActivityPollerTimeouts(TestCase):
+
+    def scheduled_input(self, spec, input='[[], {}]'):
+        from boto.swf.layer1_decisions import Layer1Decisions
+        decisions = Layer1Decisions()
+        spec.schedule(decisions, 0, input)
+        SATDA = 'scheduleActivityTaskDecisionAttributes'
+        return decisions._data[0][SATDA]['input']
+
+    def start_to_close(self, spec):
+        from flowy.poller import SWFActivityPoller
+        poller = SWFActivityPoller('domain', 'list', None, None,
+                                   DummyRegistry())
+        return poller.start_to_close(('a', '1'), self.scheduled_input(spec))
+
+    def test_registered_default(self):
+        from flowy.spec import SWFActivitySpec
+        self.assertEqual(self.start_to_close(SWFActivitySpec('a', 1)), 30)
+
+    def test_scheduled_timeout(self):
+        from flowy.spec import SWFActivitySpec
+        spec = SWFActivitySpec('a', 1, start_to_close=5)
+        self.assertEqual(self.scheduled_input(spec), '[[], {}]')
+        self.assertEqual(self.start_to_close(spec), 30)
+
+    def test_fused_sum(self):
+        from flowy.spec import SWFActivitySpec, SWFFusedActivitySpec
+        spec = SWFFusedActivitySpec([
+            SWFActivitySpec('a', 1, start_to_close=5),
+            SWFActivitySpec('b', 1, start_to_close=10)])
+        self.assertEqual(self.start_to_close(spec), 15)
+
+    def test_fused_unknown(self):
+        from flowy.spec import SWFActivitySpec, SWFFusedActivitySpec
+        spec = SWFFusedActivitySpec([
+            SWFActivitySpec('a', 1, start_to_close=5),
+            SWFActivitySpec('b', 1)])
+        self.assertEqual(self.start_to_close(spec), None)
+
+    def test_fused_input_unwrapped(self):
+        from flowy.poller import SWFActivityPoller
+        from flowy.spec import SWFActivitySpec, SWFFusedActivitySpec
+        spec = SWFFusedActivitySpec([
+            SWFActivitySpec('a', 1, start_to_close=5),
+            SWFActivitySpec('b', 1, start_to_close=10)])
+        input = self.scheduled_input(spec, '[[1], {}]')
+        poller = SWFActivityPoller('domain', 'list', None, None,
+                                   lambda spec_key, input, **kwargs: input)
+        task = poller.build_task(('a', '1'), input, 'token')
+        self.assertEqual(task._input, '[[1], {}]')
@@ -0,0 +1,76 @@
+from unittest import TestCase
+
+
+class Scoring(object):
+    setups = 0
+    teardowns = 0
+
+    def __init__(self, input, token):
+        self.input = input
+        self.token = token
+
+    def setup(self):
+        Scoring.setups += 1
+        self.model = object()
+
+    def teardown(self):
+        Scoring.teardowns += 1
+
+    def __call__(self):
+        return self.model, self.input
+
+
+class TestInstancePool(TestCase):
+
+    def setUp(self):
+        Scoring.setups = Scoring.teardowns = 0
+
+    def test_reuse_instance(self):
+        from flowy.scanner import InstancePool
+        pool = InstancePool(Scoring)
+        first = pool(input='a', token='t1')
+        model, input = first()
+        self.assertEqual(input, 'a')
+        second = pool(input='b', token='t2')
+        self.assertTrue(second is first)
+        self.assertEqual(second(), (model, 'b'))
+        self.assertEqual(second.token, 't2')
+        self.assertEqual(Scoring.setups, 1)
+
+    def test_registry_setup_teardown(self):
+        from flowy.scanner import InstancePool, TaskRegistry
+        registry = TaskRegistry()
+        registry.add('scoring', InstancePool(Scoring))
+        registry.add('other', Scoring)
+        registry.setup()
+        self.assertEqual(Scoring.setups, 1)
+        registry('scoring', input='a', token='t')
+        self.assertEqual(Scoring.setups, 1)
+        registry.teardown()
+        self.assertEqual(Scoring.teardowns, 1)
+        # a new instance is set up after a teardown
+        registry('scoring', input='a', token='t')
+        self.assertEqual(Scoring.setups, 2)
+
+    def test_not_pooled(self):
+        from flowy.scanner import TaskRegistry
+        registry = TaskRegistry()
+        registry.add('other', Scoring)
+        task = registry('other', input='a', token='t')
+        self.assertFalse(task is registry('other', input='a', token='t'))
+        self.assertEqual(Scoring.setups, 0)
+
+
+class TestStartToClose(TestCase):
+
+    def test_start_to_close(self):
+        from flowy.scanner import TaskRegistry
+        from flowy.spec import SWFActivitySpec, SWFSpecKey
+        registry = TaskRegistry()
+        registry.add(SWFActivitySpec('a', 1, start_to_close=30), Scoring)
+        registry.add(SWFActivitySpec('b', 1), Scoring)
+        self.assertEqual(registry.start_to_close(SWFSpecKey('a', 1)), 30)
+        self.assertEqual(registry.start_to_close(SWFSpecKey('b', 1)), None)
+        self.assertEqual(registry.start_to_close(SWFSpecKey('c', 1)), None)
+        self.assertEqual(sorted(registry.spec_keys()),
+                         [SWFSpecKey('a', 1), SWFSpecKey('b', 1)])
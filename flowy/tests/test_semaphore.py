@@ -0,0 +1,249 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase, skipIf
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+try:
+    import fakeredis
+    import lupa
+except ImportError:  # pragma: no cover
+    fakeredis = lupa = None
+
+
+class DummySWFClient(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def respond_activity_task_completed(self, result, task_token):
+        self.calls.append(('completed', result))
+
+    def respond_activity_task_failed(self, reason, details, task_token):
+        self.calls.append(('failed', reason))
+
+    def record_activity_task_heartbeat(self, task_token):
+        self.calls.append(('heartbeat',))
+
+
+class TestSQLiteSemaphoreStore(TestCase):
+
+    def setUp(self):
+        from flowy.semaphore import SQLiteSemaphoreStore
+        self.dir = tempfile.mkdtemp()
+        self.store = SQLiteSemaphoreStore(os.path.join(self.dir, 'db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_limit(self):
+        self.assertTrue(self.store.acquire('s', 'a', 2, 60))
+        self.assertTrue(self.store.acquire('s', 'b', 2, 60))
+        self.assertFalse(self.store.acquire('s', 'c', 2, 60))
+        # acquiring again only extends the lease
+        self.assertTrue(self.store.acquire('s', 'a', 2, 60))
+        self.assertTrue(self.store.acquire('other', 'c', 2, 60))
+        self.store.release('s', 'a')
+        self.assertTrue(self.store.acquire('s', 'c', 2, 60))
+
+    def test_lease_expires(self):
+        self.assertTrue(self.store.acquire('s', 'a', 1, 0.05))
+        self.assertFalse(self.store.acquire('s', 'b', 1, 60))
+        self.assertTrue(self.store.renew('s', 'a', 0.05))
+        time.sleep(0.1)
+        self.assertFalse(self.store.renew('s', 'a', 60))
+        self.assertTrue(self.store.acquire('s', 'b', 1, 60))
+
+    def test_take(self):
+        self.assertEqual(self.store.take('r', 10, 2), 0)
+        self.assertEqual(self.store.take('r', 10, 2), 0)
+        delay = self.store.take('r', 10, 2)
+        self.assertTrue(0 < delay <= 0.1)
+        self.assertEqual(self.store.take('other', 10, 1), 0)
+
+
+class RedisSemaphoreStoreTests(object):
+
+    def setUp(self):
+        from flowy.semaphore import RedisSemaphoreStore
+        client = self.make_client()
+        self.store = RedisSemaphoreStore(client, prefix='flowy.test.')
+        self.addCleanup(client.delete, 'flowy.test.s', 'flowy.test.rate.r',
+                        'flowy.test.rate.other')
+
+    def test_limit(self):
+        self.assertTrue(self.store.acquire('s', 'a', 2, 60))
+        self.assertTrue(self.store.acquire('s', 'b', 2, 60))
+        self.assertFalse(self.store.acquire('s', 'c', 2, 60))
+        # acquiring again only extends the lease
+        self.assertTrue(self.store.acquire('s', 'a', 2, 60))
+        self.assertTrue(self.store.renew('s', 'a', 60))
+        self.store.release('s', 'a')
+        self.assertFalse(self.store.renew('s', 'a', 60))
+        self.assertTrue(self.store.acquire('s', 'c', 2, 60))
+
+    def test_lease_expires(self):
+        self.assertTrue(self.store.acquire('s', 'a', 1, 0.05))
+        self.assertFalse(self.store.acquire('s', 'b', 1, 60))
+        self.assertTrue(self.store.renew('s', 'a', 0.05))
+        time.sleep(0.1)
+        self.assertFalse(self.store.renew('s', 'a', 60))
+        self.assertTrue(self.store.acquire('s', 'b', 1, 60))
+
+    def test_take(self):
+        self.assertEqual(self.store.take('r', 10, 2), 0)
+        self.assertEqual(self.store.take('r', 10, 2), 0)
+        self.assertTrue(0 < self.store.take('r', 10, 2) <= 0.1)
+        self.assertEqual(self.store.take('other', 10, 1), 0)
+
+
+@skipIf(fakeredis is None, 'fakeredis with lupa is not installed')
+class TestRedisSemaphoreStore(RedisSemaphoreStoreTests, TestCase):
+    """ Runs the scripts on fakeredis, its Lua is run by lupa. """
+
+    def make_client(self):
+        return fakeredis.FakeStrictRedis()
+
+
+@skipIf(redis is None, 'redis is not installed')
+class TestRedisServerSemaphoreStore(RedisSemaphoreStoreTests, TestCase):
+    """ The same tests on a real server, when one is available. """
+
+    def make_client(self):
+        url = os.environ.get('FLOWY_TEST_REDIS', 'redis://localhost:6379/15')
+        client = redis.Redis.from_url(url)
+        try:
+            client.ping()
+        except redis.ConnectionError:
+            self.skipTest('no Redis server at %s' % url)
+        return client
+
+
+class TestAcquireAll(TestCase):
+
+    def setUp(self):
+        from flowy.semaphore import SQLiteSemaphoreStore
+        self.dir = tempfile.mkdtemp()
+        self.store = SQLiteSemaphoreStore(os.path.join(self.dir, 'db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_timeout_releases(self):
+        from flowy.semaphore import Semaphore, acquire_all
+        a = Semaphore('a', 1, poll=0.01, store=self.store)
+        b = Semaphore('b', 1, poll=0.01, store=self.store)
+        self.assertEqual(acquire_all([b], 'other'), [b])
+        beats = []
+        self.assertEqual(acquire_all([b, a], 'me', lambda: beats.append(1),
+                                     timeout=0.05, interval=0.01), None)
+        self.assertTrue(beats)
+        # a was released
+        self.assertEqual(acquire_all([a], 'third'), [a])
+
+    def test_activity(self):
+        from flowy.semaphore import RateLimit, Semaphore
+        from flowy.task import SWFActivity
+        store = self.store
+
+        class Charge(SWFActivity):
+            semaphores = [RateLimit('partner', 100, store=store),
+                          Semaphore('partner', 1, store=store)]
+
+            def run(self, x):
+                self.heartbeat()
+                return store.acquire('partner', 'other', 1, 60)
+
+        client = DummySWFClient()
+        Charge(client, '[[1], {}]', 'token')()
+        self.assertEqual(client.calls, [('heartbeat',),
+                                        ('completed', 'false')])
+        self.assertTrue(store.acquire('partner', 'other', 1, 60))
+
+    def test_activity_timeout(self):
+        from flowy.semaphore import Semaphore
+        from flowy.task import SWFActivity, TIMEOUT_REASON_PREFIX
+        self.store.acquire('partner', 'other', 1, 60)
+        store = self.store
+
+        class Charge(SWFActivity):
+            semaphores = [Semaphore('partner', 1, poll=0.01, store=store)]
+            semaphore_timeout = 0.05
+
+            def run(self):
+                return 1
+
+        client = DummySWFClient()
+        Charge(client, '[[], {}]', 'token')()
+        self.assertEqual(client.calls[-1], (
+            'failed', TIMEOUT_REASON_PREFIX
+            + 'Timed out waiting for the semaphores.'))
+
+    def test_activity_store_error(self):
+        from flowy.semaphore import Semaphore
+        from flowy.task import SWFActivity, TIMEOUT_REASON_PREFIX
+
+        class BrokenStore(object):
+            def acquire(self, name, holder, limit, lease):
+                raise IOError('unreachable')
+
+        class Charge(SWFActivity):
+            semaphores = [Semaphore('partner', 1, store=BrokenStore())]
+
+            def run(self):
+                return 1
+
+        client = DummySWFClient()
+        self.assertFalse(Charge(client, '[[], {}]', 'token')())
+        self.assertEqual(client.calls, [
+            ('failed', TIMEOUT_REASON_PREFIX
+             + 'Error while acquiring the semaphores: unreachable')])
+
+    def test_activity_without_store(self):
+        from flowy.semaphore import Semaphore
+        from flowy.task import SWFActivity, TIMEOUT_REASON_PREFIX
+
+        class Charge(SWFActivity):
+            semaphores = [Semaphore('partner', 1)]
+
+            def run(self):
+                return 1
+
+        client = DummySWFClient()
+        Charge(client, '[[], {}]', 'token')()
+        self.assertEqual(client.calls, [
+            ('failed', TIMEOUT_REASON_PREFIX
+             + 'Error while acquiring the semaphores: '
+               'No semaphore store is set.')])
+
+    def test_fused_steps(self):
+        from flowy.semaphore import Semaphore
+        from flowy.task import SWFActivity, SWFFusedActivity
+        store = self.store
+
+        class Charge(SWFActivity):
+            semaphores = [Semaphore('partner', 1, store=store)]
+
+            def run(self, x):
+                return x + 1
+
+        class Notify(SWFActivity):
+            semaphores = [Semaphore('mail', 1, store=store)]
+
+            def run(self, x):
+                self.heartbeat()
+                return (store.acquire('partner', 'other', 1, 60)
+                        or store.acquire('mail', 'other', 1, 60))
+
+        client = DummySWFClient()
+        steps = [Charge(client, None, 'token'), Notify(client, None, 'token')]
+        SWFFusedActivity(client, '[[1], {}]', 'token', steps)()
+        self.assertEqual(client.calls, [('heartbeat',),
+                                        ('completed', '["2", "false"]')])
+        self.assertTrue(store.acquire('partner', 'other', 1, 60))
+        self.assertTrue(store.acquire('mail', 'other', 1, 60))
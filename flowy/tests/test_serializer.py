@@ -0,0 +1,143 @@
+from unittest import TestCase, skipIf
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class TestSerializers(TestCase):
+
+    def roundtrip(self, serializer, value):
+        from flowy.serializer import loads
+        return loads(serializer.dumps(value))
+
+    def test_json_untagged(self):
+        from flowy.serializer import JSONSerializer
+        serializer = JSONSerializer()
+        self.assertEqual(serializer.dumps([1, 'a']), '[1, "a"]')
+        self.assertEqual(self.roundtrip(serializer, {'a': [1]}), {'a': [1]})
+
+    def test_untagged_read_by_json(self):
+        import math
+        from flowy.serializer import loads
+        self.assertTrue(math.isnan(loads('NaN')))
+        self.assertEqual(loads('[Infinity, 18446744073709551616]'),
+                         [float('inf'), 2 ** 64])
+
+    @skipIf(orjson is None, 'orjson is not installed')
+    def test_orjson(self):
+        from flowy.serializer import get_serializer
+        serializer = get_serializer('orjson')
+        self.assertEqual(serializer.dumps([1, 'a']), '@orjson:[1,"a"]')
+        self.assertEqual(self.roundtrip(serializer, {'a': [1]}), {'a': [1]})
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        from flowy.serializer import get_serializer
+        serializer = get_serializer('msgpack')
+        self.assertTrue(serializer.dumps([1]).startswith('@msgpack:'))
+        self.assertEqual(self.roundtrip(serializer, {'a': [1]}), {'a': [1]})
+
+    def test_pickle_must_be_trusted(self):
+        from flowy.serializer import loads, PickleSerializer
+        data = PickleSerializer().dumps(set([1]))
+        self.assertTrue(data.startswith('@pickle:'))
+        self.assertRaises(ValueError, loads, data)
+
+    def test_pickle_trusted(self):
+        from flowy.serializer import _serializers, register_serializer
+        from flowy.serializer import PickleSerializer
+        register_serializer(PickleSerializer())
+        try:
+            self.assertEqual(self.roundtrip(PickleSerializer(), set([1])),
+                             set([1]))
+        finally:
+            del _serializers['pickle']
+
+    def test_unknown(self):
+        from flowy.serializer import get_serializer
+        self.assertRaises(ValueError, get_serializer, 'unknown')
+
+
+@skipIf(numpy is None, 'numpy is not installed')
+class TestNumpySerializer(TestCase):
+
+    def roundtrip(self, value, **kwargs):
+        from flowy.serializer import loads, NumpySerializer
+        return loads(NumpySerializer(**kwargs).dumps(value))
+
+    def test_arrays(self):
+        array = numpy.arange(12, dtype='float32').reshape(3, 4)
+        value = self.roundtrip({'a': array, 'n': numpy.int64(3)})
+        self.assertEqual(value['n'], 3)
+        self.assertEqual(value['a'].dtype, array.dtype)
+        self.assertTrue((value['a'] == array).all())
+
+    def test_compressed(self):
+        from flowy.serializer import NumpySerializer
+        array = numpy.zeros(1000)
+        data = NumpySerializer(codec='zlib').dumps(array)
+        self.assertTrue(len(data) < array.nbytes / 10)
+        self.assertTrue((self.roundtrip(array, codec='zlib') == 0).all())
+
+    def test_memory_mapped_from_blob_store(self):
+        import mmap
+        import shutil
+        import tempfile
+        from flowy.blob import LocalBlobStore, set_blob_store
+        path = tempfile.mkdtemp()
+        set_blob_store(LocalBlobStore(path), threshold=100)
+        try:
+            array = numpy.arange(100)
+            decoded = self.roundtrip(array)
+            self.assertTrue((decoded == array).all())
+            base = decoded
+            while isinstance(base, numpy.ndarray):
+                base = base.base
+            self.assertTrue(isinstance(base.obj, mmap.mmap))
+        finally:
+            set_blob_store(None)
+            shutil.rmtree(path)
+
+    def test_object_arrays(self):
+        from flowy.serializer import NumpySerializer
+        array = numpy.array([object()])
+        self.assertRaises(TypeError, NumpySerializer().dumps, array)
+
+
+class TestProxySerializer(TestCase):
+
+    def test_serializer_by_object(self):
+        from flowy.proxy import SWFActivityProxy
+        from flowy.serializer import PickleSerializer, register_serializer
+        from flowy.serializer import _serializers
+        from flowy.task import _SWFWorkflow
+        from flowy.tests.test_task import DummyScheduler
+
+        class MyWorkflow(_SWFWorkflow):
+            a = SWFActivityProxy('a', 1, serializer=PickleSerializer())
+
+            def run(self):
+                return self.a(set([1]))
+
+        scheduler = DummyScheduler()
+        MyWorkflow(scheduler, '[[], {}]', 'token', [], [], {}, {}, [], None,
+                   None)()
+        input = scheduler.state[0][3]
+        register_serializer(PickleSerializer())
+        try:
+            self.assertEqual(MyWorkflow._deserialize_arguments(input),
+                             [[set([1])], {}])
+        finally:
+            del _serializers['pickle']
@@ -18,15 +18,30 @@ class DummyScheduler(object):
     def complete(self, result):
         self.state.append(('COMPLETE', result))
 
-    def schedule_timer(self, delay, call_id):
+    def schedule_timer(self, delay, call_id, shared=True):
         self.state.append(('TIMER', delay, call_id))
 
     def schedule_activity(self, spec, call_id, input):
         self.state.append(('ACTIVITY', spec, call_id, input))
 
-    def schedule_workflow(self, spec, call_id, input):
+    def schedule_workflow(self, spec, call_id, input, id_prefix=None):
         self.state.append(('WORKFLOW', spec, call_id, input))
 
+    def cancel_timer(self, call_id):
+        self.state.append(('CANCEL_TIMER', call_id))
+
+    def cancel_activity(self, call_id):
+        self.state.append(('CANCEL_ACTIVITY', call_id))
+
+    def cancel_delay(self, call_id):
+        self.state.append(('CANCEL_DELAY', call_id))
+
+    def record_marker(self, name, details):
+        self.state.append(('MARKER', name, details))
+
+    def cancel_workflow(self, workflow_id):
+        self.state.append(('CANCEL_WORKFLOW', workflow_id))
+
 
 class TestWorkflowScheduling(TestCase):
 
@@ -45,14 +60,20 @@ class TestWorkflowScheduling(TestCase):
         self.TIMEDOUT = self.workflow._TIMEDOUT
         self.state = []
 
-    def schedule_activity(self, spec, input='i', retry=0, delay=0):
-        r = self.workflow.schedule_activity(spec, input, retry, delay)
+    def schedule_activity(self, spec, input='i', retry=0, delay=0,
+                          **kwargs):
+        r = self.workflow.schedule_activity(spec, input, retry, delay,
+                                            **kwargs)
         self.state.append(r)
 
     def schedule_workflow(self, spec, input='i', retry=0, delay=0):
         r = self.workflow.schedule_workflow(spec, input, retry, delay)
         self.state.append(r)
 
+    def schedule_fused(self, spec, input='i', retry=0, delay=0):
+        r = self.workflow.schedule_fused(spec, input, retry, delay)
+        self.state.append(r)
+
     def assert_state(self, *state):
         self.assertEquals(list(state), self.state)
 
@@ -294,15 +315,176 @@ class TestWorkflowScheduling(TestCase):
         self.assert_scheduled()
 
 
+    # FUSED
+
+    def test_fused_reserves_call_ids_for_each_step(self):
+        self.set_state()
+        self.schedule_fused(spec='ab', input='in1', retry=2, delay=0)
+        self.schedule_activity(spec='c', input='in2', retry=0, delay=0)
+        self.assert_scheduled(
+            ('ACTIVITY', 'ab', 0, 'in1'),  # 2 steps for the call + 2 retries
+            ('ACTIVITY', 'c', 6, 'in2'),
+        )
+
+    def test_fused_result_of_last_step(self):
+        self.set_state(results={0: 'a', 1: 'b'})
+        self.schedule_fused(spec='ab', input='in1', retry=0, delay=0)
+        self.assert_state(
+            (self.FOUND, 'b', 1),
+        )
+        self.assert_scheduled()
+
+    def test_fused_error_in_a_step(self):
+        self.set_state(results={0: 'a'}, errors={1: 'err'})
+        self.schedule_fused(spec='ab', input='in1', retry=0, delay=0)
+        self.assert_state(
+            (self.ERROR, 'err', 1),
+        )
+
+    def test_fused_timeout_and_reschedule(self):
+        self.set_state(timedout=[0, 1])
+        self.schedule_fused(spec='ab', input='in1', retry=1, delay=0)
+        self.assert_scheduled(
+            ('ACTIVITY', 'ab', 2, 'in1'),
+        )
+
+
+    # HEDGE
+
+    def test_hedge_timer_with_first_attempt(self):
+        self.set_state()
+        self.schedule_activity(spec='a1', input='in1', retry=1,
+                               hedge_after=5)
+        self.schedule_activity(spec='a2', input='in2')
+        self.assert_state(
+            (self.RUNNING, None, None),
+            (self.RUNNING, None, None),
+        )
+        self.assert_scheduled(
+            ('ACTIVITY', 'a1', 0, 'in1'),  # 2 attempts, a timer, a duplicate
+            ('TIMER', 5, 2),
+            ('ACTIVITY', 'a2', 4, 'in2'),
+        )
+
+    def test_hedge_duplicate_after_timer(self):
+        self.set_state(running=[0], results={1: None})
+        self.schedule_activity(spec='a1', input='in1', hedge_after=5)
+        self.assert_state(
+            (self.RUNNING, None, None),
+        )
+        self.assert_scheduled(
+            ('ACTIVITY', 'a1', 2, 'in1'),
+        )
+
+    def test_hedge_duplicate_wins(self):
+        self.set_state(running=[0], results={1: None, 2: 20})
+        self.schedule_activity(spec='a1', input='in1', hedge_after=5)
+        self.assert_state(
+            (self.FOUND, 20, 2),
+        )
+        self.assert_scheduled(
+            ('CANCEL_ACTIVITY', 0),
+        )
+
+    def test_hedge_first_attempt_wins(self):
+        self.set_state(running=[1], results={0: 10})
+        self.schedule_activity(spec='a1', input='in1', hedge_after=5)
+        self.assert_state(
+            (self.FOUND, 10, 0),
+        )
+        self.assert_scheduled(
+            ('CANCEL_TIMER', 1),
+        )
+
+    def test_hedge_no_cancel(self):
+        self.set_state(running=[0], results={1: None, 2: 20})
+        self.schedule_activity(spec='a1', input='in1', hedge_after=5,
+                               hedge_cancel=False)
+        self.assert_state(
+            (self.FOUND, 20, 2),
+        )
+        self.assert_scheduled()
+
+    def test_hedge_wait_duplicate_after_error(self):
+        self.set_state(errors={0: 'err'}, results={1: None}, running=[2])
+        self.schedule_activity(spec='a1', input='in1', hedge_after=5)
+        self.assert_state(
+            (self.RUNNING, None, None),
+        )
+        self.assert_scheduled()
+
+
+    # BACKOFF
+
+    def backoff(self):
+        from flowy.proxy import ExponentialBackoff
+        return ExponentialBackoff(base=5, factor=2)
+
+    def test_backoff_reserves_a_timer_for_each_retry(self):
+        self.set_state()
+        self.schedule_activity(spec='a1', input='in1', retry=2,
+                               backoff=self.backoff())
+        self.schedule_activity(spec='a2', input='in2')
+        self.assert_scheduled(
+            ('ACTIVITY', 'a1', 0, 'in1'),  # 3 attempts and 2 timers
+            ('ACTIVITY', 'a2', 5, 'in2'),
+        )
+
+    def test_backoff_timer_after_timeout(self):
+        self.set_state(timedout=[0])
+        self.schedule_activity(spec='a1', input='in1', retry=2,
+                               backoff=self.backoff())
+        self.assert_state(
+            (self.RUNNING, None, None),
+        )
+        self.assert_scheduled(
+            ('TIMER', 5, 1),
+        )
+
+    def test_backoff_retry_after_timer(self):
+        self.set_state(timedout=[0], results={1: None})
+        self.schedule_activity(spec='a1', input='in1', retry=2,
+                               backoff=self.backoff())
+        self.assert_scheduled(
+            ('ACTIVITY', 'a1', 2, 'in1'),
+        )
+
+    def test_backoff_grows(self):
+        self.set_state(timedout=[0, 2], results={1: None})
+        self.schedule_activity(spec='a1', input='in1', retry=2,
+                               backoff=self.backoff())
+        self.assert_scheduled(
+            ('TIMER', 10, 3),
+        )
+
+    def test_backoff_all_timedout(self):
+        self.set_state(timedout=[0, 2], results={1: None})
+        self.schedule_activity(spec='a1', input='in1', retry=1,
+                               backoff=self.backoff())
+        self.assert_state(
+            (self.TIMEDOUT, None, 2),
+        )
+        self.assert_scheduled()
+
+    def test_backoff_delays(self):
+        from flowy.proxy import ExponentialBackoff
+        b = ExponentialBackoff(base=1, factor=3, max=20)
+        self.assertEqual([b.delay(n) for n in range(1, 6)], [1, 3, 9, 20, 20])
+        b = ExponentialBackoff(base=10, factor=1, jitter=0.5)
+        for _ in range(100):
+            self.assertTrue(10 <= b.delay(1) <= 15)
+
+
 class TestWorkflowBase(TestCase):
     def set_state(self, running=[], timedout=[], results={}, errors={},
-                  order=None):
+                  order=None, **kwargs):
         self.scheduler = DummyScheduler()
         self.Workflow = self.make_workflow()
-        order = list(range(10000))
+        if order is None:
+            order = list(range(10000))
         self.workflow = self.Workflow(self.scheduler, '[[], {}]', 'token',
                                       running, timedout, results, errors,
-                                      order, None, None)
+                                      order, None, None, **kwargs)
         self.workflow()
 
     def assert_scheduled(self, *state):
@@ -469,3 +651,498 @@ class TestResultBlocksWorkflow(TestWorkflowBase):
             ('ACTIVITY', self.Workflow.b._spec, 4, '[["b_input"], {}]'),
             'FLUSH'
         )
+
+
+class TestFusedWorkflow(TestWorkflowBase):
+
+    def make_workflow(self):
+        from flowy.task import _SWFWorkflow
+        from flowy.proxy import SWFActivityProxy, SWFFusedActivityProxy
+
+        class MyWorkflow(_SWFWorkflow):
+
+            a = SWFActivityProxy(name='a', version=1)
+            b = SWFActivityProxy(name='b', version=1)
+            ab = SWFFusedActivityProxy([a, b])
+            c = SWFActivityProxy(name='c', version=1)
+
+            def run(self):
+                return self.c(self.ab('x'))
+
+        return MyWorkflow
+
+    def test_schedule_fused(self):
+        self.set_state()
+        self.assert_scheduled(
+            ('ACTIVITY', self.Workflow.ab._spec, 0, '[["x"], {}]'),
+            'FLUSH'
+        )
+
+    def test_use_last_step_result(self):
+        self.set_state(results={0: '1', 1: '2'})
+        self.assert_scheduled(
+            ('ACTIVITY', self.Workflow.c._spec, 8, '[[2], {}]'),
+            'FLUSH'
+        )
+
+
+class DummyActivityClient(object):
+
+    def __init__(self, cancel=False):
+        self.state = []
+        self.cancel = cancel
+
+    def respond_activity_task_completed(self, result, task_token):
+        self.state.append(('COMPLETE', result))
+
+    def respond_activity_task_failed(self, reason, details, task_token):
+        self.state.append(('FAIL', reason, details))
+
+    def respond_activity_task_canceled(self, task_token):
+        self.state.append(('CANCELED',))
+
+    def record_activity_task_heartbeat(self, task_token):
+        self.state.append(('HEARTBEAT',))
+        return {'cancelRequested': self.cancel}
+
+
+class TestActivityCancel(TestCase):
+
+    def make_activity(self, client):
+        from flowy.task import SWFActivity
+
+        class Export(SWFActivity):
+            def run(self):
+                self.heartbeat()
+                return 1
+
+        return Export(client, '[[], {}]', 'token')
+
+    def test_keep_running(self):
+        client = DummyActivityClient()
+        self.make_activity(client)()
+        self.assertEqual(client.state, [('HEARTBEAT',), ('COMPLETE', '1')])
+
+    def test_stop_when_cancel_requested(self):
+        client = DummyActivityClient(cancel=True)
+        self.make_activity(client)()
+        self.assertEqual(client.state, [('HEARTBEAT',), ('CANCELED',)])
+
+    def test_stop_fused_steps(self):
+        from flowy.task import SWFFusedActivity
+        client = DummyActivityClient(cancel=True)
+        steps = [self.make_activity(client), self.make_activity(client)]
+        SWFFusedActivity(client, '[[], {}]', 'token', steps)()
+        self.assertEqual(client.state, [('HEARTBEAT',), ('CANCELED',)])
+
+
+class TestFusedActivity(TestCase):
+
+    def make_step(self, client, f):
+        from flowy.task import SWFActivity
+
+        class Step(SWFActivity):
+            def run(self, *args, **kwargs):
+                return f(*args, **kwargs)
+
+        return Step(client, None, 'token')
+
+    def test_run_steps_in_sequence(self):
+        from flowy.task import SWFFusedActivity
+        client = DummyActivityClient()
+        steps = [self.make_step(client, lambda x: x + 1),
+                 self.make_step(client, lambda x: x * 10)]
+        SWFFusedActivity(client, '[[1], {}]', 'token', steps)()
+        self.assertEqual(client.state, [('COMPLETE', '["2", "20"]')])
+
+    def test_fail_with_completed_steps(self):
+        from flowy.task import SWFFusedActivity
+        client = DummyActivityClient()
+
+        def error(x):
+            raise ValueError('err')
+
+        steps = [self.make_step(client, lambda x: x + 1),
+                 self.make_step(client, error)]
+        SWFFusedActivity(client, '[[1], {}]', 'token', steps)()
+        self.assertEqual(client.state, [('FAIL', 'err', '["2"]')])
+
+
+class TestCancelLosersWorkflow(TestWorkflowBase):
+
+    def make_workflow(self):
+        from flowy.task import _SWFWorkflow
+        from flowy.proxy import SWFActivityProxy, SWFWorkflowProxy
+
+        class MyWorkflow(_SWFWorkflow):
+
+            a = SWFActivityProxy(name='a', version=1)
+            b = SWFActivityProxy(name='b', version=1)
+            w = SWFWorkflowProxy(name='w', version=1)
+
+            def run(self):
+                return self.first_result(self.a(), self.b(), self.w(),
+                                         cancel=True)
+
+        return MyWorkflow
+
+    def test_nothing_to_cancel_while_waiting(self):
+        self.set_state(running=[0, 4, 8])
+        self.assert_scheduled('FLUSH')
+
+    def test_cancel_and_complete(self):
+        self.set_state(results={4: '2'}, running=[0, 8], order=[4],
+                       children={8: 'x-8'})
+        self.assert_scheduled(
+            ('CANCEL_ACTIVITY', 0),
+            ('CANCEL_WORKFLOW', 'x-8'),
+            ('COMPLETE', '2'),
+        )
+
+    def test_cancel_only_once(self):
+        self.set_state(results={4: '2'}, running=[0, 8], order=[4],
+                       cancelled=[0, 8])
+        self.assert_scheduled(
+            ('COMPLETE', '2'),
+        )
+
+    def test_dont_reschedule_cancelled(self):
+        self.set_state(results={4: '2'}, order=[4], cancelled=[0, 8])
+        self.assert_scheduled(
+            ('COMPLETE', '2'),
+        )
+
+    def test_dont_retry_cancelled_timeout(self):
+        self.set_state(results={4: '2'}, timedout=[0], order=[4, 0],
+                       cancelled=[0, 8])
+        self.assert_scheduled(
+            ('COMPLETE', '2'),
+        )
+
+
+class TestCancelHedgedLosersWorkflow(TestWorkflowBase):
+
+    def make_workflow(self):
+        from flowy.task import _SWFWorkflow
+        from flowy.proxy import SWFActivityProxy
+
+        class MyWorkflow(_SWFWorkflow):
+
+            # the first attempt, the hedge timer and the duplicate: 0-2
+            a = SWFActivityProxy(name='a', version=1, retry=0,
+                                 hedge_after=5)
+            b = SWFActivityProxy(name='b', version=1)
+
+            def run(self):
+                return self.first_result(self.a(), self.b(), cancel=True)
+
+        return MyWorkflow
+
+    def test_cancel_both_attempts(self):
+        self.set_state(results={1: None, 3: '2'}, running=[0, 2],
+                       order=[1, 3])
+        self.assert_scheduled(
+            ('CANCEL_ACTIVITY', 0),
+            ('CANCEL_ACTIVITY', 2),
+            ('COMPLETE', '2'),
+        )
+
+    def test_cancel_attempt_and_hedge_timer(self):
+        self.set_state(results={3: '2'}, running=[0, 1], order=[3])
+        self.assert_scheduled(
+            ('CANCEL_ACTIVITY', 0),
+            ('CANCEL_TIMER', 1),
+            ('COMPLETE', '2'),
+        )
+
+
+class TestFirstResultsCancelWorkflow(TestWorkflowBase):
+
+    def make_workflow(self):
+        from flowy.task import _SWFWorkflow
+        from flowy.proxy import SWFActivityProxy
+
+        class MyWorkflow(_SWFWorkflow):
+
+            a = SWFActivityProxy(name='a', version=1, delay=10)
+
+            def run(self):
+                calls = [self.a(i) for i in range(3)]
+                return self.first_results(2, *calls, cancel=True)
+
+        return MyWorkflow
+
+    def test_dont_wait_for_delayed_loser(self):
+        # each call has a timer and the activity: 0-1, 5-6, 10-11
+        self.set_state(results={0: None, 1: '1', 5: None, 6: '2'},
+                       running=[10], order=[1, 6])
+        self.assert_scheduled(
+            ('CANCEL_DELAY', 10),
+            ('COMPLETE', '[1, 2]'),
+        )
+
+    def test_dont_schedule_cancelled_delayed_loser(self):
+        # the timer fired after the loser was given up on
+        self.set_state(results={0: None, 1: '1', 5: None, 6: '2', 10: None},
+                       order=[1, 6], cancelled=[10])
+        self.assert_scheduled(
+            ('COMPLETE', '[1, 2]'),
+        )
+
+
+class TestSignalWorkflow(TestWorkflowBase):
+
+    def make_workflow(self):
+        from flowy.task import _SWFWorkflow
+        from flowy.proxy import SWFActivityProxy
+
+        class MyWorkflow(_SWFWorkflow):
+
+            a = SWFActivityProxy(name='a', version=1)
+
+            def run(self):
+                first = self.wait_for_signal('go')
+                second = self.wait_for_signal('go')
+                return self.a(first, second)
+
+        return MyWorkflow
+
+    def test_wait_without_decisions(self):
+        self.set_state()
+        self.assert_scheduled('FLUSH')
+
+    def test_wait_for_the_next_signal(self):
+        self.set_state(signals={'go': ['1']}, order=[('go', 0)])
+        self.assert_scheduled('FLUSH')
+
+    def test_signals_in_order(self):
+        self.set_state(signals={'go': ['1', None]},
+                       order=[('go', 0), ('go', 1)])
+        self.assert_scheduled(
+            ('ACTIVITY', self.Workflow.a._spec, 0, '[[1, null], {}]'),
+            'FLUSH',
+        )
+
+    def test_signal_ordered_with_results(self):
+        from flowy.task import _SWFWorkflow
+        workflow = _SWFWorkflow(None, 'input', 'token', [], [], {'0': '1'},
+                                {}, [('go', 0), '0'], None, None,
+                                signals={'go': ['2']})
+        signal = workflow.wait_for_signal('go')
+        self.assertEqual(signal.result(), 2)
+        self.assertEqual(signal._order, 0)
+
+
+class TestAccumulateWorkflow(TestWorkflowBase):
+
+    def make_workflow(self):
+        from flowy.task import _SWFWorkflow
+        from flowy.proxy import SWFActivityProxy
+
+        class MyWorkflow(_SWFWorkflow):
+
+            a = SWFActivityProxy(name='a', version=1, error_handling=True)
+
+            def run(self):
+                results = [self.a(i) for i in range(3)]
+                return self.accumulate('sum', lambda x, y: x + y, 0, *results)
+
+        return MyWorkflow
+
+    def test_checkpoint_finished(self):
+        self.set_state(results={0: '1', 8: '3'}, running=[4], order=[8, 0])
+        self.assert_scheduled(
+            ('MARKER', 'sum', '{"folded": [[0, 1]], "value": 4}'),
+            'FLUSH',
+        )
+
+    def test_fold_only_new_results(self):
+        # the checkpointed results are never deserialized again
+        self.set_state(results={0: 'x', 4: '2', 8: 'x'}, order=[8, 0, 4],
+                       markers={'sum': '{"folded": [[0, 1]], "value": 4}'})
+        self.assert_scheduled(
+            ('MARKER', 'sum', '{"folded": [[0, 2]], "value": 6}'),
+            ('COMPLETE', '6'),
+        )
+
+    def test_nothing_new(self):
+        self.set_state(results={0: 'x', 8: 'x'}, running=[4], order=[8, 0],
+                       markers={'sum': '{"folded": [[0, 1]], "value": 4}'})
+        self.assert_scheduled('FLUSH')
+
+    def test_error(self):
+        self.set_state(results={0: '1'}, errors={4: 'err'}, running=[8],
+                       order=[0, 4])
+        self.assert_scheduled(('FAIL', 'err'))
+
+
+class TestBroadcastWorkflow(TestWorkflowBase):
+
+    def setUp(self):
+        from flowy.blob import set_blob_store
+        from flowy.tests.test_blob import DummyBlobStore
+        self.store = DummyBlobStore()
+        set_blob_store(self.store)
+
+    def tearDown(self):
+        from flowy.blob import set_blob_store
+        set_blob_store(None)
+
+    def make_workflow(self):
+        from flowy.task import _SWFWorkflow
+        from flowy.proxy import SWFActivityProxy
+
+        class MyWorkflow(_SWFWorkflow):
+
+            a = SWFActivityProxy(name='a', version=1)
+
+            def run(self):
+                table = self.broadcast({'x': 1})
+                return self.a(table, 1), self.a(table, 2)
+
+        return MyWorkflow
+
+    def test_store_once(self):
+        self.set_state()
+        self.assertEqual(self.store.blobs, {'0': b'{"x": 1}'})
+        self.assertEqual(self.scheduler.state[0],
+                         ('MARKER', 'flowy.broadcast.0', '0'))
+        self.assertEqual(self.scheduler.state[1][3],
+                         '[[{"@broadcast": "0"}, 1], {}]')
+
+    def test_reuse_handle(self):
+        self.set_state(running=[0], markers={'flowy.broadcast.0': '7'})
+        self.assertEqual(self.store.blobs, {})
+        self.assert_scheduled(
+            ('ACTIVITY', self.Workflow.a._spec, 4,
+             '[[{"@broadcast": "7"}, 2], {}]'),
+            'FLUSH',
+        )
+
+    def test_inline_without_store(self):
+        from flowy.blob import set_blob_store
+        set_blob_store(None)
+        self.set_state(running=[4])
+        self.assert_scheduled(
+            ('ACTIVITY', self.Workflow.a._spec, 0, '[[{"x": 1}, 1], {}]'),
+            'FLUSH',
+        )
+
+
+class DummyDecisionClient(object):
+
+    def __init__(self):
+        self.decisions = None
+
+    def respond_decision_task_completed(self, task_token, decisions):
+        self.decisions = decisions
+
+
+class TestSWFScheduler(TestCase):
+
+    def test_shared_timers(self):
+        from flowy.task import SWFScheduler
+        client = DummyDecisionClient()
+        scheduler = SWFScheduler(client, 'token')
+        scheduler.schedule_timer(10, 0)
+        scheduler.schedule_timer(20, 2)
+        scheduler.schedule_timer(10, 4)
+        scheduler.schedule_timer(10, 6, shared=False)
+        scheduler.flush()
+        attrs = [d['startTimerDecisionAttributes'] for d in client.decisions]
+        self.assertEqual(attrs, [
+            {'startToFireTimeout': '10', 'timerId': '0', 'control': '[0, 4]'},
+            {'startToFireTimeout': '20', 'timerId': '2'},
+            {'startToFireTimeout': '10', 'timerId': '6'},
+        ])
+
+
+    def run_workflow(self, run, running, results, order, **kwargs):
+        from flowy.task import SWFWorkflow
+        from flowy.proxy import SWFActivityProxy
+
+        class MyWorkflow(SWFWorkflow):
+
+            a = SWFActivityProxy(name='a', version=1, **kwargs)
+            b = SWFActivityProxy(name='b', version=1)
+
+        MyWorkflow.run = run
+        client = DummyDecisionClient()
+        MyWorkflow(client, '[[], {}]', 'token', running, [], results, {},
+                   order, None, None)()
+        return [d['decisionType'] for d in client.decisions]
+
+    def test_cancel_losers_before_closing(self):
+        def run(self):
+            return self.first_result(self.a(), self.b(), cancel=True)
+        decisions = self.run_workflow(run, [0], {4: '2'}, [4])
+        self.assertEqual(decisions, ['RequestCancelActivityTask',
+                                     'CompleteWorkflowExecution'])
+
+    def test_cancel_hedge_loser_before_closing(self):
+        def run(self):
+            return self.a()
+        decisions = self.run_workflow(run, [0], {1: None, 2: '20'}, [1, 2],
+                                      retry=0, hedge_after=5)
+        self.assertEqual(decisions, ['RequestCancelActivityTask',
+                                     'CompleteWorkflowExecution'])
+
+    def test_dont_cancel_calls_never_started(self):
+        def run(self):
+            self.first_result(self.a(), self.b(), cancel=True)
+            self.fail('stop')
+        decisions = self.run_workflow(run, [], {3: '2'}, [3], retry=0,
+                                      hedge_after=5)
+        self.assertEqual(decisions, ['FailWorkflowExecution'])
+
+    def test_cancel_before_failing(self):
+        def run(self):
+            self.first_result(self.a(), self.b(), cancel=True)
+            self.fail('stop')
+        decisions = self.run_workflow(run, [0], {4: '2'}, [4])
+        self.assertEqual(decisions, ['RequestCancelActivityTask',
+                                     'FailWorkflowExecution'])
+
+
+class TestPartitionedWorkflow(TestCase):
+
+    def make_workflow(self, results={}, order=[]):
+        from flowy.task import SWFPartitionedWorkflow
+        from flowy.proxy import SWFPartitionProxy
+
+        class Sum(SWFPartitionedWorkflow):
+
+            partition = SWFPartitionProxy('Sum', 1, width=3, leaf_size=2,
+                                          reduce=sum)
+
+            def run_leaf(self, start, stop):
+                return sum(range(start, stop))
+
+        client = DummyDecisionClient()
+        workflow = Sum(client, '[[0, 7], {}]', 'token', [], [], results, {},
+                       order, None, None, workflow_id='root')
+        workflow()
+        return client.decisions
+
+    def test_split_with_deterministic_ids(self):
+        decisions = self.make_workflow()
+        SCWEDA = 'startChildWorkflowExecutionDecisionAttributes'
+        attrs = [(d[SCWEDA]['workflowId'], d[SCWEDA]['input'])
+                 for d in decisions]
+        self.assertEqual(attrs, [
+            ('root-0', '[[0, 3], {}]'),
+            ('root-4', '[[3, 6], {}]'),
+            ('root-8', '[[6, 7], {}]'),
+        ])
+
+    def test_reduce(self):
+        decisions = self.make_workflow(results={0: '3', 4: '12', 8: '6'},
+                                       order=[4, 0, 8])
+        CWEDA = 'completeWorkflowExecutionDecisionAttributes'
+        self.assertEqual(decisions[0][CWEDA]['result'], '21')
+
+    def test_slices(self):
+        from flowy.proxy import SWFPartitionProxy
+        proxy = SWFPartitionProxy('Sum', 1, width=3, leaf_size=2)
+        self.assertEqual(proxy._slices(5, 7), [(5, 7)])
+        self.assertEqual(proxy._slices(0, 10), [(0, 4), (4, 8), (8, 10)])
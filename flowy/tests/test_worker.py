@@ -0,0 +1,219 @@
+import os
+import shutil
+import tempfile
+import time
+from collections import Counter
+from unittest import TestCase
+
+
+class DummyWorker(object):
+
+    def __init__(self, path, fail=False):
+        self._path = path
+        self._fail = fail
+
+    def run_forever(self, loop=-1):
+        with open(self._path, 'a') as f:
+            f.write('%s\n' % os.getpid())
+        if self._fail:
+            raise RuntimeError('fail')
+
+
+class TestPreforkSupervisor(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'tasks')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def supervise(self, exits, fail=False, **kwargs):
+        from flowy.worker import PreforkSupervisor
+
+        class Supervisor(PreforkSupervisor):
+            respawn_delay = 0
+            exited = 0
+
+            def _wait(self):
+                result = super(Supervisor, self)._wait()
+                self.exited += 1
+                if self.exited >= exits:
+                    self._stopping = True
+                return result
+
+        supervisor = Supervisor(lambda: DummyWorker(self.path, fail),
+                                **kwargs)
+        supervisor.run_forever()
+        self.assertEqual(supervisor._children, set())
+        with open(self.path) as f:
+            return Counter(f.read().split())
+
+    def test_recycle_after_max_tasks(self):
+        tasks = self.supervise(3, processes=2, max_tasks=2)
+        self.assertTrue(len([c for c in tasks.values() if c == 2]) >= 3)
+        self.assertTrue(max(tasks.values()) <= 2)
+        self.assertFalse(str(os.getpid()) in tasks)
+
+    def test_respawn_dead_workers(self):
+        tasks = self.supervise(3, fail=True, processes=1)
+        self.assertEqual(sorted(tasks.values()), [1, 1, 1])
+
+
+class DummyTask(object):
+
+    def __init__(self, path, input):
+        self._path = path
+        self._input = input
+
+    def __call__(self):
+        if self._input.startswith('hang'):
+            time.sleep(30)
+        if self._input.startswith('memory'):
+            self.memory = bytearray(200 * 1024 * 1024)
+            time.sleep(30)
+        with open(self._path, 'a') as f:
+            f.write('%s %s %s\n' % (os.getpid(), len(self._input),
+                                    self._input == 'x' * len(self._input)))
+
+
+class DummyPoller(object):
+
+    def __init__(self, path, inputs=(), timeouts=None):
+        self._path = path
+        self._inputs = list(inputs)
+        self._timeouts = timeouts or {}
+        self.failed = []
+        self.timedout = []
+
+    def poll_next_response(self):
+        input = self._inputs.pop(0)
+        return (input[:1], 1), input, 'token'
+
+    def build_task(self, spec_key, input, token):
+        return DummyTask(self._path, input)
+
+    def start_to_close(self, spec_key, input=None):
+        return self._timeouts.get(spec_key[0])
+
+    def fail_task(self, token, reason):
+        self.failed.append((token, reason))
+
+    def time_out_task(self, token, reason):
+        self.timedout.append((token, reason))
+
+
+class TestProcessPoolWorker(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'tasks')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_run_in_pool(self):
+        from flowy import worker
+        segments = []
+
+        def share(data, threshold):
+            payload, segment = old_share(data, threshold)
+            segments.append(segment)
+            return payload, segment
+
+        inputs = ['x' * 10, 'x' * 100000, 'x' * 20, 'x' * 200000]
+        old_share, worker._share = worker._share, share
+        try:
+            worker.ProcessPoolWorker(
+                DummyPoller(self.path, inputs),
+                lambda: DummyPoller(self.path), processes=2,
+                threshold=1000).run_forever(4)
+        finally:
+            worker._share = old_share
+        with open(self.path) as f:
+            tasks = [line.split() for line in f]
+        self.assertEqual(sorted(int(l) for _, l, _ in tasks),
+                         [10, 20, 100000, 200000])
+        self.assertTrue(all(ok == 'True' for _, _, ok in tasks))
+        self.assertFalse(str(os.getpid()) in [pid for pid, _, _ in tasks])
+        if worker.shared_memory is not None:
+            shared = [s for s in segments if s is not None]
+            self.assertEqual(len(shared), 2)
+            for segment in shared:
+                self.assertRaises(OSError, worker.shared_memory.SharedMemory,
+                                  name=segment.name)
+
+    def test_limited_pool(self):
+        from flowy.limits import Limit, Limiter
+        from flowy.worker import ProcessPoolWorker
+
+        class RecordingLimiter(Limiter):
+            most = 0
+
+            def start(self, spec_key):
+                super(RecordingLimiter, self).start(spec_key)
+                if spec_key[0] == 'x':
+                    running = self._running[('x', '1')]
+                    self.most = max(self.most, running)
+
+        limiter = RecordingLimiter({('x', 1): Limit(concurrency=1)})
+        inputs = ['x' * 10, 'x' * 20, 'y' * 10, 'x' * 30, 'y' * 20]
+        ProcessPoolWorker(DummyPoller(self.path, inputs),
+                          lambda: DummyPoller(self.path), processes=3,
+                          limiter=limiter).run_forever(5)
+        with open(self.path) as f:
+            tasks = [line.split() for line in f]
+        self.assertEqual(len(tasks), 5)
+        self.assertEqual(limiter.most, 1)
+        self.assertEqual(limiter.delay(('x', 1)), 0)
+
+    def test_resource_admission(self):
+        from flowy.limits import Capacity, Limit, Limiter
+        from flowy.worker import ProcessPoolWorker
+
+        class RecordingLimiter(Limiter):
+            most = 0
+
+            def start(self, spec_key):
+                super(RecordingLimiter, self).start(spec_key)
+                self.most = max(self.most, self._used[1])
+
+        limiter = RecordingLimiter({('x', 1): Limit(memory=600),
+                                    ('y', 1): Limit(memory=300)},
+                                   capacity=Capacity(memory=1000))
+        inputs = ['x' * 10, 'x' * 20, 'y' * 10, 'y' * 20, 'x' * 30]
+        ProcessPoolWorker(DummyPoller(self.path, inputs),
+                          lambda: DummyPoller(self.path), processes=4,
+                          limiter=limiter).run_forever(5)
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 5)
+        self.assertTrue(limiter.most <= 1000)
+        self.assertEqual(limiter._used, [0, 0])
+
+    def test_kill_after_start_to_close(self):
+        from flowy.worker import ProcessPoolWorker
+        poller = DummyPoller(self.path, ['hang', 'x' * 10, 'x' * 20],
+                             timeouts={'h': 0.2})
+        started = time.time()
+        ProcessPoolWorker(poller, lambda: DummyPoller(self.path),
+                          processes=1).run_forever(3)
+        self.assertTrue(time.time() - started < 10)
+        self.assertEqual(poller.failed, [])
+        self.assertEqual(poller.timedout, [
+            ('token', 'The task exceeded its start to close timeout.')])
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+    def test_kill_over_max_task_rss(self):
+        from flowy.worker import ProcessPoolWorker, _rss
+        if not _rss(os.getpid()):
+            self.skipTest('the RSS of the processes is not known')
+        poller = DummyPoller(self.path, ['memory', 'x' * 10])
+        worker = ProcessPoolWorker(poller, lambda: DummyPoller(self.path),
+                                   processes=2, max_task_rss=150)
+        worker.rss_interval = 0.05
+        started = time.time()
+        worker.run_forever(2)
+        self.assertTrue(time.time() - started < 10)
+        self.assertEqual(poller.failed, [
+            ('token', 'The task exceeded 150MB of memory.')])
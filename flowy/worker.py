@@ -1,9 +1,431 @@
+import errno
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+    from multiprocessing.connection import wait as wait_connections
+except ImportError:  # pragma: no cover
+    resource_tracker = shared_memory = wait_connections = None
+
+logger = logging.getLogger(__name__)
+
+
 class SingleThreadedWorker(object):
-    def __init__(self, poller):
+    def __init__(self, poller, teardown=None, limiter=None):
         self._poller = poller
+        self._teardown = teardown
+        self._limiter = limiter
 
     def run_forever(self, loop=-1):
         while loop:
-            task = self._poller.poll_next_task()
-            task()
+            if self._limiter is None:
+                task = self._poller.poll_next_task()
+                task()
+            else:
+                self._run_limited()
             loop = max(-1, loop - 1)
+
+    def _run_limited(self):
+        spec_key, input, token = self._poller.poll_next_response()
+        # only one task runs at a time, so only the rate can hold it
+        delay = self._limiter.delay(spec_key)
+        if delay:
+            time.sleep(delay)
+        self._limiter.start(spec_key)
+        try:
+            self._poller.build_task(spec_key, input, token)()
+        finally:
+            self._limiter.finish(spec_key)
+
+    def close(self):
+        if self._teardown is not None:
+            self._teardown()
+
+
+class PreforkSupervisor(object):
+    """ Runs workers in forked processes and keeps them running.
+
+    Everything imported and scanned before run_forever is shared with the
+    workers copy-on-write. The workers are built by worker_factory after the
+    fork, so they don't share connections. A worker exits and is replaced
+    after max_tasks tasks or once its peak RSS is over max_rss megabytes.
+    """
+
+    # don't fork faster than this if the workers keep dying
+    respawn_delay = 1
+
+    def __init__(self, worker_factory, processes=1, max_tasks=None,
+                 max_rss=None):
+        self._worker_factory = worker_factory
+        self._processes = processes
+        self._max_tasks = max_tasks
+        self._max_rss = max_rss
+        self._children = set()
+        self._stopping = False
+
+    def run_forever(self):
+        old_handlers = dict((s, signal.signal(s, self._stop))
+                            for s in (signal.SIGTERM, signal.SIGINT))
+        try:
+            while not self._stopping:
+                while len(self._children) < self._processes:
+                    self._children.add(self._spawn())
+                started = time.time()
+                pid, status = self._wait()
+                if pid is None:
+                    continue
+                self._children.discard(pid)
+                if os.WIFSIGNALED(status) or os.WEXITSTATUS(status):
+                    logger.warning('Worker %s died with status %s.', pid,
+                                   status)
+                    if time.time() - started < self.respawn_delay:
+                        time.sleep(self.respawn_delay)
+        finally:
+            for s, handler in old_handlers.items():
+                signal.signal(s, handler)
+            self._shutdown()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            return pid
+        status = 1
+        try:
+            for s in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(s, signal.SIG_DFL)
+            self._run_worker()
+            status = 0
+        except Exception:
+            logger.exception('Error in the worker:')
+        finally:
+            os._exit(status)
+
+    def _run_worker(self):
+        worker = self._worker_factory()
+        tasks = 0
+        try:
+            while self._max_tasks is None or tasks < self._max_tasks:
+                worker.run_forever(1)
+                tasks += 1
+                if (self._max_rss is not None
+                        and _peak_rss() > self._max_rss):
+                    logger.info('Recycling the worker, its RSS is over '
+                                '%sMB.', self._max_rss)
+                    break
+        finally:
+            close = getattr(worker, 'close', None)
+            if close is not None:
+                close()
+
+    def _wait(self):
+        try:
+            return os.wait()
+        except OSError as e:
+            # interrupted by a signal
+            if e.errno == errno.EINTR:
+                return None, None
+            raise
+
+    def _stop(self, signum, frame):
+        # the supervisor is waiting for the workers so stop them first
+        self._stopping = True
+        self._kill_children()
+
+    def _kill_children(self):
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def _shutdown(self):
+        self._kill_children()
+        for pid in self._children:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self._children.clear()
+
+
+class ProcessPoolWorker(object):
+    """ Polls for activity tasks here and runs them in a pool of processes.
+
+    A task is only polled when a process is idle, so it doesn't wait in a
+    queue while its timeouts are running. The processes report the results
+    to SWF themselves, with their own pollers built by poller_factory after
+    the fork. The inputs longer than threshold are handed over in a shared
+    memory segment instead of being pickled through the pipes, the segment
+    is unlinked as soon as the process is done with the task or dies.
+    setup and teardown are called in every process when it starts and
+    before it exits.
+
+    The tasks over the limits of the limiter are held until they can start,
+    meanwhile the other tasks keep running. No more tasks are polled while
+    there are as many held tasks as processes, or while the resources left
+    on the host don't fit the needs of any activity.
+
+    A process running a task for longer than the start to close timeout of
+    its activity, or using more than max_task_rss megabytes, is killed and
+    replaced and the task is failed right away. A task out of time is failed
+    as timed out, so the decider retries it like an SWF timeout. The
+    processes are checked between the polls.
+    """
+
+    # how often the memory of the processes is checked, in seconds
+    rss_interval = 1
+
+    def __init__(self, poller, poller_factory, processes=2,
+                 threshold=65536, setup=None, teardown=None, limiter=None,
+                 max_task_rss=None):
+        self._poller = poller
+        self._poller_factory = poller_factory
+        self._processes = processes
+        self._threshold = threshold
+        self._setup = setup
+        self._teardown = teardown
+        self._limiter = limiter
+        self._max_task_rss = max_task_rss
+        self._pool = {}  # connection -> process
+        # connection -> (spec key, shared memory segment, token, deadline)
+        self._busy = {}
+        self._held = []  # the polled tasks waiting for their limits
+
+    def run_forever(self, loop=-1):
+        self._start()
+        try:
+            while loop or self._held:
+                conn = self._idle_connection()
+                if self._dispatch(conn):
+                    continue
+                if (not loop or len(self._held) >= self._processes
+                        or not self._can_poll()):
+                    # don't claim more tasks until a held one can start
+                    self._collect(timeout=self._hold_time())
+                    continue
+                self._held.append(self._poller.poll_next_response())
+                loop = max(-1, loop - 1)
+        finally:
+            self._shutdown()
+
+    def _dispatch(self, conn):
+        for i, (spec_key, input, token) in enumerate(self._held):
+            if self._limiter is None or self._limiter.delay(spec_key) == 0:
+                break
+        else:
+            return False
+        del self._held[i]
+        if self._limiter is not None:
+            self._limiter.start(spec_key)
+        payload, segment = _share(input, self._threshold)
+        deadline = self._poller.start_to_close(spec_key, input)
+        if deadline is not None:
+            deadline += time.time()
+        self._busy[conn] = spec_key, segment, token, deadline
+        conn.send((spec_key, payload, token))
+        return True
+
+    def _can_poll(self):
+        return self._limiter is None or self._limiter.can_poll()
+
+    def _hold_time(self):
+        # None waits for a running task to finish
+        delays = [self._limiter.delay(spec_key)
+                  for spec_key, _, _ in self._held]
+        delays = [d for d in delays if d is not None]
+        if not delays:
+            return None
+        return min(delays)
+
+    def _start(self):
+        if shared_memory is not None:
+            # shared by the processes so they don't unlink the segments
+            resource_tracker.ensure_running()
+        while len(self._pool) < self._processes:
+            self._spawn()
+
+    def _spawn(self):
+        conn, child_conn = _fork_context().Pipe()
+        process = _fork_context().Process(target=self._run_process,
+                                          args=(child_conn, conn))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        self._pool[conn] = process
+
+    def _run_process(self, conn, parent_conn):
+        # only the poller is interrupted, the tasks are drained on shutdown
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # notice when the poller dies
+        for c in list(self._pool) + [parent_conn]:
+            c.close()
+        poller = self._poller_factory()
+        if self._setup is not None:
+            self._setup()
+        try:
+            while 1:
+                message = conn.recv()
+                if message is None:
+                    break
+                spec_key, payload, token = message
+                try:
+                    poller.build_task(spec_key, _load(payload), token)()
+                except Exception:
+                    logger.exception('Error while running the task:')
+                conn.send(True)
+        finally:
+            if self._teardown is not None:
+                self._teardown()
+
+    def _idle_connection(self):
+        while 1:
+            all_busy = len(self._busy) == len(self._pool)
+            self._collect(timeout=None if all_busy else 0)
+            for conn in self._pool:
+                if conn not in self._busy:
+                    return conn
+
+    def _collect(self, timeout=0, respawn=True):
+        ready = []
+        if self._busy:
+            ready = wait_connections(list(self._busy),
+                                     self._guard_time(timeout))
+        elif timeout:
+            time.sleep(timeout)
+        for conn in ready:
+            try:
+                conn.recv()
+            except EOFError:
+                logger.warning('Pool process %s died.', self._pool[conn].pid)
+                self._replace(conn, respawn)
+            self._done(conn)
+        self._enforce(respawn)
+
+    def _guard_time(self, timeout):
+        # wake up in time to enforce the guardrails
+        times = [d - time.time() for _, _, _, d in self._busy.values()
+                 if d is not None]
+        if self._max_task_rss is not None:
+            times.append(self.rss_interval)
+        if timeout is not None:
+            times.append(timeout)
+        if not times:
+            return None
+        return max(0, min(times))
+
+    def _enforce(self, respawn):
+        now = time.time()
+        for conn, (_, _, token, deadline) in list(self._busy.items()):
+            pid = self._pool[conn].pid
+            fail = self._poller.fail_task
+            if deadline is not None and now > deadline:
+                reason = 'The task exceeded its start to close timeout.'
+                fail = self._poller.time_out_task
+            elif (self._max_task_rss is not None
+                    and _rss(pid) > self._max_task_rss):
+                reason = 'The task exceeded %sMB of memory.' % (
+                    self._max_task_rss)
+            else:
+                continue
+            logger.warning('Killing the pool process %s: %s', pid, reason)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self._replace(conn, respawn)
+            self._done(conn)
+            fail(token, reason)
+
+    def _replace(self, conn, respawn):
+        self._pool.pop(conn).join()
+        conn.close()
+        if respawn:
+            self._spawn()
+
+    def _done(self, conn):
+        spec_key, segment, _, _ = self._busy.pop(conn)
+        if self._limiter is not None:
+            self._limiter.finish(spec_key)
+        _release(segment)
+
+    def _shutdown(self):
+        for conn in self._pool:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+        while self._busy:
+            self._collect(timeout=None, respawn=False)
+        for conn, process in self._pool.items():
+            process.join()
+            conn.close()
+        self._pool.clear()
+
+
+class _SharedPayload(object):
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+
+def _share(data, threshold):
+    if shared_memory is None or threshold is None or len(data) <= threshold:
+        return data, None
+    buf = data.encode('utf-8')
+    segment = shared_memory.SharedMemory(create=True, size=len(buf))
+    segment.buf[:len(buf)] = buf
+    # only the name is needed to unlink it later
+    segment.close()
+    return _SharedPayload(segment.name, len(buf)), segment
+
+
+def _load(payload):
+    if not isinstance(payload, _SharedPayload):
+        return payload
+    segment = shared_memory.SharedMemory(name=payload.name)
+    view = segment.buf[:payload.size]
+    try:
+        return str(view, 'utf-8')
+    finally:
+        view.release()
+        segment.close()
+
+
+def _release(segment):
+    if segment is None:
+        return
+    try:
+        segment.unlink()
+    except OSError:
+        pass
+
+
+def _fork_context():
+    # the processes inherit the scanned tasks and the poller factory
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing  # pragma: no cover
+
+
+def _rss(pid):
+    # in MB, only known on Linux
+    try:
+        with open('/proc/%s/statm' % pid) as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return 0
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024)
+
+
+def _peak_rss():
+    # in MB, ru_maxrss is in kilobytes on Linux and in bytes on OS X
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / (1024.0 * 1024)
+    return rss / 1024.0
@@ -21,7 +21,7 @@ setup(
         'venusian>=1.0a8',
         'boto3>=1.12.37'
     ],
-    tests_require=['coverage'],
+    tests_require=['coverage', 'fakeredis[lua]'],
     test_suite="nose.collector",
     extras_require={'docs': ['sphinx', 'sphinx_rtd_theme']},
     entry_points={